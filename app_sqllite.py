@@ -1,23 +1,48 @@
 import os
 import json
 import re
-from flask import Flask, request, render_template, redirect, url_for, jsonify, send_file
+import io
+import time
+import hashlib
+import click
+from flask import Flask, request, render_template, redirect, url_for, jsonify, send_file, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
-from vertex_llm import init_vertexai, get_summary_with_context, get_entity_relationship_with_context, get_kop_doc
-from utils import extract_text_from_pdf, parse_graph_data, markdown_to_docx
-from db_models import db, Regulation, Upload, Summary, EntityGraph
+from datetime import datetime, timedelta
+from vertex_llm import init_llm, get_summary_with_context, get_incremental_summary, get_entity_relationship_with_context, get_kop_doc, stream_kop_doc, llm_cache, get_call_metrics, PROMPT_VERSION
+from utils import extract_text_from_pdf, markdown_to_docx, MarkdownDocxWriter, file_sha256, parse_page_range, diff_sections, diff_relationships, align_entities, remap_entity_ids, layout_graphs
+from db_models import (db, Regulation, Upload, Summary, EntityGraph, Job, KopDocument, GraphVersion, upgrade_schema,
+                       HISTORY_COUNTER, bump_counter, counter_value)
+from jobs import JobQueue, job_to_dict
+from pipeline import Stage, run_stages, timing_summary
+from graph_store import RelationGraph, pack_graph, stored_relationships, iter_stored_vis_json
+from http_cache import cached_response, payload_cache
+import tracing
+from batch import load_manifest, run_batch, batch_summary, format_summary
+from obligation_index import (obligation_rows, replace_obligations, ensure_fts, search_obligations, obligation_to_dict,
+                              PERIOD_NAMES, SEARCH_PAGE_SIZE, SEARCH_MAX_PAGE_SIZE)
+from timeline import update_timeline, rebuild_version, diff_versions, edge_history, version_to_dict
 from docx import Document
-from io import BytesIO
 
 app = Flask(__name__)
 
-# Use SQLite database (local file-based)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///regulations.db'
+# Use SQLite database (local file-based); DATABASE_URL points elsewhere, e.g. a scratch DB for benchmarks
+app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv("DATABASE_URL", 'sqlite:///regulations.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Background workers write while requests read; wait on SQLite locks instead of failing
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {"connect_args": {"timeout": 30}}
+app.config['JOB_WORKERS'] = int(os.getenv("JOB_WORKERS", 2))
+app.config['PIPELINE_WORKERS'] = int(os.getenv("PIPELINE_WORKERS", 4))
+# Only send changed sections to the LLM when at least this share of the new text is unchanged
+app.config['INCREMENTAL_DIFF'] = os.getenv("INCREMENTAL_DIFF", "1") == "1"
+app.config['INCREMENTAL_MIN_SKIP'] = float(os.getenv("INCREMENTAL_MIN_SKIP", 0.3))
 db.init_app(app)
 
-init_vertexai()
+job_queue = JobQueue(app)
+
+# PDF extraction workers are spawned processes, which re-import the script
+# that started the server as __mp_main__; they only need pdf_worker
+if __name__ != "__mp_main__":
+    init_llm()
 
 @app.route("/", methods=["GET", "POST"])
 def index():
@@ -28,152 +53,892 @@ def index():
         old_path = request.form.get('old_path', '').strip()
         new_path = request.form.get('new_path', '').strip()
         first_time_path = request.form.get('first_time_path', '').strip()
+        page_range = request.form.get('page_range', '').strip() or None
+
+        if page_range:
+            try:
+                parse_page_range(page_range, 1)
+            except ValueError as e:
+                return str(e), 400
 
         if mode == "first_time":
             if not os.path.exists(first_time_path):
                 return "New Regulation PDF path is invalid.", 400
-            upload = Upload(regulation_id=regulation_id, old_path=None, new_path=first_time_path)
+            upload = Upload(regulation_id=regulation_id, old_path=None, new_path=first_time_path, page_range=page_range)
         else:
             if not (os.path.exists(old_path) and os.path.exists(new_path)):
                 return "Old or New PDF path is invalid.", 400
-            upload = Upload(regulation_id=regulation_id, old_path=old_path, new_path=new_path)
+            upload = Upload(regulation_id=regulation_id, old_path=old_path, new_path=new_path, page_range=page_range)
 
         db.session.add(upload)
+        bump_counter(HISTORY_COUNTER)
         db.session.commit()
-        process_upload(upload.id)
+        job_queue.submit("process", upload.id)
         return redirect(url_for("compare", upload_id=upload.id))
 
     return render_template("index.html", regulations=regulations)
 
 
-def process_upload(upload_id):
-    upload = Upload.query.get(upload_id)
+def process_upload(upload_id, progress=None, use_cache=True):
+    report = progress or (lambda pct, stage: None)
+    upload = db.session.get(Upload, upload_id)
 
-    db.session.query(Summary).filter_by(upload_id=upload.id).delete()
-    db.session.query(EntityGraph).filter_by(upload_id=upload.id).delete()
+    # Hash the files on every run since the paths may have been overwritten in place
+    upload.new_hash = file_sha256(upload.new_path)
+    upload.old_hash = file_sha256(upload.old_path) if upload.old_path else None
+    # Stored results only stand in for the old PDF when they cover the same pages,
+    # and a regenerate recomputes both sides, so it has no previous version
+    previous = find_previous_version(upload) if use_cache and upload.old_path and not upload.page_range else None
+    upload.previous_upload_id = previous[0].id if previous else None
+    db.session.commit()
 
-    if not upload.old_path:
-        new_text = extract_text_from_pdf(upload.new_path)
-        new_summary = get_summary_with_context(new_text)
-        new_json = get_entity_relationship_with_context(new_summary)
+    # Stages run on worker threads outside the app context, so hand them plain values
+    old_path, new_path = upload.old_path, upload.new_path
+    old_hash, new_hash = upload.old_hash, upload.new_hash
+    page_range = upload.page_range
+    regulation_id = upload.regulation_id
+
+    if not old_path:
+        stages = [
+            Stage("new_text", lambda: extract_text_from_pdf(new_path, page_range=page_range, file_hash=new_hash), label="Extracting text"),
+            Stage("new_summary", lambda new_text: get_summary_with_context(new_text, use_cache=use_cache),
+                  deps=["new_text"], label="Summarizing regulation"),
+            Stage("new_json", lambda new_summary: get_entity_relationship_with_context(new_summary, use_cache=use_cache),
+                  deps=["new_summary"], label="Extracting entity relationships"),
+        ]
+    else:
+        if previous:
+            # The old PDF is the new side of an earlier upload: reuse its stored results
+            _, previous_summary, previous_graph = previous
+            reused_summary, reused_json = previous_summary.new_summary, stored_relationships(previous_graph, "new")
+            old_stages = [
+                Stage("old_summary", lambda: reused_summary, label="Reusing old summary"),
+                Stage("old_json", lambda: reused_json, label="Reusing old entity relationships"),
+            ]
+        else:
+            old_stages = [
+                Stage("old_summary", lambda old_text: get_summary_with_context(old_text, use_cache=use_cache),
+                      deps=["old_text"], label="Summarizing old regulation"),
+                Stage("old_json", lambda old_summary: get_entity_relationship_with_context(old_summary, use_cache=use_cache),
+                      deps=["old_summary"], label="Extracting old entity relationships"),
+            ]
+
+        def summarize_new(new_text, old_summary, section_diff):
+            if section_diff is None:
+                return get_summary_with_context(new_text, context=old_summary, use_cache=use_cache)
+            if not section_diff.has_changes:
+                return old_summary
+            return get_incremental_summary(section_diff.changes_text(), old_summary, use_cache=use_cache)
+
+        def extract_new_json(new_summary, old_json, section_diff):
+            if section_diff is None:
+                return get_entity_relationship_with_context(new_summary, context=old_json, use_cache=use_cache)
+            if not section_diff.has_changes:
+                return old_json
+            return get_entity_relationship_with_context(
+                new_summary, context=old_json, use_cache=use_cache, changed_sections=section_diff.changed_headings()
+            )
+
+        # The old chain only feeds the new one through the context hand-off, so
+        # both extractions run together and old_json overlaps with new_summary.
+        stages = old_stages + [
+            Stage("old_text", lambda: extract_text_from_pdf(old_path, page_range=page_range, file_hash=old_hash), label="Extracting old text"),
+            Stage("new_text", lambda: extract_text_from_pdf(new_path, page_range=page_range, file_hash=new_hash), label="Extracting new text"),
+            Stage("section_diff", lambda old_text, new_text: _incremental_diff(old_text, new_text),
+                  deps=["old_text", "new_text"], label="Comparing sections"),
+            Stage("new_summary", summarize_new,
+                  deps=["new_text", "old_summary", "section_diff"], label="Summarizing new regulation"),
+            Stage("new_json", extract_new_json,
+                  deps=["new_summary", "old_json", "section_diff"], label="Extracting new entity relationships"),
+        ]
+
+    def on_stage_done(stage, done, total):
+        report(5 + 85 * done // total, f"Finished: {stage.label}")
+
+    report(5, "Extracting text")
+    results, timings = run_stages(stages, max_workers=app.config['PIPELINE_WORKERS'], on_stage_done=on_stage_done)
+    timing = timing_summary(timings)
+    app.logger.info("Upload %s: stages took %.2fs wall clock (%.2fs serial): %s",
+                    upload_id, timing["wall"], timing["serial"], timing["stages"])
+
+    old_summary = results.get("old_summary")
+    old_json = results.get("old_json")
+    new_summary = results["new_summary"]
+    new_json = results["new_json"]
+    old_data = json.loads(old_json) if old_json else None
+    new_data = json.loads(new_json)
+    if old_data and new_json != old_json:
+        # Entity IDs are assigned afresh by every extraction; carry the old IDs over to matching entities
+        with tracing.span("align_entities") as span:
+            matches = align_entities(old_data, new_data)
+            new_data = remap_entity_ids(new_data, matches, old_data)
+            span.set(matched=len(matches), entities=len(new_data.get("entities", [])))
+        app.logger.info("Upload %s: matched %d of %d new entities to the previous version",
+                        upload_id, len(matches), len(new_data.get("entities", [])))
+    diff_stats = None
+    if results.get("section_diff"):
+        diff_stats = json.dumps(results["section_diff"].stats())
+        app.logger.info("Upload %s: incremental diff %s", upload_id, diff_stats)
+
+    report(90, "Laying out graphs")
+    with tracing.span("graph_build") as span:
+        graph_new = RelationGraph(new_data)
+        graph_old = RelationGraph(old_data) if old_data else None
+        # NetworkX only for the layout; storage and rendering work on the columns
+        positions_old, positions_new = layout_graphs(graph_old.to_networkx() if graph_old else None, graph_new.to_networkx())
+        span.set(nodes=graph_new.node_count, edges=graph_new.edge_count)
+
+    with tracing.span("graph_diff"):
+        graph_diff_json = json.dumps(diff_relationships(old_data, new_data)) if old_data else None
+
+    report(95, "Saving results")
+    with tracing.span("serialize") as span:
+        graph = EntityGraph(
+            upload_id=upload.id,
+            old_packed=pack_graph(graph_old, positions_old) if graph_old else None,
+            new_packed=pack_graph(graph_new, positions_new),
+            node_count=graph_new.node_count,
+            edge_count=graph_new.edge_count,
+            diff_json=graph_diff_json
+        )
+        span.set(bytes=len(graph.new_packed) + len(graph.old_packed or b""))
+    with tracing.span("obligation_index") as span:
+        obligations = obligation_rows(upload.id, regulation_id, "old", old_data) + obligation_rows(upload.id, regulation_id, "new", new_data)
+        span.set(rows=len(obligations))
+    with tracing.span("commit"):
+        _replace_results(upload.id, Summary(upload_id=upload.id, old_summary=old_summary, new_summary=new_summary, diff_stats=diff_stats), graph, obligations)
+    with tracing.span("timeline") as span:
+        # The upload's results are already saved; a timeline that fails to update is caught up by the next one
+        try:
+            span.set(versions=update_timeline(regulation_id, upload.id))
+        except Exception:
+            db.session.rollback()
+            app.logger.exception("Upload %s: could not update the timeline of regulation %s", upload.id, regulation_id)
+
+
+def _incremental_diff(old_text, new_text):
+    """Section diff for the incremental path, or None when a full re-summarization is the better deal."""
+    if not app.config['INCREMENTAL_DIFF']:
+        return None
+    section_diff = diff_sections(old_text, new_text)
+    stats = section_diff.stats()
+    if stats["sections"] < 2 or stats["tokens_skipped"] < app.config['INCREMENTAL_MIN_SKIP'] * stats["tokens_total"]:
+        return None
+    return section_diff
+
+
+def find_previous_version(upload):
+    """Finds the latest processed upload of the same regulation whose new PDF is this upload's old PDF.
+
+    Returns ``(upload, summary, graph)`` or None.
+    """
+    return (
+        db.session.query(Upload, Summary, EntityGraph)
+        .join(Summary, Summary.upload_id == Upload.id)
+        .join(EntityGraph, EntityGraph.upload_id == Upload.id)
+        .filter(
+            Upload.regulation_id == upload.regulation_id,
+            Upload.id != upload.id,
+            Upload.new_hash == upload.old_hash,
+            Upload.page_range.is_(None),
+            Summary.new_summary.isnot(None),
+            db.or_(EntityGraph.new_packed.isnot(None), EntityGraph.new_json.isnot(None))
+        )
+        .order_by(Upload.upload_time.desc(), Upload.id.desc())
+        .first()
+    )
 
-        G_new = parse_graph_data(json.loads(new_json))
-        graph_new_json = json.dumps({
-            "nodes": [{"id": n, **G_new.nodes[n]} for n in G_new.nodes],
-            "edges": [{"from": u, "to": v, **G_new[u][v]} for u, v in G_new.edges]
-        })
 
-        db.session.add(Summary(upload_id=upload.id, old_summary=None, new_summary=new_summary))
-        db.session.add(EntityGraph(
-            upload_id=upload.id,
-            old_json=None,
-            new_json=new_json,
-            graph_old=None,
-            graph_new=graph_new_json
-        ))
-    else:
-        old_text = extract_text_from_pdf(upload.old_path)
-        new_text = extract_text_from_pdf(upload.new_path)
+def _replace_results(upload_id, summary, graph, obligations):
+    # Swap results in one short transaction so the previous ones stay readable
+    # (and SQLite stays unlocked) for the whole time the LLM calls run.
+    previous_version = db.session.query(db.func.max(EntityGraph.version)).filter_by(upload_id=upload_id).scalar()
+    graph.version = (previous_version or 0) + 1
+    db.session.query(Summary).filter_by(upload_id=upload_id).delete()
+    db.session.query(EntityGraph).filter_by(upload_id=upload_id).delete()
+    db.session.add(summary)
+    db.session.add(graph)
+    replace_obligations(upload_id, obligations)
+    bump_counter(HISTORY_COUNTER)
+    db.session.commit()
+    payload_cache.invalidate(upload_id)
 
-        old_summary = get_summary_with_context(old_text)
-        new_summary = get_summary_with_context(new_text, context=old_summary)
 
-        old_json = get_entity_relationship_with_context(old_summary)
-        new_json = get_entity_relationship_with_context(new_summary, context=old_json)
+@job_queue.handler("process")
+def process_upload_job(upload_id, report):
+    process_upload(upload_id, progress=report)
 
-        G_old = parse_graph_data(json.loads(old_json))
-        G_new = parse_graph_data(json.loads(new_json))
 
-        graph_old_json = json.dumps({
-            "nodes": [{"id": n, **G_old.nodes[n]} for n in G_old.nodes],
-            "edges": [{"from": u, "to": v, **G_old[u][v]} for u, v in G_old.edges]
-        })
+@job_queue.handler("regenerate")
+def regenerate_upload_job(upload_id, report):
+    # The analyst asked for a fresh answer, so skip cached LLM responses
+    process_upload(upload_id, progress=report, use_cache=False)
 
-        graph_new_json = json.dumps({
-            "nodes": [{"id": n, **G_new.nodes[n]} for n in G_new.nodes],
-            "edges": [{"from": u, "to": v, **G_new[u][v]} for u, v in G_new.edges]
-        })
 
-        db.session.add(Summary(upload_id=upload.id, old_summary=old_summary, new_summary=new_summary))
-        db.session.add(EntityGraph(
-            upload_id=upload.id,
-            old_json=old_json,
-            new_json=new_json,
-            graph_old=graph_old_json,
-            graph_new=graph_new_json
-        ))
+DOCX_MIMETYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+
+def kop_input_hash(new_summary, new_json):
+    """Identifies what a KOP is generated from, so an unchanged upload can reuse its stored document."""
+    digest = hashlib.sha256()
+    for part in (os.getenv("GEMINI_MODEL") or "", PROMPT_VERSION, new_summary, new_json):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
 
+
+def new_kop_document():
+    doc = Document()
+    doc.add_heading("Key Operating Procedure (KOP)", 0)
+    return doc
+
+
+def store_kop(upload_id, new_summary, new_json, graph_version, markdown, doc, use_cache, job_id=None):
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    data = buffer.getvalue()
+    document = KopDocument(
+        upload_id=upload_id,
+        job_id=job_id,
+        content_hash=hashlib.sha256(data).hexdigest(),
+        input_hash=kop_input_hash(new_summary, new_json),
+        parameters=json.dumps({
+            "model": os.getenv("GEMINI_MODEL"),
+            "prompt_version": PROMPT_VERSION,
+            "graph_version": graph_version,
+            "use_cache": use_cache
+        }),
+        markdown=markdown,
+        docx=data,
+        size=len(data)
+    )
+    db.session.add(document)
+    bump_counter(HISTORY_COUNTER)
     db.session.commit()
+    return document
+
+
+def generate_kop(upload_id, report, kind, use_cache=True):
+    summary = Summary.query.filter_by(upload_id=upload_id).first()
+    graph = EntityGraph.query.filter_by(upload_id=upload_id).first()
+    new_json = stored_relationships(graph, "new")
+
+    report(10, "Generating KOP")
+    kop_text = get_kop_doc(new_summary=summary.new_summary, new_json_str=new_json, use_cache=use_cache)
+
+    report(80, "Building Word document")
+    with tracing.span("docx"):
+        doc = new_kop_document()
+        markdown_to_docx(doc, kop_text)
+
+    # Submit dedupes per kind, so the running job of this kind is the one executing us
+    job = job_queue.active_job(upload_id, kind)
+    with tracing.span("commit"):
+        store_kop(upload_id, summary.new_summary, new_json, graph.version, kop_text, doc, use_cache, job_id=job.id if job else None)
+
+
+@job_queue.handler("approve")
+def generate_kop_job(upload_id, report):
+    generate_kop(upload_id, report, "approve")
+
+
+@job_queue.handler("regenerate_kop")
+def regenerate_kop_job(upload_id, report):
+    # An explicit request for a new version, so do not replay the cached LLM answer
+    generate_kop(upload_id, report, "regenerate_kop", use_cache=False)
+
+
+def kop_to_dict(document):
+    return {
+        "id": document.id,
+        "upload_id": document.upload_id,
+        "content_hash": document.content_hash,
+        "parameters": json.loads(document.parameters or "{}"),
+        "size": document.size,
+        "created_at": document.created_at.isoformat() if document.created_at else None,
+        "download_url": url_for("kop_document", document_id=document.id),
+    }
+
+
+def send_kop(document):
+    return send_file(
+        io.BytesIO(document.docx),
+        as_attachment=True,
+        download_name=f"kop_upload_{document.upload_id}.docx",
+        mimetype=DOCX_MIMETYPE,
+        etag=document.content_hash,
+        last_modified=document.created_at
+    )
 
 
 @app.route("/compare/<int:upload_id>")
 def compare(upload_id):
-    return render_template("compare.html", upload_id=upload_id)
+    job = job_queue.latest_job(upload_id, "process", "regenerate")
+    return render_template("compare.html", upload_id=upload_id, job=job_to_dict(job) if job else None)
+
+
+@app.route("/jobs/<int:job_id>")
+def job_status(job_id):
+    job = db.get_or_404(Job, job_id)
+    return jsonify(job_to_dict(job))
+
+
+@app.route("/jobs/<int:job_id>/result")
+def job_result(job_id):
+    job = db.get_or_404(Job, job_id)
+    document = KopDocument.query.filter_by(job_id=job_id).first() if job.status == "done" else None
+    if document:
+        return send_kop(document)
+    if job.status != "done" or not job.result_path:
+        return "Result not available", 404
+    # KOP files written to disk before documents were stored in the database
+    return send_file(
+        os.path.abspath(job.result_path),
+        as_attachment=True,
+        download_name=f"kop_upload_{job.upload_id}.docx",
+        mimetype=DOCX_MIMETYPE
+    )
+
+
+@app.route("/kop/<int:upload_id>")
+def kop_download(upload_id):
+    """Latest stored KOP of an upload; never triggers generation."""
+    document = KopDocument.query.filter_by(upload_id=upload_id).order_by(KopDocument.id.desc()).first()
+    if not document:
+        return "No KOP has been generated for this upload", 404
+    return send_kop(document)
+
+
+@app.route("/kop/document/<int:document_id>")
+def kop_document(document_id):
+    return send_kop(db.get_or_404(KopDocument, document_id))
+
+
+@app.route("/kop/<int:upload_id>/versions")
+def kop_versions(upload_id):
+    documents = (
+        KopDocument.query.options(db.defer(KopDocument.docx))
+        .filter_by(upload_id=upload_id)
+        .order_by(KopDocument.id.desc())
+        .all()
+    )
+    return jsonify([kop_to_dict(document) for document in documents])
+
+
+def _graph_stamp(upload_id, *criteria):
+    """(version, updated_at) of an upload's EntityGraph without loading its payload columns."""
+    return (
+        db.session.query(EntityGraph.version, EntityGraph.updated_at)
+        .filter(EntityGraph.upload_id == upload_id, *criteria)
+        .first()
+    )
 
 
 @app.route("/graph_data/<int:upload_id>/<version>")
 def graph_data(upload_id, version):
-    graph_entry = EntityGraph.query.filter_by(upload_id=upload_id).first()
-    if not graph_entry:
+    if version not in ("old", "new"):
+        return jsonify({"error": "Invalid version"}), 400
+    stamp = _graph_stamp(upload_id)
+    if not stamp:
         return jsonify({"nodes": [], "edges": []})
-    if version == "old":
-        return jsonify(json.loads(graph_entry.graph_old or '{}'))
-    if version == "new":
-        return jsonify(json.loads(graph_entry.graph_new or '{}'))
-    return jsonify({"error": "Invalid version"}), 400
+
+    def build():
+        graph_entry = EntityGraph.query.filter_by(upload_id=upload_id).first()
+        return b"".join(iter_stored_vis_json(graph_entry, version))
+
+    return cached_response(
+        (upload_id, f"graph_{version}", stamp.version),
+        f"graph-{upload_id}-{version}-v{stamp.version}",
+        stamp.updated_at,
+        build
+    )
+
+
+@app.route("/diff/<int:upload_id>")
+def graph_diff(upload_id):
+    stamp = _graph_stamp(upload_id, db.or_(EntityGraph.old_packed.isnot(None), EntityGraph.old_json.isnot(None)))
+    if not stamp:
+        return jsonify({"error": "No comparison available for this upload"}), 404
+
+    def build():
+        graph_entry = EntityGraph.query.filter_by(upload_id=upload_id).first()
+        if not graph_entry.diff_json:
+            # Uploads processed before diffs were stored
+            graph_entry.diff_json = json.dumps(diff_relationships(
+                stored_relationships(graph_entry, "old"), stored_relationships(graph_entry, "new")
+            ))
+            db.session.commit()
+        return graph_entry.diff_json
+
+    return cached_response((upload_id, "diff", stamp.version), f"diff-{upload_id}-v{stamp.version}", stamp.updated_at, build)
 
 
 @app.route("/regenerate/<int:upload_id>", methods=["POST"])
 def regenerate(upload_id):
-    process_upload(upload_id)
-    return redirect(url_for("compare", upload_id=upload_id))
+    db.get_or_404(Upload, upload_id)
+    payload_cache.invalidate(upload_id)
+    job = job_queue.active_job(upload_id, "process", "regenerate") or job_queue.submit("regenerate", upload_id)
+    return jsonify(job_to_dict(job)), 202
 
 
-@app.route("/approve/<int:upload_id>", methods=["POST"])
-def approve(upload_id):
+def _kop_sources(upload_id):
+    """(summary, graph, error response) for KOP generation; the error is None when both are usable."""
     summary = Summary.query.filter_by(upload_id=upload_id).first()
     graph = EntityGraph.query.filter_by(upload_id=upload_id).first()
     if not summary or not graph:
-        return "Data not found", 404
+        return summary, graph, ("Data not found", 404)
+    if not summary.new_summary or not (graph.new_packed or graph.new_json):
+        return summary, graph, ("New data missing. Please upload new regulation first.", 400)
+    return summary, graph, None
+
+
+def _stored_kop(upload_id, input_hash):
+    """Latest stored KOP generated from exactly these inputs, without its docx bytes."""
+    return (
+        KopDocument.query.options(db.defer(KopDocument.docx))
+        .filter_by(upload_id=upload_id, input_hash=input_hash)
+        .order_by(KopDocument.id.desc())
+        .first()
+    )
 
-    if not summary.new_summary or not graph.new_json:
-        return "New data missing. Please upload new regulation first.", 400
 
-    kop_text = get_kop_doc(new_summary=summary.new_summary, new_json_str=graph.new_json)
-    doc = Document()
-    doc.add_heading("Key Operating Procedure (KOP)", 0)
-    markdown_to_docx(doc, kop_text)
+@app.route("/approve/<int:upload_id>", methods=["POST"])
+def approve(upload_id):
+    summary, graph, error = _kop_sources(upload_id)
+    if error:
+        return error
+
+    if request.args.get("regenerate") == "1":
+        job = job_queue.submit("regenerate_kop", upload_id)
+        return jsonify(job_to_dict(job)), 202
+
+    # Hand back the stored document while its summary and graph are unchanged
+    document = _stored_kop(upload_id, kop_input_hash(summary.new_summary, stored_relationships(graph, "new")))
+    if document:
+        return jsonify({"document": kop_to_dict(document)}), 200
+
+    job = job_queue.submit("approve", upload_id)
+    return jsonify(job_to_dict(job)), 202
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.route("/approve/<int:upload_id>/stream", methods=["POST"])
+def approve_stream(upload_id):
+    """KOP generation as server-sent events.
+
+    ``chunk`` events carry markdown as the model streams it; the Word document
+    is built line by line alongside, so the final ``done`` event (with the
+    stored document) follows the last chunk immediately. Failures end the
+    stream with an ``error`` event. Takes the same ``regenerate=1`` flag as
+    /approve.
+    """
+    summary, graph, error = _kop_sources(upload_id)
+    if error:
+        return error
+    new_summary, new_json, graph_version = summary.new_summary, stored_relationships(graph, "new"), graph.version
+    regenerate = request.args.get("regenerate") == "1"
+    stored = None if regenerate else _stored_kop(upload_id, kop_input_hash(new_summary, new_json))
+
+    def events():
+        if stored:
+            if stored.markdown:
+                yield _sse("chunk", {"text": stored.markdown})
+            yield _sse("done", {"document": kop_to_dict(stored)})
+            return
+        doc = new_kop_document()
+        writer = MarkdownDocxWriter(doc)
+        parts = []
+        docx_seconds = 0.0
+        try:
+            with tracing.trace(upload_id, "kop_stream"):
+                for text in stream_kop_doc(new_summary, new_json, use_cache=not regenerate):
+                    parts.append(text)
+                    started = time.perf_counter()
+                    writer.feed(text)
+                    docx_seconds += time.perf_counter() - started
+                    yield _sse("chunk", {"text": text})
+                with tracing.span("docx") as span:
+                    writer.close()
+                    # Most of the document was built while the model was still writing
+                    span.set(incremental_seconds=round(docx_seconds, 6))
+                with tracing.span("commit"):
+                    document = store_kop(upload_id, new_summary, new_json, graph_version, "".join(parts), doc, not regenerate)
+            yield _sse("done", {"document": kop_to_dict(document)})
+        except Exception as e:
+            db.session.rollback()
+            app.logger.exception("Streaming KOP generation for upload %s failed", upload_id)
+            yield _sse("error", {"error": str(e)})
+
+    return app.response_class(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        # Let reverse proxies pass events through as they are produced
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
-    buffer = BytesIO()
-    doc.save(buffer)
-    buffer.seek(0)
 
-    return send_file(
-        buffer,
-        as_attachment=True,
-        download_name=f"kop_upload_{upload_id}.docx",
-        mimetype="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+@app.route("/llm_cache/stats")
+def llm_cache_stats():
+    return jsonify(llm_cache.stats())
+
+
+@app.route("/llm/metrics")
+def llm_metrics():
+    return jsonify(get_call_metrics())
+
+
+@app.route("/metrics")
+def prometheus_metrics():
+    """Span durations, LLM tokens, calls and cache use, and job counts in Prometheus text format."""
+    calls = get_call_metrics()
+    cache = llm_cache.stats()
+    jobs = db.session.query(Job.kind, Job.status, db.func.count(Job.id)).group_by(Job.kind, Job.status).all()
+    families = tracing.metrics.families() + [
+        ("llm_calls_total", "counter", "LLM calls by kind and outcome, excluding cache hits.",
+         [("", {"kind": kind, "counter": name}, value)
+          for kind, counters in sorted(calls.items()) for name, value in counters.items()]),
+        ("llm_cache_requests_total", "counter", "LLM cache lookups by kind and result.",
+         [("", {"kind": kind, "result": result}, count)
+          for result in ("hits", "misses") for kind, count in sorted(cache[result].items())]),
+        ("llm_cache_entries", "gauge", "Responses stored in the LLM cache.", [("", {}, cache["entries"])]),
+        ("jobs", "gauge", "Jobs by kind and status.",
+         [("", {"kind": kind, "status": status}, count) for kind, status, count in jobs]),
+    ]
+    return app.response_class(tracing.prometheus_text(families), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/trace/<int:upload_id>")
+def upload_trace(upload_id):
+    """The latest traces of an upload, newest first, for the compare page timeline."""
+    limit = min(request.args.get("limit", 5, type=int), 50)
+    return jsonify({"upload_id": upload_id, "traces": tracing.upload_traces(upload_id, limit)})
+
+
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+
+
+def _parse_history_filters(args):
+    """Validated /history query arguments; raises ValueError on malformed input."""
+    filters = {
+        "regulation": args.get("regulation", type=int),
+        "date_from": None,
+        "date_to": None,
+        "before": None,
+        "limit": min(max(args.get("limit", HISTORY_PAGE_SIZE, type=int), 1), HISTORY_MAX_PAGE_SIZE),
+    }
+    if args.get("date_from"):
+        filters["date_from"] = datetime.strptime(args["date_from"], "%Y-%m-%d")
+    if args.get("date_to"):
+        filters["date_to"] = datetime.strptime(args["date_to"], "%Y-%m-%d") + timedelta(days=1)
+    if args.get("before"):
+        # Keyset cursor: upload_time and id of the last row of the previous page
+        cursor_time, _, cursor_id = args["before"].rpartition("_")
+        filters["before"] = (datetime.fromisoformat(cursor_time), int(cursor_id))
+    return filters
+
+
+def history_rows(regulation=None, date_from=None, date_to=None, before=None, limit=HISTORY_PAGE_SIZE):
+    """One page of uploads, newest first, with regulation name, processing status, graph size and KOP state.
+
+    Everything comes from a single query: the latest processing job and the
+    KOP flag are correlated subqueries served by the jobs and kop_documents
+    indexes, so rows cost no extra lookups. Returns ``(rows, next_cursor)``.
+    """
+    status = (
+        db.select(Job.status)
+        .where(Job.upload_id == Upload.id, Job.kind.in_(("process", "regenerate")))
+        .order_by(Job.id.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+    kop_generated = db.exists().where(KopDocument.upload_id == Upload.id)
+    query = (
+        db.session.query(
+            Upload.id,
+            Upload.old_path,
+            Upload.new_path,
+            Upload.upload_time,
+            Regulation.name.label("regulation"),
+            status.label("status"),
+            EntityGraph.id.isnot(None).label("processed"),
+            EntityGraph.node_count,
+            EntityGraph.edge_count,
+            kop_generated.label("kop_generated"),
+        )
+        .join(Regulation, Regulation.id == Upload.regulation_id)
+        .outerjoin(EntityGraph, EntityGraph.upload_id == Upload.id)
     )
+    if regulation:
+        query = query.filter(Upload.regulation_id == regulation)
+    if date_from:
+        query = query.filter(Upload.upload_time >= date_from)
+    if date_to:
+        query = query.filter(Upload.upload_time < date_to)
+    if before:
+        before_time, before_id = before
+        query = query.filter(db.or_(
+            Upload.upload_time < before_time,
+            db.and_(Upload.upload_time == before_time, Upload.id < before_id)
+        ))
+
+    rows = query.order_by(Upload.upload_time.desc(), Upload.id.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = f"{rows[-1].upload_time.isoformat()}_{rows[-1].id}"
+    return rows, next_cursor
 
 
 @app.route("/history")
 def history():
-    uploads = Upload.query.order_by(Upload.upload_time.desc()).all()
-    return render_template("history.html", uploads=uploads)
+    try:
+        filters = _parse_history_filters(request.args)
+    except ValueError as e:
+        return f"Invalid filter: {e}", 400
+
+    # Bumped whenever an upload is added, a job changes status, or results or a KOP are stored
+    stamp = counter_value(HISTORY_COUNTER)
+
+    def build():
+        rows, next_cursor = history_rows(**filters)
+        return render_template(
+            "history.html",
+            uploads=rows,
+            regulations=Regulation.query.order_by(Regulation.name).all(),
+            filters=request.args,
+            next_cursor=next_cursor
+        )
+
+    key = ("history", request.query_string.decode(), stamp)
+    return cached_response(key, f"history-{stamp}", None, build, mimetype="text/html")
+
+
+def _parse_obligation_filters(args):
+    """Validated obligation search arguments; raises ValueError on malformed input.
+
+    ``regulation`` may be repeated or comma-separated and takes names or IDs.
+    """
+    requested = [value.strip() for values in args.getlist("regulation") for value in values.split(",") if value.strip()]
+    regulation_ids = None
+    if requested:
+        regulations = Regulation.query.all()
+        by_key = {regulation.name.lower(): regulation.id for regulation in regulations}
+        by_key.update({str(regulation.id): regulation.id for regulation in regulations})
+        unknown = [value for value in requested if value.lower() not in by_key]
+        if unknown:
+            raise ValueError(f"unknown regulations {unknown}")
+        regulation_ids = sorted({by_key[value.lower()] for value in requested})
+
+    def amount(name):
+        value = args.get(name, "").replace(",", "").strip()
+        return float(value) if value else None
+
+    period = args.get("period") or None
+    if period and period not in PERIOD_NAMES:
+        raise ValueError(f"period must be one of {', '.join(PERIOD_NAMES)}")
+    side = args.get("side") or None
+    if side and side not in ("old", "new"):
+        raise ValueError("side must be old or new")
+    return {
+        "q": args.get("q", "").strip() or None,
+        "regulation_ids": regulation_ids,
+        "period": period,
+        "min_amount": amount("min_amount"),
+        "max_amount": amount("max_amount"),
+        "currency": args.get("currency", "").strip() or None,
+        "side": side,
+        "latest": args.get("latest") in ("1", "true", "on"),
+        "before": args.get("before", type=int),
+        "limit": min(max(args.get("limit", SEARCH_PAGE_SIZE, type=int), 1), SEARCH_MAX_PAGE_SIZE),
+    }
+
+
+@app.route("/obligations/search")
+def obligation_search():
+    try:
+        filters = _parse_obligation_filters(request.args)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid filter: {e}"}), 400
+    started = time.perf_counter()
+    rows, next_cursor = search_obligations(**filters)
+    return jsonify({
+        "results": [obligation_to_dict(row) for row in rows],
+        "next_cursor": next_cursor,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 2),
+    })
+
+
+@app.route("/obligations")
+def obligations():
+    try:
+        filters = _parse_obligation_filters(request.args)
+    except ValueError as e:
+        return f"Invalid filter: {e}", 400
+    searched = any(request.args.get(name) for name in ("q", "regulation", "period", "min_amount", "max_amount", "currency", "side", "latest"))
+    started = time.perf_counter()
+    rows, next_cursor = search_obligations(**filters) if searched else ([], None)
+    return render_template(
+        "obligations.html",
+        results=[obligation_to_dict(row) for row in rows],
+        regulations=Regulation.query.order_by(Regulation.name).all(),
+        selected_regulations=filters["regulation_ids"] or [],
+        periods=PERIOD_NAMES,
+        filters=request.args,
+        searched=searched,
+        elapsed_ms=(time.perf_counter() - started) * 1000,
+        next_cursor=next_cursor
+    )
+
+
+@app.route("/timeline/<int:regulation_id>")
+def timeline(regulation_id):
+    """The stored versions of a regulation, oldest first, with what changed in each."""
+    regulation = db.get_or_404(Regulation, regulation_id)
+    rows = (
+        db.session.query(GraphVersion, Upload)
+        .join(Upload, Upload.id == GraphVersion.upload_id)
+        .filter(GraphVersion.regulation_id == regulation_id)
+        .order_by(GraphVersion.sequence)
+        .all()
+    )
+    return jsonify({
+        "regulation_id": regulation.id,
+        "regulation": regulation.name,
+        "versions": [version_to_dict(version, upload) for version, upload in rows],
+    })
+
+
+@app.route("/timeline/<int:regulation_id>/version/<int:sequence>")
+def timeline_version(regulation_id, sequence):
+    rebuilt = rebuild_version(regulation_id, sequence)
+    if rebuilt is None:
+        return jsonify({"error": "No such version"}), 404
+    version, data = rebuilt
+    return jsonify({"version": version_to_dict(version), "graph": data})
+
+
+@app.route("/timeline/<int:regulation_id>/diff")
+def timeline_diff(regulation_id):
+    """Relationship diff between versions ``from`` and ``to`` (sequence numbers), no LLM calls involved."""
+    from_sequence = request.args.get("from", type=int)
+    to_sequence = request.args.get("to", type=int)
+    if from_sequence is None or to_sequence is None:
+        return jsonify({"error": "from and to version sequences are required"}), 400
+    diff = diff_versions(regulation_id, from_sequence, to_sequence)
+    if diff is None:
+        return jsonify({"error": "No such version"}), 404
+    return jsonify({"from": from_sequence, "to": to_sequence, "diff": diff})
+
+
+@app.route("/timeline/<int:regulation_id>/edge")
+def timeline_edge(regulation_id):
+    """How the relationships between two entities (IDs or names) changed across every version."""
+    subject, obj = request.args.get("subject", "").strip(), request.args.get("object", "").strip()
+    if not subject or not obj:
+        return jsonify({"error": "subject and object are required"}), 400
+    verb = request.args.get("verb") or None
+    return jsonify({
+        "regulation_id": regulation_id,
+        "subject": subject,
+        "object": obj,
+        "verb": verb,
+        "history": edge_history(regulation_id, subject, obj, verb),
+    })
+
+
+def init_db():
+    db.create_all()
+    upgrade_schema()
+    ensure_fts()
+
+    # Insert default regulations only if not already present
+    if not Regulation.query.first():
+        db.session.add_all([
+            Regulation(name="EMIR Refit"),
+            Regulation(name="MiFID II"),
+            Regulation(name="SFTR"),
+            Regulation(name="AWPR")
+        ])
+        bump_counter(HISTORY_COUNTER)
+        db.session.commit()
+
+
+@app.cli.command("batch")
+@click.argument("manifest", type=click.Path(exists=True, dir_okay=False))
+@click.option("--concurrency", "-c", default=2, show_default=True, help="Uploads processed at the same time.")
+@click.option("--no-cache", is_flag=True, help="Skip cached LLM responses, as Regenerate does.")
+@click.option("--force", is_flag=True, help="Reprocess uploads that already have results.")
+@click.option("--json", "as_json", is_flag=True, help="Print the summary as JSON.")
+def batch_command(manifest, concurrency, no_cache, force, as_json):
+    """Processes every (regulation, old_path, new_path) upload listed in MANIFEST.
+
+    MANIFEST is a CSV file with a regulation,old_path,new_path[,page_range]
+    header or a JSON list of objects with those keys. Rerunning a manifest
+    skips uploads that already finished, so an interrupted batch resumes.
+    """
+    init_db()
+    try:
+        entries = load_manifest(manifest)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+    calls_before, cache_before = get_call_metrics(), llm_cache.stats()
+    try:
+        wall = run_batch(app, job_queue.handlers, entries, concurrency=concurrency,
+                         kind="regenerate" if no_cache else "process", force=force,
+                         echo=lambda line: click.echo(line, err=as_json))
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    calls_after, cache_after = get_call_metrics(), llm_cache.stats()
+
+    summary = batch_summary(entries, wall)
+    summary["llm_calls"] = {
+        kind: {name: value - calls_before.get(kind, {}).get(name, 0) for name, value in counters.items()}
+        for kind, counters in calls_after.items()
+    }
+    summary["llm_cache"] = {
+        name: sum(cache_after[name].values()) - sum(cache_before[name].values()) for name in ("hits", "misses")
+    }
+    click.echo(json.dumps(summary, indent=2) if as_json else format_summary(summary))
+    if summary["failed"]:
+        raise SystemExit(1)
+
+
+@app.cli.command("reindex-obligations")
+def reindex_obligations_command():
+    """Rebuilds the obligation search index from every stored graph, e.g. for uploads processed before it existed."""
+    init_db()
+    count = 0
+    for graph_entry in EntityGraph.query.order_by(EntityGraph.upload_id).all():
+        upload = db.session.get(Upload, graph_entry.upload_id)
+        rows = []
+        for side in ("old", "new"):
+            relationships = stored_relationships(graph_entry, side)
+            rows += obligation_rows(upload.id, upload.regulation_id, side, json.loads(relationships) if relationships else None)
+        replace_obligations(upload.id, rows)
+        db.session.commit()
+        count += len(rows)
+    click.echo(f"Indexed {count} obligations")
+
+
+@app.cli.command("rebuild-timelines")
+@click.option("--regulation", "regulation_ids", type=int, multiple=True, help="Only this regulation ID; repeatable.")
+def rebuild_timelines_command(regulation_ids):
+    """Rebuilds regulation version timelines from the stored graphs, e.g. for uploads processed before they existed."""
+    init_db()
+    for regulation_id in regulation_ids or [regulation.id for regulation in Regulation.query.order_by(Regulation.id)]:
+        db.session.query(GraphVersion).filter_by(regulation_id=regulation_id).delete()
+        db.session.commit()
+        click.echo(f"Regulation {regulation_id}: {update_timeline(regulation_id)} versions")
 
 
 if __name__ == "__main__":
     with app.app_context():
-        db.create_all()
-
-        # Insert default regulations only if not already present
-        if not Regulation.query.first():
-            db.session.add_all([
-                Regulation(name="EMIR Refit"),
-                Regulation(name="MiFID II"),
-                Regulation(name="SFTR"),
-                Regulation(name="AWPR")
-            ])
-            db.session.commit()
+        init_db()
 
+    # Jobs a crashed or restarted process left behind are recovered when the queue is first used
     app.run(debug=True)
@@ -0,0 +1,270 @@
+import os
+import csv
+import json
+import time
+from db_models import db, Regulation, Upload, EntityGraph, HISTORY_COUNTER, bump_counter
+from jobs import JobQueue
+from utils import file_sha256, parse_page_range
+
+MANIFEST_FIELDS = ("regulation", "old_path", "new_path", "page_range")
+BATCH_POLL_INTERVAL = 0.25
+
+
+class BatchEntry:
+    """One manifest row and what happened to it."""
+
+    def __init__(self, number, regulation, old_path, new_path, page_range=None):
+        self.number = number
+        self.regulation = regulation
+        self.old_path = old_path
+        self.new_path = new_path
+        self.page_range = page_range
+        self.regulation_id = None
+        self.upload_id = None
+        # An earlier entry of the same regulation whose new PDF is this entry's old one
+        self.depends_on = None
+        # The number of an earlier entry with the same upload; this one is not run
+        self.duplicate_of = None
+        self.resumed = False
+        self.status = None
+        self.error = None
+        self.duration = None
+        self.queue_wait = None
+
+    def ready(self):
+        return self.depends_on is None or self.depends_on.status is not None
+
+    def finish(self, job):
+        self.status = job.status
+        self.error = job.error
+        if job.started_at and job.finished_at:
+            self.duration = (job.finished_at - job.started_at).total_seconds()
+            self.queue_wait = (job.started_at - job.created_at).total_seconds()
+
+
+def load_manifest(path):
+    """Reads a batch manifest: a CSV file with a header row, or a JSON list of objects.
+
+    Each row has ``regulation`` (name or ID), ``new_path`` and optionally
+    ``old_path`` and ``page_range``. Relative paths are resolved against the
+    manifest's directory. Every row is checked before anything runs; all
+    problems are reported together as one ValueError.
+    """
+    base = os.path.dirname(os.path.abspath(path))
+    if path.lower().endswith(".json"):
+        with open(path, encoding="utf-8") as f:
+            rows = json.load(f)
+    else:
+        with open(path, newline="", encoding="utf-8") as f:
+            rows = list(csv.DictReader(f))
+
+    def resolve(value):
+        value = (value or "").strip()
+        return os.path.normpath(os.path.join(base, value)) if value else None
+
+    entries, errors = [], []
+    for number, row in enumerate(rows, 1):
+        unknown = set(row) - set(MANIFEST_FIELDS)
+        if unknown:
+            errors.append(f"Entry {number}: unknown fields {sorted(unknown)}")
+        regulation = str(row.get("regulation") or "").strip()
+        old_path, new_path = resolve(row.get("old_path")), resolve(row.get("new_path"))
+        page_range = (row.get("page_range") or "").strip() or None
+        if not regulation:
+            errors.append(f"Entry {number}: regulation is missing")
+        if not new_path or not os.path.exists(new_path):
+            errors.append(f"Entry {number}: new PDF path {new_path!r} is invalid")
+        if old_path and not os.path.exists(old_path):
+            errors.append(f"Entry {number}: old PDF path {old_path!r} is invalid")
+        if page_range:
+            try:
+                parse_page_range(page_range, 1)
+            except ValueError as e:
+                errors.append(f"Entry {number}: {e}")
+        entries.append(BatchEntry(number, regulation, old_path, new_path, page_range))
+    if errors:
+        raise ValueError("\n".join(errors))
+    if not entries:
+        raise ValueError("The manifest lists no uploads")
+    return entries
+
+
+def _resolve_regulations(entries):
+    regulations = Regulation.query.all()
+    by_key = {regulation.name.lower(): regulation.id for regulation in regulations}
+    by_key.update({str(regulation.id): regulation.id for regulation in regulations})
+    unknown = sorted({entry.regulation for entry in entries if entry.regulation.lower() not in by_key})
+    if unknown:
+        names = ", ".join(regulation.name for regulation in regulations)
+        raise ValueError(f"Unknown regulations {unknown}; known: {names}")
+    for entry in entries:
+        entry.regulation_id = by_key[entry.regulation.lower()]
+
+
+def _mark_duplicates(entries):
+    # Jobs are deduplicated per upload, so a repeated row would only share
+    # the first row's job; it is reported as a duplicate instead of run.
+    first = {}
+    for entry in entries:
+        key = (entry.regulation_id, entry.old_path, entry.new_path, entry.page_range)
+        if key in first:
+            entry.status = "duplicate"
+            entry.duplicate_of = first[key].number
+        else:
+            first[key] = entry
+
+
+def _link_versions(entries):
+    # Chained versions run in manifest order so each one can reuse the
+    # results of the one before instead of summarizing its old PDF again.
+    latest_by_path = {}
+    for entry in entries:
+        if entry.duplicate_of is not None:
+            continue
+        if entry.old_path:
+            entry.depends_on = latest_by_path.get((entry.regulation_id, entry.old_path))
+        latest_by_path[(entry.regulation_id, entry.new_path)] = entry
+
+
+def _prepare(entry, force):
+    """Finds or creates the Upload for an entry; marks it skipped if it already has results."""
+    new_hash = file_sha256(entry.new_path)
+    old_hash = file_sha256(entry.old_path) if entry.old_path else None
+    upload = (
+        Upload.query
+        .filter_by(regulation_id=entry.regulation_id, old_path=entry.old_path,
+                   new_path=entry.new_path, page_range=entry.page_range)
+        .order_by(Upload.id.desc())
+        .first()
+    )
+    # Hashes are unset when a previous run died before processing started
+    if upload and upload.new_hash in (None, new_hash) and upload.old_hash in (None, old_hash):
+        has_results = db.session.query(EntityGraph.id).filter_by(upload_id=upload.id).first() is not None
+        entry.upload_id = upload.id
+        if has_results and not force:
+            entry.status = "skipped"
+        entry.resumed = not has_results
+        return
+    upload = Upload(regulation_id=entry.regulation_id, old_path=entry.old_path,
+                    new_path=entry.new_path, page_range=entry.page_range)
+    db.session.add(upload)
+    bump_counter(HISTORY_COUNTER)
+    db.session.commit()
+    entry.upload_id = upload.id
+
+
+def run_batch(app, handlers, entries, concurrency=2, kind="process", force=False, echo=print,
+              poll_interval=BATCH_POLL_INTERVAL):
+    """Processes manifest entries with the upload job handlers, ``concurrency`` uploads at a time.
+
+    Runs inside an app context. Every entry gets an Upload row and a job like
+    a web upload, so history and the compare page show batch results too.
+    Entries whose upload already has results are skipped unless ``force``,
+    which makes a rerun after a crash pick up where the last one stopped;
+    stages that finished before the crash are answered by the LLM cache.
+    Rows repeating an earlier row are marked as duplicates and not run.
+    Returns the wall-clock time in seconds.
+    """
+    _resolve_regulations(entries)
+    _mark_duplicates(entries)
+    _link_versions(entries)
+    for entry in entries:
+        if entry.duplicate_of is None:
+            _prepare(entry, force)
+    duplicates = [entry for entry in entries if entry.duplicate_of is not None]
+    for entry in duplicates:
+        echo(f"Entry {entry.number} repeats entry {entry.duplicate_of}; ignoring it")
+    skipped = [entry for entry in entries if entry.status == "skipped"]
+    if skipped:
+        echo(f"Skipping {len(skipped)} uploads that already have results")
+
+    # Jobs of a web process that died are the web tier's to recover, not this run's
+    queue = JobQueue(app, max_workers=concurrency, recover=False)
+    queue.handlers = handlers
+    waiting = [entry for entry in entries if entry.status is None]
+    running = {}
+    finished = len(skipped) + len(duplicates)
+    started = time.perf_counter()
+    try:
+        while waiting or running:
+            for entry in [entry for entry in waiting if entry.ready()]:
+                waiting.remove(entry)
+                if entry.resumed:
+                    queue.abandon_active(entry.upload_id, "Interrupted; restarted by a batch run")
+                running[queue.submit(kind, entry.upload_id).id] = entry
+
+            done = queue.finished_jobs(list(running))
+            if not done:
+                time.sleep(poll_interval)
+                continue
+            for job in done:
+                entry = running.pop(job.id)
+                entry.finish(job)
+                finished += 1
+                line = f"[{finished}/{len(entries)}] {entry.regulation}: upload {entry.upload_id} {entry.status}"
+                if entry.duration is not None:
+                    line += f" in {entry.duration:.1f}s"
+                echo(line + (f" ({entry.error})" if entry.error else ""))
+    finally:
+        queue.shutdown()
+    return time.perf_counter() - started
+
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def latency_summary(values):
+    """Count, mean, p50, p95 and max of a list of durations in seconds."""
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 3),
+        "p50": round(_percentile(values, 50), 3),
+        "p95": round(_percentile(values, 95), 3),
+        "max": round(max(values), 3),
+    }
+
+
+def batch_summary(entries, wall):
+    """Throughput and latency of a batch run as a JSON-serializable dict."""
+    done = [entry for entry in entries if entry.status == "done"]
+    return {
+        "entries": len(entries),
+        "done": len(done),
+        "failed": sum(1 for entry in entries if entry.status == "failed"),
+        "skipped": sum(1 for entry in entries if entry.status == "skipped"),
+        "duplicates": sum(1 for entry in entries if entry.status == "duplicate"),
+        "wall_seconds": round(wall, 3),
+        "uploads_per_minute": round(60 * len(done) / wall, 2) if wall and done else 0.0,
+        "latency": latency_summary([entry.duration for entry in done if entry.duration is not None]),
+        "queue_wait": latency_summary([entry.queue_wait for entry in done if entry.queue_wait is not None]),
+        "failures": [
+            {"entry": entry.number, "upload_id": entry.upload_id, "error": entry.error}
+            for entry in entries if entry.status == "failed"
+        ],
+    }
+
+
+def format_summary(summary):
+    lines = [
+        f"Uploads: {summary['done']} done, {summary['failed']} failed, "
+        f"{summary['skipped']} skipped, {summary['duplicates']} duplicate of {summary['entries']}",
+        f"Wall clock: {summary['wall_seconds']:.1f}s, throughput {summary['uploads_per_minute']:.2f} uploads/min",
+    ]
+    for label, key in (("Latency", "latency"), ("Queue wait", "queue_wait")):
+        stats = summary[key]
+        if stats["count"]:
+            lines.append(f"{label}: mean {stats['mean']:.1f}s, p50 {stats['p50']:.1f}s, "
+                         f"p95 {stats['p95']:.1f}s, max {stats['max']:.1f}s")
+    for kind, counters in sorted(summary.get("llm_calls", {}).items()):
+        lines.append(f"LLM {kind}: {counters.get('calls', 0)} calls, {counters.get('retries', 0)} retries, "
+                     f"{counters.get('failures', 0)} failures")
+    cache = summary.get("llm_cache")
+    if cache:
+        lines.append(f"LLM cache: {cache['hits']} hits, {cache['misses']} misses")
+    for failure in summary["failures"]:
+        lines.append(f"Failed entry {failure['entry']} (upload {failure['upload_id']}): {failure['error']}")
+    return "\n".join(lines)
@@ -0,0 +1,54 @@
+"""Times markdown_to_docx on large synthetic KOP markdown.
+
+Usage: python benchmarks/markdown_docx.py [--sections 400] [--repeat 3] [--stream-chunk 0]
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from docx import Document
+from utils import MarkdownDocxWriter
+from synthetic import synthetic_kop
+
+
+def run(text, stream_chunk=0):
+    doc = Document()
+    writer = MarkdownDocxWriter(doc)
+    start = time.perf_counter()
+    if stream_chunk:
+        for i in range(0, len(text), stream_chunk):
+            writer.feed(text[i:i + stream_chunk])
+    else:
+        writer.feed(text)
+    writer.close()
+    return time.perf_counter() - start, doc
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sections", type=int, default=400)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--stream-chunk", type=int, default=0,
+                        help="Feed the text in chunks of this many characters, as the streaming endpoint does")
+    args = parser.parse_args()
+
+    text = synthetic_kop(args.sections)
+    line_count = text.count("\n") + 1
+    timings = []
+    for _ in range(args.repeat):
+        elapsed, doc = run(text, args.stream_chunk)
+        timings.append(elapsed)
+
+    best = min(timings)
+    print(f"input:      {len(text) / 1024:.0f} KiB, {line_count} lines")
+    print(f"output:     {len(doc.paragraphs)} paragraphs, {len(doc.tables)} tables")
+    print(f"best:       {best:.3f} s ({line_count / best:,.0f} lines/s)")
+    print(f"median:     {statistics.median(timings):.3f} s over {args.repeat} runs")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,427 @@
+"""Benchmark suite for the regulation pipeline on deterministic synthetic inputs.
+
+Usage: python benchmarks/run.py [--quick] [--filter NAME] [--output results.json]
+                                [--baseline benchmarks/baseline.json] [--tolerance 0.25] [--save-baseline]
+
+Every case prepares its inputs untimed, runs once to warm up and then
+``--repeat`` timed runs. The end-to-end case drives process_upload against
+the replay LLM provider with no latency, a scratch database and a scratch
+LLM cache, so it measures our own code rather than Gemini. The baseline
+file keeps the quick and the full suite's results apart, each with the
+commit and machine they were recorded on.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from docx import Document
+import utils
+from utils import (extract_text_from_pdf, file_sha256, parse_graph_data, compare_graphs, layout_graphs,
+                   align_entities, remap_entity_ids, diff_relationships, markdown_to_docx)
+from graph_store import RelationGraph, pack_graph, PackedGraph
+from synthetic import make_pdf, make_graph, revise_graph, synthetic_kop
+
+DEFAULT_BASELINE = os.path.join(ROOT, "benchmarks", "baseline.json")
+DEFAULT_TOLERANCE = 0.25
+# Differences below this many seconds are timer noise, whatever the ratio
+MIN_REGRESSION_SECONDS = 0.005
+
+GRAPH_SIZES = [{"entities": 100, "relationships": 200}, {"entities": 1000, "relationships": 2000},
+               {"entities": 5000, "relationships": 10000}]
+# At the size limit for server-side layout, and above it where layout is skipped
+LAYOUT_SIZES = [GRAPH_SIZES[0],
+                {"entities": utils.GRAPH_LAYOUT_MAX_NODES, "relationships": 2 * utils.GRAPH_LAYOUT_MAX_NODES},
+                GRAPH_SIZES[-1]]
+E2E_ENTITIES = 200
+
+
+class Case:
+    """One benchmark: ``setup(work_dir, **params)`` prepares inputs and returns the function to time."""
+
+    def __init__(self, name, setup, sizes, quick_sizes=None, repeat=5):
+        self.name = name
+        self.setup = setup
+        self.sizes = sizes
+        self.quick_sizes = quick_sizes if quick_sizes is not None else sizes[:1]
+        self.repeat = repeat
+
+
+def case_id(name, params):
+    return name + "[" + ",".join(f"{key}={value}" for key, value in params.items()) + "]"
+
+
+def _pdf(work_dir, pages, revision=0):
+    path = os.path.join(work_dir, f"regulation_{pages}_r{revision}.pdf")
+    if not os.path.exists(path):
+        make_pdf(path, pages, revision=revision)
+    return path
+
+
+def _graphs(entities, relationships):
+    """An old graph and its revision with entity IDs aligned, as process_upload has them after alignment."""
+    old = make_graph(entities, relationships)
+    new = revise_graph(old, seed=1)
+    return old, remap_entity_ids(new, align_entities(old, new), old)
+
+
+def setup_pdf_extract(work_dir, pages):
+    path = _pdf(work_dir, pages)
+    file_hash = file_sha256(path)
+
+    def run():
+        # Time cold extraction, not the page cache
+        utils.page_cache.clear()
+        extract_text_from_pdf(path, file_hash=file_hash)
+    return run
+
+
+def setup_parse_graph_data(work_dir, entities, relationships):
+    data = make_graph(entities, relationships)
+    return lambda: parse_graph_data(data)
+
+
+def setup_relation_graph(work_dir, entities, relationships):
+    data = make_graph(entities, relationships)
+    return lambda: RelationGraph(data)
+
+
+def setup_align_entities(work_dir, entities, relationships):
+    old = make_graph(entities, relationships)
+    new = revise_graph(old, seed=1)
+    return lambda: remap_entity_ids(new, align_entities(old, new), old)
+
+
+def setup_compare_graphs(work_dir, entities, relationships):
+    old, new = _graphs(entities, relationships)
+    G_old, G_new = parse_graph_data(old), parse_graph_data(new)
+    return lambda: compare_graphs(G_old, G_new)
+
+
+def setup_diff_relationships(work_dir, entities, relationships):
+    old, new = _graphs(entities, relationships)
+    return lambda: diff_relationships(old, new)
+
+
+def setup_layout_graphs(work_dir, entities, relationships):
+    old, new = _graphs(entities, relationships)
+    G_old, G_new = RelationGraph(old).to_networkx(), RelationGraph(new).to_networkx()
+    return lambda: layout_graphs(G_old, G_new)
+
+
+def _positions(data):
+    # Any fixed coordinates do; the layout itself is timed by layout_graphs
+    return {entity["id"]: {"x": float(i % 100) * 40, "y": float(i // 100) * 40} for i, entity in enumerate(data["entities"])}
+
+
+def setup_pack_graph(work_dir, entities, relationships):
+    data = make_graph(entities, relationships)
+    positions = _positions(data)
+    return lambda: pack_graph(data, positions)
+
+
+def setup_vis_json(work_dir, entities, relationships):
+    data = make_graph(entities, relationships)
+    blob = pack_graph(data, _positions(data))
+    # What /graph_data does for an uncached payload: unpack and render
+    return lambda: b"".join(PackedGraph(blob).iter_vis_json())
+
+
+def setup_markdown_to_docx(work_dir, sections):
+    text = synthetic_kop(sections)
+    return lambda: markdown_to_docx(Document(), text)
+
+
+def setup_process_upload(work_dir, mode, pages):
+    import app_sqllite
+    from db_models import db, Regulation, Upload
+
+    app = app_sqllite.app
+    old_path = _pdf(work_dir, pages) if mode == "compare" else None
+    new_path = _pdf(work_dir, pages, revision=1)
+    with app.app_context():
+        db.create_all()
+        if not Regulation.query.first():
+            db.session.add(Regulation(name="Benchmark"))
+            db.session.commit()
+        regulation_id = Regulation.query.first().id
+
+    def run():
+        utils.page_cache.clear()
+        with app.app_context():
+            upload = Upload(regulation_id=regulation_id, old_path=old_path, new_path=new_path)
+            db.session.add(upload)
+            db.session.commit()
+            # Bypass the LLM cache so every run does the same work
+            app_sqllite.process_upload(upload.id, use_cache=False)
+            db.session.remove()
+    return run
+
+
+def setup_obligation_search(work_dir, uploads):
+    import app_sqllite
+    from db_models import db, Regulation, Upload
+    from obligation_index import obligation_rows, replace_obligations, search_obligations
+
+    app = app_sqllite.app
+    with app.app_context():
+        app_sqllite.init_db()
+        regulation_ids = [regulation.id for regulation in Regulation.query.all()]
+        indexed = db.session.query(db.func.count(db.distinct(db.text("upload_id")))).select_from(db.table("obligations")).scalar()
+        for n in range(indexed, uploads):
+            upload = Upload(regulation_id=regulation_ids[n % len(regulation_ids)], new_path=f"synthetic-{n}.pdf")
+            db.session.add(upload)
+            db.session.flush()
+            replace_obligations(upload.id, obligation_rows(upload.id, upload.regulation_id, "new", make_graph(1000, 2000, seed=n)))
+            db.session.commit()
+
+    def run():
+        with app.app_context():
+            # "Which regulations oblige us to report thresholds above LKR 10 million", then all quarterly obligations
+            search_obligations(q="must report", min_amount=1e7, currency="LKR")
+            search_obligations(period="quarterly", regulation_ids=regulation_ids[:3])
+            db.session.remove()
+    return run
+
+
+CASES = [
+    Case("pdf_extract", setup_pdf_extract, [{"pages": 10}, {"pages": 100}, {"pages": 400}],
+         quick_sizes=[{"pages": 10}, {"pages": 100}], repeat=3),
+    Case("parse_graph_data", setup_parse_graph_data, GRAPH_SIZES, quick_sizes=GRAPH_SIZES[:2]),
+    Case("relation_graph", setup_relation_graph, GRAPH_SIZES, quick_sizes=GRAPH_SIZES[:2]),
+    Case("align_entities", setup_align_entities, GRAPH_SIZES, quick_sizes=GRAPH_SIZES[:2]),
+    Case("compare_graphs", setup_compare_graphs, GRAPH_SIZES, quick_sizes=GRAPH_SIZES[:2]),
+    Case("diff_relationships", setup_diff_relationships, GRAPH_SIZES, quick_sizes=GRAPH_SIZES[:2]),
+    Case("layout_graphs", setup_layout_graphs, LAYOUT_SIZES, repeat=3),
+    Case("pack_graph", setup_pack_graph, GRAPH_SIZES, quick_sizes=GRAPH_SIZES[:2]),
+    Case("vis_json", setup_vis_json, GRAPH_SIZES, quick_sizes=GRAPH_SIZES[:2]),
+    Case("markdown_to_docx", setup_markdown_to_docx, [{"sections": 50}, {"sections": 400}], repeat=3),
+    Case("obligation_search", setup_obligation_search, [{"uploads": 10}, {"uploads": 50}]),
+    Case("process_upload", setup_process_upload,
+         [{"mode": "first_time", "pages": 100}, {"mode": "compare", "pages": 100}],
+         quick_sizes=[{"mode": "first_time", "pages": 20}, {"mode": "compare", "pages": 20}], repeat=3),
+]
+
+
+def _configure_environment(work_dir):
+    # Read when app_sqllite and vertex_llm are first imported, by the process_upload case
+    os.environ.update(
+        LLM_PROVIDER="replay",
+        LLM_REPLAY_LATENCY="0",
+        LLM_REPLAY_JITTER="0",
+        LLM_REPLAY_FAILURE_RATE="0",
+        LLM_REPLAY_CHUNK_DELAY="0",
+        LLM_REPLAY_ENTITIES=str(E2E_ENTITIES),
+        LLM_CACHE_PATH=os.path.join(work_dir, "llm_cache.db"),
+        DATABASE_URL="sqlite:///" + os.path.join(work_dir, "regulations.db"),
+    )
+    os.environ.pop("LLM_RECORD_PATH", None)
+    os.environ.pop("LLM_REPLAY_PATH", None)
+
+
+def time_case(fn, repeat, warmup=1):
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return {
+        "runs": repeat,
+        "min": round(min(timings), 6),
+        "median": round(statistics.median(timings), 6),
+        "mean": round(statistics.fmean(timings), 6),
+        "max": round(max(timings), 6),
+    }
+
+
+def _git(*args):
+    return subprocess.run(["git", *args], cwd=ROOT, capture_output=True, text=True, timeout=10).stdout.strip()
+
+
+def _git_commit():
+    """The checked-out commit, with "-dirty" when tracked files other than the baseline differ from it."""
+    try:
+        commit = _git("rev-parse", "--short", "HEAD") or None
+        changed = _git("status", "--porcelain", "--untracked-files=no", "--", ".",
+                       ":(exclude)" + os.path.relpath(DEFAULT_BASELINE, ROOT))
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return commit + "-dirty" if commit and changed else commit
+
+
+def _cpu_model():
+    # platform.processor() is empty on most Linux systems
+    try:
+        with open("/proc/cpuinfo", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or None
+
+
+def machine_details():
+    """What timings depend on besides the code: interpreter, OS and CPU."""
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu": _cpu_model(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def _selected(name, name_filter):
+    return not name_filter or any(part and part in name for part in name_filter.split(","))
+
+
+def run_suite(quick=False, name_filter=None, repeat=None, echo=print):
+    """Runs the selected cases and returns the results document."""
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="regbench-") as work_dir:
+        _configure_environment(work_dir)
+        try:
+            for case in CASES:
+                for params in (case.quick_sizes if quick else case.sizes):
+                    name = case_id(case.name, params)
+                    if not _selected(name, name_filter):
+                        continue
+                    fn = case.setup(work_dir, **params)
+                    stats = time_case(fn, repeat or case.repeat)
+                    results[name] = {"case": case.name, "params": params, **stats}
+                    echo(f"{name:<60} median {stats['median']:9.4f}s  min {stats['min']:9.4f}s")
+        finally:
+            if "app_sqllite" in sys.modules:
+                sys.modules["app_sqllite"].job_queue.shutdown()
+    return {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+            "quick": quick,
+            # None when every case ran its own default number of times; each result has its "runs"
+            "repeat": repeat,
+            "machine": machine_details(),
+        },
+        "results": results,
+    }
+
+
+def _mode(quick):
+    return "quick" if quick else "full"
+
+
+def _case_ids(quick):
+    return [case_id(case.name, params) for case in CASES for params in (case.quick_sizes if quick else case.sizes)]
+
+
+def save_baseline(current, path, merge=False):
+    """Stores ``current`` as the baseline of its mode (quick or full), keeping the other mode's.
+
+    With ``merge`` the results are added to the stored ones of the same mode
+    instead of replacing them, for recording only the cases that changed.
+    """
+    baseline = {}
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            baseline = json.load(f)
+    mode = _mode(current["meta"]["quick"])
+    stored = baseline.get(mode)
+    if merge and stored:
+        if stored["meta"]["machine"] != current["meta"]["machine"]:
+            raise ValueError(f"The {mode} baseline was recorded on another machine; record the whole suite instead")
+        results = {**stored["results"], **current["results"]}
+        # Keep the suite's order so diffs of the baseline stay readable
+        order = {name: i for i, name in enumerate(_case_ids(current["meta"]["quick"]))}
+        current = {**current, "results": dict(sorted(results.items(), key=lambda item: order.get(item[0], len(order))))}
+    baseline[mode] = current
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({key: baseline[key] for key in ("full", "quick") if key in baseline}, f, indent=2)
+        f.write("\n")
+
+
+def compare_to_baseline(current, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Per-case median change against the baseline; a case regresses when it is more than ``tolerance`` slower."""
+    rows = []
+    for name, result in current["results"].items():
+        reference = baseline["results"].get(name)
+        if reference is None:
+            rows.append({"name": name, "median": result["median"], "baseline": None, "change": None, "regression": False})
+            continue
+        change = result["median"] / reference["median"] - 1 if reference["median"] else 0.0
+        regression = change > tolerance and result["median"] - reference["median"] > MIN_REGRESSION_SECONDS
+        rows.append({"name": name, "median": result["median"], "baseline": reference["median"],
+                     "change": round(change, 4), "regression": regression})
+    return rows
+
+
+def format_comparison(rows):
+    lines = []
+    for row in rows:
+        if row["baseline"] is None:
+            lines.append(f"{row['name']:<60} {row['median']:9.4f}s  (not in baseline)")
+            continue
+        flag = "  REGRESSION" if row["regression"] else ""
+        lines.append(f"{row['name']:<60} {row['median']:9.4f}s  vs {row['baseline']:9.4f}s  {row['change']:+7.1%}{flag}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--quick", action="store_true", help="Smaller inputs only, for a fast check")
+    parser.add_argument("--filter", help="Only run cases whose ID contains this text, or one of several "
+                                         "separated by commas, e.g. vis_json,pack_graph")
+    parser.add_argument("--repeat", type=int, help="Timed runs per case instead of each case's default")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="Results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="Allowed slowdown of a case's median as a fraction (default 0.25)")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="Store these results as the baseline of this mode; with --filter only the selected "
+                             "cases are replaced")
+    args = parser.parse_args()
+
+    current = run_suite(quick=args.quick, name_filter=args.filter, repeat=args.repeat)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(current, f, indent=2)
+    if args.save_baseline:
+        try:
+            save_baseline(current, args.baseline, merge=bool(args.filter))
+        except ValueError as e:
+            sys.exit(str(e))
+        print(f"Saved {_mode(args.quick)} baseline to {args.baseline}")
+        return
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --save-baseline to create one")
+        return
+
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f).get(_mode(args.quick))
+    if baseline is None:
+        print(f"No {_mode(args.quick)} baseline in {args.baseline}; run with --save-baseline to create one")
+        return
+    rows = compare_to_baseline(current, baseline, args.tolerance)
+    print()
+    print(f"Against baseline from commit {baseline['meta'].get('commit')} ({baseline['meta'].get('timestamp')}):")
+    if baseline["meta"].get("machine") != current["meta"]["machine"]:
+        print(f"Warning: the baseline was recorded on another machine: {baseline['meta'].get('machine')}")
+    print(format_comparison(rows))
+    regressions = [row["name"] for row in rows if row["regression"]]
+    if regressions:
+        print(f"{len(regressions)} cases slower than the baseline by more than {args.tolerance:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
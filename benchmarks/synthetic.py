@@ -0,0 +1,140 @@
+"""Deterministic synthetic inputs for the benchmarks: regulation PDFs, entity graphs and KOP markdown."""
+import random
+
+import fitz
+
+WORDS = (
+    "operator shall submit report quarterly threshold capital exposure "
+    "institution notify authority within days review control risk data "
+    "retention record customer assessment breach annual limit"
+).split()
+
+ENTITY_TYPES = ("organization", "report", "threshold", "customer", "authority", "obligation")
+ENTITY_NOUNS = (
+    "Central Bank", "Licensed Bank", "Clearing House", "Trade Repository", "Investment Firm",
+    "Transaction Report", "Exposure Limit", "Capital Buffer", "Retail Customer", "Supervisory Authority",
+    "Liquidity Return", "Margin Call", "Audit Committee", "Data Record", "Risk Assessment",
+)
+VERBS = ("must report to", "must notify", "must retain", "may request", "must submit", "must review")
+FREQUENCIES = ("daily", "weekly", "monthly", "quarterly", "annually")
+
+PAGE_RECT = fitz.Rect(50, 50, 550, 800)
+
+
+def _sentence(rng, n=14):
+    words = [rng.choice(WORDS) for _ in range(n)]
+    words[0] = words[0].capitalize()
+    return " ".join(words) + "."
+
+
+def regulation_pages(pages, seed=0, revision=0, change_ratio=0.1):
+    """Page texts of a regulation with one article per page.
+
+    ``revision`` > 0 rewrites about ``change_ratio`` of the articles, the way
+    an amended version of the same regulation would differ from its predecessor.
+    """
+    rng = random.Random(seed)
+    changed = random.Random(f"{seed}-{revision}")
+    texts = []
+    for n in range(1, pages + 1):
+        body = [_sentence(rng) for _ in range(12)]
+        if revision and changed.random() < change_ratio:
+            body[changed.randrange(len(body))] = _sentence(changed)
+        texts.append(f"Article {n} Obligation {n}\n" + "\n".join(body))
+    return texts
+
+
+def make_pdf(path, pages, seed=0, revision=0, change_ratio=0.1):
+    """Writes a ``pages``-page regulation PDF to ``path`` (see regulation_pages)."""
+    with fitz.open() as doc:
+        for text in regulation_pages(pages, seed, revision, change_ratio):
+            doc.new_page().insert_textbox(PAGE_RECT, text, fontsize=9)
+        doc.save(path)
+    return path
+
+
+def make_graph(entities, relationships, seed=0):
+    """Entity-relationship data shaped like the extraction output, with ``entities`` nodes and ``relationships`` edges.
+
+    Edges are drawn between random pairs, so some pairs get several
+    relationships, as the LLM produces for multi-obligation entities.
+    """
+    rng = random.Random(seed)
+    nodes = [
+        {"id": f"E{i}", "name": f"{rng.choice(ENTITY_NOUNS)} {i}", "type": rng.choice(ENTITY_TYPES)}
+        for i in range(1, entities + 1)
+    ]
+    edges = []
+    for _ in range(relationships):
+        subject, obj = rng.sample(nodes, 2) if entities > 1 else (nodes[0], nodes[0])
+        edges.append({
+            "subject_id": subject["id"],
+            "subject_name": subject["name"],
+            "verb": rng.choice(VERBS),
+            "object_id": obj["id"],
+            "object_name": obj["name"],
+            "Optionality": rng.choice(("Mandatory", "Conditional")),
+            "Condition for Relationship to be Active": f"Exposure above LKR {rng.randint(1, 50)} million",
+            "Property of Object (part of condition)": "Amount, Currency",
+            "Thresholds": f"LKR {rng.randint(1, 50)} million",
+            "frequency": f"to be validated {rng.choice(FREQUENCIES)}",
+        })
+    return {"entities": nodes, "relationships": edges}
+
+
+def revise_graph(data, seed=0, change_ratio=0.1):
+    """A later version of ``data``: some relationships changed, added or dropped, and entity IDs renumbered.
+
+    Renumbering mirrors a fresh extraction, which assigns its own IDs, so
+    entity alignment has real work to do.
+    """
+    rng = random.Random(seed)
+    entities = [dict(entity) for entity in data["entities"]]
+    relationships = []
+    for rel in data["relationships"]:
+        roll = rng.random()
+        if roll < change_ratio / 2:
+            continue
+        rel = dict(rel)
+        if roll < change_ratio:
+            rel["Thresholds"] = f"LKR {rng.randint(51, 100)} million"
+        relationships.append(rel)
+    for _ in range(int(len(data["relationships"]) * change_ratio / 2)):
+        subject, obj = rng.sample(entities, 2)
+        relationships.append(dict(rng.choice(data["relationships"]), subject_id=subject["id"], subject_name=subject["name"],
+                                  object_id=obj["id"], object_name=obj["name"]))
+
+    order = list(range(len(entities)))
+    rng.shuffle(order)
+    renumbered = {entities[i]["id"]: f"N{n}" for n, i in enumerate(order, 1)}
+    for entity in entities:
+        entity["id"] = renumbered[entity["id"]]
+    for rel in relationships:
+        rel["subject_id"] = renumbered[rel["subject_id"]]
+        rel["object_id"] = renumbered[rel["object_id"]]
+    return {"entities": [entities[i] for i in order], "relationships": relationships}
+
+
+def synthetic_kop(sections, seed=7):
+    """A KOP-shaped document: headings, numbered steps, nested bullets, emphasis and tables."""
+    rng = random.Random(seed)
+    lines = ["# Key Operating Procedure", ""]
+    for s in range(1, sections + 1):
+        lines.append(f"## {s}. Obligation {s}")
+        lines.append("")
+        lines.append(f"**Owner:** Compliance team {s % 7}. {_sentence(rng)} Refer to `RULE-{s}`.")
+        lines.append("")
+        lines.append("### Steps")
+        for step in range(1, 5):
+            lines.append(f"{step}. {_sentence(rng, 10)} *Due within {step * 5} days*.")
+            lines.append(f"   - {_sentence(rng, 8)}")
+        lines.append("")
+        lines.append("### Controls")
+        lines.append("| Control | Frequency | Threshold |")
+        lines.append("|---|---|---|")
+        for row in range(3):
+            lines.append(f"| {_sentence(rng, 4)} | **{rng.choice(('Daily', 'Monthly', 'Annual'))}** | {rng.randint(1, 100)}% |")
+        lines.append("")
+        lines.append(_sentence(rng, 30))
+        lines.append("")
+    return "\n".join(lines)
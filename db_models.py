@@ -10,24 +10,198 @@ class Regulation(db.Model):
 
 class Upload(db.Model):
     __tablename__ = 'uploads'
+    __table_args__ = (
+        db.Index('ix_uploads_regulation_time', 'regulation_id', 'upload_time'),
+        db.Index('ix_uploads_time', 'upload_time', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     regulation_id = db.Column(db.Integer, db.ForeignKey('regulations.id'), nullable=False)
     old_path = db.Column(db.Text)
     new_path = db.Column(db.Text)
+    old_hash = db.Column(db.String(64))
+    new_hash = db.Column(db.String(64))
+    page_range = db.Column(db.String(255))
+    previous_upload_id = db.Column(db.Integer, db.ForeignKey('uploads.id'))
     upload_time = db.Column(db.DateTime, default=datetime.utcnow)
 
 class Summary(db.Model):
     __tablename__ = 'summaries'
     id = db.Column(db.Integer, primary_key=True)
-    upload_id = db.Column(db.Integer, db.ForeignKey('uploads.id'), nullable=False)
+    upload_id = db.Column(db.Integer, db.ForeignKey('uploads.id'), nullable=False, index=True)
     old_summary = db.Column(db.Text)
     new_summary = db.Column(db.Text)
+    diff_stats = db.Column(db.Text)
 
 class EntityGraph(db.Model):
     __tablename__ = 'entity_graphs'
     id = db.Column(db.Integer, primary_key=True)
-    upload_id = db.Column(db.Integer, db.ForeignKey('uploads.id'), nullable=False)
+    upload_id = db.Column(db.Integer, db.ForeignKey('uploads.id'), nullable=False, index=True)
+    # graph_store.pack_graph blobs holding entities, relationships and layout
+    old_packed = db.Column(db.LargeBinary)
+    new_packed = db.Column(db.LargeBinary)
+    # Text copies, only set on rows written before graphs were packed
     old_json = db.Column(db.Text)
     new_json = db.Column(db.Text)
     graph_old = db.Column(db.Text)
     graph_new = db.Column(db.Text)
+    diff_json = db.Column(db.Text)
+    # Size of the new graph as rendered, for listings that should not unpack it
+    node_count = db.Column(db.Integer)
+    edge_count = db.Column(db.Integer)
+    # Bumped every time the upload is (re)processed; drives ETags and the payload cache
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class Job(db.Model):
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        db.Index('ix_jobs_upload_kind', 'upload_id', 'kind'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    upload_id = db.Column(db.Integer, db.ForeignKey('uploads.id'), nullable=False)
+    kind = db.Column(db.String(32), nullable=False)
+    status = db.Column(db.String(16), nullable=False, default='queued')
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    stage = db.Column(db.String(255))
+    error = db.Column(db.Text)
+    result_path = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    # Stamped periodically by the process holding a queued or running job; see jobs.JobQueue
+    heartbeat_at = db.Column(db.DateTime)
+
+class KopDocument(db.Model):
+    __tablename__ = 'kop_documents'
+    id = db.Column(db.Integer, primary_key=True)
+    upload_id = db.Column(db.Integer, db.ForeignKey('uploads.id'), nullable=False, index=True)
+    job_id = db.Column(db.Integer, db.ForeignKey('jobs.id'))
+    # sha256 of the docx bytes, and of the summary/graph/model/prompt version it was generated from
+    content_hash = db.Column(db.String(64), nullable=False)
+    input_hash = db.Column(db.String(64), nullable=False)
+    parameters = db.Column(db.Text)
+    markdown = db.Column(db.Text)
+    docx = db.Column(db.LargeBinary, nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class TraceSpan(db.Model):
+    __tablename__ = 'trace_spans'
+    __table_args__ = (
+        db.Index('ix_trace_spans_upload_trace', 'upload_id', 'trace_id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    upload_id = db.Column(db.Integer, db.ForeignKey('uploads.id'), nullable=False)
+    job_id = db.Column(db.Integer, db.ForeignKey('jobs.id'))
+    # One trace per job run or KOP stream; spans are numbered within it
+    trace_id = db.Column(db.String(32), nullable=False)
+    kind = db.Column(db.String(32), nullable=False)
+    span_index = db.Column(db.Integer, nullable=False)
+    parent_index = db.Column(db.Integer)
+    name = db.Column(db.String(64), nullable=False)
+    # Seconds from the start of the trace
+    start_offset = db.Column(db.Float, nullable=False)
+    duration = db.Column(db.Float, nullable=False)
+    status = db.Column(db.String(16), nullable=False, default='ok')
+    prompt_tokens = db.Column(db.Integer)
+    response_tokens = db.Column(db.Integer)
+    attributes = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class Obligation(db.Model):
+    __tablename__ = 'obligations'
+    __table_args__ = (
+        db.Index('ix_obligations_upload', 'upload_id', 'side'),
+        db.Index('ix_obligations_regulation', 'regulation_id', 'side'),
+        db.Index('ix_obligations_period', 'period', 'regulation_id'),
+        db.Index('ix_obligations_amount', 'threshold_currency', 'threshold_amount'),
+    )
+    # One row per relationship of a processed graph, written with the upload's results
+    id = db.Column(db.Integer, primary_key=True)
+    upload_id = db.Column(db.Integer, db.ForeignKey('uploads.id'), nullable=False)
+    regulation_id = db.Column(db.Integer, db.ForeignKey('regulations.id'), nullable=False)
+    side = db.Column(db.String(3), nullable=False)
+    subject_id = db.Column(db.String(255))
+    subject_name = db.Column(db.Text)
+    subject_type = db.Column(db.String(255))
+    verb = db.Column(db.Text)
+    object_id = db.Column(db.String(255))
+    object_name = db.Column(db.Text)
+    object_type = db.Column(db.String(255))
+    optionality = db.Column(db.Text)
+    condition = db.Column(db.Text)
+    property = db.Column(db.Text)
+    thresholds = db.Column(db.Text)
+    frequency = db.Column(db.Text)
+    # Normalized from the text above so they can be filtered on with an index
+    period = db.Column(db.String(16))
+    threshold_amount = db.Column(db.Float)
+    threshold_currency = db.Column(db.String(8))
+    # Lowercased text of the row; the FTS5 index (when available) is built over it
+    search_text = db.Column(db.Text, nullable=False)
+
+class GraphVersion(db.Model):
+    __tablename__ = 'graph_versions'
+    __table_args__ = (
+        db.UniqueConstraint('regulation_id', 'sequence', name='uq_graph_versions_sequence'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    regulation_id = db.Column(db.Integer, db.ForeignKey('regulations.id'), nullable=False)
+    upload_id = db.Column(db.Integer, db.ForeignKey('uploads.id'), nullable=False, index=True)
+    # Position in the regulation's timeline, from 0
+    sequence = db.Column(db.Integer, nullable=False)
+    # Either a full graph_store.pack_graph snapshot or a zlib-compressed JSON delta against the previous version
+    snapshot = db.Column(db.LargeBinary)
+    delta = db.Column(db.LargeBinary)
+    node_count = db.Column(db.Integer, nullable=False)
+    edge_count = db.Column(db.Integer, nullable=False)
+    # Counts of what changed against the previous version, as JSON
+    changes = db.Column(db.Text)
+    # On snapshots: JSON list of every entity ID used up to this version, so a
+    # rebuild can start here instead of replaying the timeline from the beginning
+    reserved_ids = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class Counter(db.Model):
+    __tablename__ = 'counters'
+    # Bumped in the same transaction as every change a cached page shows, so
+    # the page's ETag can be read with one primary-key lookup
+    name = db.Column(db.String(64), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+
+# Uploads added, job status changes, stored results and KOPs: what /history lists
+HISTORY_COUNTER = "history"
+
+
+def bump_counter(name, conn=None):
+    """Adds one to a named counter in the current transaction of ``conn`` (by default the session)."""
+    (conn or db.session).execute(
+        db.text("INSERT INTO counters (name, value) VALUES (:name, 1) "
+                "ON CONFLICT (name) DO UPDATE SET value = counters.value + 1"),
+        {"name": name}
+    )
+
+
+def counter_value(name):
+    return db.session.execute(db.select(Counter.value).where(Counter.name == name)).scalar() or 0
+
+
+def upgrade_schema():
+    """Adds the columns and indexes a database created by an older version lacks; safe to run on every start.
+
+    db.create_all() creates missing tables but never alters existing ones.
+    Added columns must be nullable or have a server default.
+    """
+    inspector = db.inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    ddl = db.schema.CreateColumn(column).compile(dialect=db.engine.dialect)
+                    conn.execute(db.text(f"ALTER TABLE {table.name} ADD COLUMN {ddl}"))
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
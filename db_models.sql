@@ -1,30 +1,173 @@
-CREATE TABLE regulations (
+CREATE TABLE IF NOT EXISTS regulations (
     id SERIAL PRIMARY KEY,
     name VARCHAR(255) UNIQUE NOT NULL
 );
 
-CREATE TABLE uploads (
+CREATE TABLE IF NOT EXISTS uploads (
     id SERIAL PRIMARY KEY,
     regulation_id INTEGER NOT NULL REFERENCES regulations(id),
     old_path TEXT,
     new_path TEXT,
+    old_hash VARCHAR(64),
+    new_hash VARCHAR(64),
+    page_range VARCHAR(255),
+    previous_upload_id INTEGER REFERENCES uploads(id),
     upload_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
-CREATE TABLE summaries (
+-- Databases created from an older version of this file; CREATE TABLE IF NOT EXISTS leaves their tables as they were
+ALTER TABLE uploads ADD COLUMN IF NOT EXISTS old_hash VARCHAR(64);
+ALTER TABLE uploads ADD COLUMN IF NOT EXISTS new_hash VARCHAR(64);
+ALTER TABLE uploads ADD COLUMN IF NOT EXISTS page_range VARCHAR(255);
+ALTER TABLE uploads ADD COLUMN IF NOT EXISTS previous_upload_id INTEGER REFERENCES uploads(id);
+
+CREATE INDEX IF NOT EXISTS ix_uploads_regulation_time ON uploads (regulation_id, upload_time);
+CREATE INDEX IF NOT EXISTS ix_uploads_time ON uploads (upload_time, id);
+
+CREATE TABLE IF NOT EXISTS summaries (
     id SERIAL PRIMARY KEY,
     upload_id INTEGER NOT NULL REFERENCES uploads(id),
     old_summary TEXT,
-    new_summary TEXT
+    new_summary TEXT,
+    diff_stats TEXT
 );
 
-CREATE TABLE entity_graphs (
+ALTER TABLE summaries ADD COLUMN IF NOT EXISTS diff_stats TEXT;
+
+CREATE INDEX IF NOT EXISTS ix_summaries_upload_id ON summaries (upload_id);
+
+CREATE TABLE IF NOT EXISTS entity_graphs (
     id SERIAL PRIMARY KEY,
     upload_id INTEGER NOT NULL REFERENCES uploads(id),
+    old_packed BYTEA,
+    new_packed BYTEA,
     old_json TEXT,
     new_json TEXT,
     graph_old TEXT,
-    graph_new TEXT
+    graph_new TEXT,
+    diff_json TEXT,
+    node_count INTEGER,
+    edge_count INTEGER,
+    version INTEGER NOT NULL DEFAULT 1,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+ALTER TABLE entity_graphs ADD COLUMN IF NOT EXISTS old_packed BYTEA;
+ALTER TABLE entity_graphs ADD COLUMN IF NOT EXISTS new_packed BYTEA;
+ALTER TABLE entity_graphs ADD COLUMN IF NOT EXISTS diff_json TEXT;
+ALTER TABLE entity_graphs ADD COLUMN IF NOT EXISTS node_count INTEGER;
+ALTER TABLE entity_graphs ADD COLUMN IF NOT EXISTS edge_count INTEGER;
+ALTER TABLE entity_graphs ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;
+ALTER TABLE entity_graphs ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;
+
+CREATE INDEX IF NOT EXISTS ix_entity_graphs_upload_id ON entity_graphs (upload_id);
+
+CREATE TABLE IF NOT EXISTS jobs (
+    id SERIAL PRIMARY KEY,
+    upload_id INTEGER NOT NULL REFERENCES uploads(id),
+    kind VARCHAR(32) NOT NULL,
+    status VARCHAR(16) NOT NULL DEFAULT 'queued',
+    progress INTEGER NOT NULL DEFAULT 0,
+    stage VARCHAR(255),
+    error TEXT,
+    result_path TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    started_at TIMESTAMP,
+    finished_at TIMESTAMP,
+    heartbeat_at TIMESTAMP
+);
+
+ALTER TABLE jobs ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMP;
+
+CREATE INDEX IF NOT EXISTS ix_jobs_upload_kind ON jobs (upload_id, kind);
+
+CREATE TABLE IF NOT EXISTS kop_documents (
+    id SERIAL PRIMARY KEY,
+    upload_id INTEGER NOT NULL REFERENCES uploads(id),
+    job_id INTEGER REFERENCES jobs(id),
+    content_hash VARCHAR(64) NOT NULL,
+    input_hash VARCHAR(64) NOT NULL,
+    parameters TEXT,
+    markdown TEXT,
+    docx BYTEA NOT NULL,
+    size INTEGER NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS ix_kop_documents_upload_id ON kop_documents (upload_id);
+
+CREATE TABLE IF NOT EXISTS trace_spans (
+    id SERIAL PRIMARY KEY,
+    upload_id INTEGER NOT NULL REFERENCES uploads(id),
+    job_id INTEGER REFERENCES jobs(id),
+    trace_id VARCHAR(32) NOT NULL,
+    kind VARCHAR(32) NOT NULL,
+    span_index INTEGER NOT NULL,
+    parent_index INTEGER,
+    name VARCHAR(64) NOT NULL,
+    start_offset DOUBLE PRECISION NOT NULL,
+    duration DOUBLE PRECISION NOT NULL,
+    status VARCHAR(16) NOT NULL DEFAULT 'ok',
+    prompt_tokens INTEGER,
+    response_tokens INTEGER,
+    attributes TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS ix_trace_spans_upload_trace ON trace_spans (upload_id, trace_id);
+
+CREATE TABLE IF NOT EXISTS obligations (
+    id SERIAL PRIMARY KEY,
+    upload_id INTEGER NOT NULL REFERENCES uploads(id),
+    regulation_id INTEGER NOT NULL REFERENCES regulations(id),
+    side VARCHAR(3) NOT NULL,
+    subject_id VARCHAR(255),
+    subject_name TEXT,
+    subject_type VARCHAR(255),
+    verb TEXT,
+    object_id VARCHAR(255),
+    object_name TEXT,
+    object_type VARCHAR(255),
+    optionality TEXT,
+    condition TEXT,
+    property TEXT,
+    thresholds TEXT,
+    frequency TEXT,
+    period VARCHAR(16),
+    threshold_amount DOUBLE PRECISION,
+    threshold_currency VARCHAR(8),
+    search_text TEXT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS ix_obligations_upload ON obligations (upload_id, side);
+CREATE INDEX IF NOT EXISTS ix_obligations_regulation ON obligations (regulation_id, side);
+CREATE INDEX IF NOT EXISTS ix_obligations_period ON obligations (period, regulation_id);
+CREATE INDEX IF NOT EXISTS ix_obligations_amount ON obligations (threshold_currency, threshold_amount);
+-- Serves the LIKE '%word%' text search used outside SQLite
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX IF NOT EXISTS ix_obligations_search_text ON obligations USING GIN (search_text gin_trgm_ops);
+
+CREATE TABLE IF NOT EXISTS graph_versions (
+    id SERIAL PRIMARY KEY,
+    regulation_id INTEGER NOT NULL REFERENCES regulations(id),
+    upload_id INTEGER NOT NULL REFERENCES uploads(id),
+    sequence INTEGER NOT NULL,
+    snapshot BYTEA,
+    delta BYTEA,
+    node_count INTEGER NOT NULL,
+    edge_count INTEGER NOT NULL,
+    changes TEXT,
+    reserved_ids TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT uq_graph_versions_sequence UNIQUE (regulation_id, sequence)
+);
+
+CREATE INDEX IF NOT EXISTS ix_graph_versions_upload_id ON graph_versions (upload_id);
+
+-- Named change counters; "history" is bumped by every change /history shows
+CREATE TABLE IF NOT EXISTS counters (
+    name VARCHAR(64) PRIMARY KEY,
+    value INTEGER NOT NULL DEFAULT 0
 );
 
 INSERT INTO regulations (name) VALUES
@@ -0,0 +1,156 @@
+import json
+import re
+
+ENTITY_FIELDS = ("id", "name", "type")
+RELATIONSHIP_FIELDS = (
+    "subject_id",
+    "subject_name",
+    "verb",
+    "object_id",
+    "object_name",
+    "Optionality",
+    "Condition for Relationship to be Active",
+    "Property of Object (part of condition)",
+    "Thresholds",
+    "frequency",
+)
+REQUIRED_RELATIONSHIP_FIELDS = ("subject_id", "verb", "object_id")
+
+# Vertex AI response_schema (OpenAPI subset) for JSON response mode
+ENTITY_RELATIONSHIP_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "entities": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {field: {"type": "STRING"} for field in ENTITY_FIELDS},
+                "required": list(ENTITY_FIELDS),
+            },
+        },
+        "relationships": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {field: {"type": "STRING"} for field in RELATIONSHIP_FIELDS},
+                "required": list(REQUIRED_RELATIONSHIP_FIELDS),
+            },
+        },
+    },
+    "required": ["entities", "relationships"],
+}
+
+_CODE_FENCE = re.compile(r"^```(?:json)?\s*|\s*```\s*$", re.IGNORECASE)
+_TRAILING_COMMA = re.compile(r",\s*([}\]])")
+
+
+class SchemaError(ValueError):
+    """The model response is not (repairable) entity-relationship JSON."""
+
+
+def _close_truncated(text):
+    """Cuts truncated JSON back to the last complete array element or object member and closes it.
+
+    Walks the text once, tracking string/escape state and the open bracket
+    stack, and remembers the last position where a nested value finished.
+    """
+    stack = []
+    in_string = False
+    escaped = False
+    last_cut = None
+    for i, ch in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]":
+            if not stack:
+                break
+            stack.pop()
+            if not stack:
+                return text[:i + 1]
+            last_cut = (i + 1, list(stack))
+    if last_cut is None:
+        raise SchemaError("Response contains no complete JSON value")
+    end, open_brackets = last_cut
+    return text[:end] + "".join(reversed(open_brackets))
+
+
+def parse_json_response(text):
+    """Parses a model response into a dict, tolerating fences and chatter around the JSON.
+
+    Trailing commas and truncated output (e.g. a response cut off at the
+    token limit) are repaired. Returns ``(data, repaired)``.
+    """
+    cleaned = _CODE_FENCE.sub("", text.strip())
+    start = cleaned.find("{")
+    if start < 0:
+        raise SchemaError("Response contains no JSON object")
+    candidate = cleaned[start:cleaned.rfind("}") + 1]
+    try:
+        return json.loads(candidate), False
+    except ValueError:
+        pass
+
+    repaired = _close_truncated(cleaned[start:])
+    repaired = _TRAILING_COMMA.sub(r"\1", repaired)
+    try:
+        return json.loads(repaired), True
+    except ValueError as e:
+        raise SchemaError(f"Unrepairable JSON response: {e}") from e
+
+
+def validate_entity_relationships(data):
+    """Checks a parsed response against the schema and normalizes it.
+
+    Every field is coerced to a string; relationships missing a required
+    field are dropped and entities referenced only by relationships are
+    added from their subject/object names. Returns ``(data, repaired)``.
+    """
+    if not isinstance(data, dict):
+        raise SchemaError("Top-level JSON value must be an object")
+    entities = data.get("entities")
+    relationships = data.get("relationships")
+    if not isinstance(entities, list) or not isinstance(relationships, list):
+        raise SchemaError("JSON must contain 'entities' and 'relationships' arrays")
+
+    repaired = False
+    clean_entities = []
+    known = {}
+    for entity in entities:
+        if not isinstance(entity, dict) or not entity.get("id"):
+            repaired = True
+            continue
+        clean = {field: str(entity.get(field) or "") for field in ENTITY_FIELDS}
+        clean["name"] = clean["name"] or clean["id"]
+        if clean["id"] in known:
+            repaired = True
+            continue
+        known[clean["id"]] = clean
+        clean_entities.append(clean)
+
+    clean_relationships = []
+    for rel in relationships:
+        if not isinstance(rel, dict) or not all(rel.get(field) for field in REQUIRED_RELATIONSHIP_FIELDS):
+            repaired = True
+            continue
+        clean = {field: str(rel.get(field) or "") for field in RELATIONSHIP_FIELDS}
+        for side in ("subject", "object"):
+            entity_id = clean[f"{side}_id"]
+            if entity_id not in known:
+                repaired = True
+                known[entity_id] = {"id": entity_id, "name": clean[f"{side}_name"] or entity_id, "type": "unknown"}
+                clean_entities.append(known[entity_id])
+        clean_relationships.append(clean)
+
+    if not clean_entities and not clean_relationships:
+        raise SchemaError("JSON contains no valid entities or relationships")
+    return {"entities": clean_entities, "relationships": clean_relationships}, repaired
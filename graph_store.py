@@ -0,0 +1,245 @@
+import sys
+import json
+import math
+import zlib
+import struct
+from array import array
+import networkx as nx
+from entity_schema import ENTITY_FIELDS, RELATIONSHIP_FIELDS
+from utils import EDGE_TOOLTIP_FIELDS
+
+MAGIC = b"RGS1"
+COMPRESSION_LEVEL = 6
+STREAM_CHUNK_BYTES = 64 * 1024
+NODE_REFERENCE_FIELDS = ("subject_id", "object_id")
+# (label, field) pairs of the tooltip sent as edge "attrs"; the verb is already the edge label
+TOOLTIP_ATTRS = tuple((label, field) for label, field in EDGE_TOOLTIP_FIELDS if field != "verb")
+
+
+def _le_bytes(values):
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _le_array(typecode, data):
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+def _json_strings(strings):
+    return [json.dumps(value, ensure_ascii=False).encode("utf-8") for value in strings]
+
+
+def _iter_vis_json(s, columns, chunk_bytes):
+    """Yields the vis.js payload of node/edge columns whose strings ``s`` are already JSON-encoded.
+
+    Every relationship becomes its own edge, parallel ones included, with its
+    index as the edge ID. Tooltips are not rendered here: each edge carries
+    the raw values of the tooltip fields other than the verb in ``attrs``,
+    labelled once by the top-level ``tooltip_fields``, and the page builds
+    the text on hover.
+    """
+    ids = [s[i] for i in columns["node.id"]]
+    node_rows = zip(ids, columns["node.name"], columns["node.type"], columns["node.x"], columns["node.y"])
+    nodes = (
+        b'{"id":%s,"label":%s,"group":%s}' % (node_id, s[name], s[group]) if math.isnan(x)
+        else b'{"id":%s,"label":%s,"group":%s,"x":%s,"y":%s}' % (node_id, s[name], s[group], repr(x).encode(), repr(y).encode())
+        for node_id, name, group, x, y in node_rows
+    )
+
+    attr_columns = [columns[f"edge.{field}"] for _, field in TOOLTIP_ATTRS]
+    edge_rows = zip(columns["edge.subject_id"], columns["edge.object_id"], columns["edge.verb"], *attr_columns)
+    edges = (
+        b'{"id":%d,"from":%s,"to":%s,"label":%s,"attrs":[%s]}' % (
+            i, ids[subject], ids[obj], s[verb], b",".join(s[value] for value in attrs))
+        for i, (subject, obj, verb, *attrs) in enumerate(edge_rows)
+    )
+
+    chunk = [b'{"tooltip_fields":' + json.dumps([label for label, _ in TOOLTIP_ATTRS]).encode("utf-8") + b',"nodes":[']
+    size = 0
+    for prefix, items in ((b"", nodes), (b'],"edges":[', edges)):
+        chunk.append(prefix)
+        for n, item in enumerate(items):
+            if n:
+                chunk.append(b",")
+            chunk.append(item)
+            size += len(item)
+            if size >= chunk_bytes:
+                yield b"".join(chunk)
+                chunk, size = [], 0
+    chunk.append(b"]}")
+    yield b"".join(chunk)
+
+
+class RelationGraph:
+    """Entity-relationship data held as interned strings and array columns.
+
+    Nodes and relationships are rows of ``array`` columns of indexes into
+    ``strings``, except ``subject_id``/``object_id``, which index nodes.
+    Unlike a networkx DiGraph every relationship is kept, parallel ones
+    included. Relationships naming an unlisted entity get a node whose name
+    is its ID. NetworkX is only involved for analytics, via to_networkx.
+    """
+
+    __slots__ = ("strings", "columns", "node_count", "edge_count")
+
+    def __init__(self, data):
+        strings = {}
+
+        def intern(value):
+            index = strings.get(value)
+            if index is None:
+                index = strings[value] = len(strings)
+            return index
+
+        entities = list(data.get("entities", []))
+        relationships = data.get("relationships", [])
+        node_index = {entity["id"]: i for i, entity in enumerate(entities)}
+        for rel in relationships:
+            for field in NODE_REFERENCE_FIELDS:
+                if rel[field] not in node_index:
+                    node_index[rel[field]] = len(entities)
+                    entities.append({"id": rel[field], "name": rel[field], "type": ""})
+
+        self.columns = {}
+        for field in ENTITY_FIELDS:
+            self.columns[f"node.{field}"] = array("I", (intern(str(entity.get(field, ""))) for entity in entities))
+        for field in RELATIONSHIP_FIELDS:
+            if field in NODE_REFERENCE_FIELDS:
+                values = (node_index[rel[field]] for rel in relationships)
+            else:
+                values = (intern(str(rel.get(field, ""))) for rel in relationships)
+            self.columns[f"edge.{field}"] = array("I", values)
+        self.strings = list(strings)
+        self.node_count = len(entities)
+        self.edge_count = len(relationships)
+
+    def node_ids(self):
+        return [self.strings[i] for i in self.columns["node.id"]]
+
+    def to_networkx(self):
+        """A DiGraph of the node IDs and subject/object pairs, for layout and other analytics."""
+        ids = self.node_ids()
+        G = nx.DiGraph()
+        G.add_nodes_from(ids)
+        G.add_edges_from((ids[subject], ids[obj]) for subject, obj in zip(self.columns["edge.subject_id"], self.columns["edge.object_id"]))
+        return G
+
+    def iter_vis_json(self, positions=None, chunk_bytes=STREAM_CHUNK_BYTES):
+        """Yields the vis.js ``{"nodes", "edges"}`` payload as UTF-8 JSON chunks (see PackedGraph.iter_vis_json)."""
+        return _iter_vis_json(_json_strings(self.strings), {**self.columns, **self._position_columns(positions)}, chunk_bytes)
+
+    def _position_columns(self, positions):
+        positions = positions or {}
+        ids = self.node_ids()
+        return {
+            "node.x": array("d", (positions[n]["x"] if n in positions else math.nan for n in ids)),
+            "node.y": array("d", (positions[n]["y"] if n in positions else math.nan for n in ids)),
+        }
+
+    def pack(self, positions=None):
+        """The graph and node positions (keyed by node ID) as one compressed pack_graph blob."""
+        columns = {}
+        for field in ENTITY_FIELDS:
+            columns[f"node.{field}"] = self.columns[f"node.{field}"]
+        columns.update(self._position_columns(positions))
+        for field in RELATIONSHIP_FIELDS:
+            columns[f"edge.{field}"] = self.columns[f"edge.{field}"]
+
+        sections = [("strings", b"\n".join(_json_strings(self.strings)))]
+        sections += [(name, _le_bytes(values)) for name, values in columns.items()]
+        header = json.dumps({
+            "nodes": self.node_count,
+            "edges": self.edge_count,
+            "strings": len(self.strings),
+            "sections": [[name, len(payload)] for name, payload in sections],
+        }).encode("utf-8")
+        body = struct.pack("<I", len(header)) + header + b"".join(payload for _, payload in sections)
+        return MAGIC + zlib.compress(body, COMPRESSION_LEVEL)
+
+
+def pack_graph(data, positions=None):
+    """Packs entity-relationship data (a dict or a RelationGraph) and node positions into one compressed blob.
+
+    Strings are interned once, already JSON-encoded, so the vis.js payload can
+    be written by concatenation. Entities and relationships are stored as
+    columns of string indexes (``subject_id``/``object_id`` as node indexes)
+    and node positions as float columns. The layout is described by a small
+    JSON header and the whole body is zlib-compressed.
+    """
+    graph = data if isinstance(data, RelationGraph) else RelationGraph(data)
+    return graph.pack(positions)
+
+
+class PackedGraph:
+    """Read access to a blob written by pack_graph."""
+
+    def __init__(self, blob):
+        if bytes(blob[:len(MAGIC)]) != MAGIC:
+            raise ValueError("Not a packed graph")
+        body = memoryview(zlib.decompress(blob[len(MAGIC):]))
+        header_length = struct.unpack_from("<I", body)[0]
+        header = json.loads(bytes(body[4:4 + header_length]))
+        self.node_count = header["nodes"]
+        self.edge_count = header["edges"]
+
+        offset = 4 + header_length
+        self.columns = {}
+        for name, length in header["sections"]:
+            payload = body[offset:offset + length]
+            offset += length
+            if name == "strings":
+                # Encoded JSON strings never contain a raw newline
+                self.strings = bytes(payload).split(b"\n") if header["strings"] else []
+            else:
+                self.columns[name] = _le_array("d" if name in ("node.x", "node.y") else "I", payload)
+
+    def relationships(self):
+        """The entity-relationship data as a dict, as it was packed."""
+        values = json.loads(b"[" + b",".join(self.strings) + b"]")
+        node_ids = [values[i] for i in self.columns["node.id"]]
+        entities = [
+            {field: values[i] for field, i in zip(ENTITY_FIELDS, row)}
+            for row in zip(*(self.columns[f"node.{field}"] for field in ENTITY_FIELDS))
+        ]
+        relationships = []
+        for row in zip(*(self.columns[f"edge.{field}"] for field in RELATIONSHIP_FIELDS)):
+            relationships.append({
+                field: node_ids[i] if field in NODE_REFERENCE_FIELDS else values[i]
+                for field, i in zip(RELATIONSHIP_FIELDS, row)
+            })
+        return {"entities": entities, "relationships": relationships}
+
+    def relationships_json(self):
+        return json.dumps(self.relationships(), ensure_ascii=False)
+
+    def iter_vis_json(self, chunk_bytes=STREAM_CHUNK_BYTES):
+        """Yields the vis.js ``{"tooltip_fields", "nodes", "edges"}`` payload as UTF-8 JSON chunks.
+
+        Nodes carry their stored position; every relationship is an edge, in
+        the order it was packed. The stored strings are spliced in as they
+        are, so nothing is decoded or re-encoded.
+        """
+        return _iter_vis_json(self.strings, self.columns, chunk_bytes)
+
+
+def stored_relationships(graph_entry, version):
+    """Entity-relationship JSON of the "old" or "new" side of an EntityGraph row, or None."""
+    packed = getattr(graph_entry, f"{version}_packed")
+    if packed:
+        return PackedGraph(packed).relationships_json()
+    # Rows written before graphs were packed
+    return getattr(graph_entry, f"{version}_json")
+
+
+def iter_stored_vis_json(graph_entry, version):
+    """Streams the vis.js payload of one side of an EntityGraph row without re-encoding it."""
+    packed = getattr(graph_entry, f"{version}_packed")
+    if packed:
+        return PackedGraph(packed).iter_vis_json()
+    return iter([(getattr(graph_entry, f"graph_{version}") or "{}").encode("utf-8")])
@@ -0,0 +1,119 @@
+import os
+import gzip
+import threading
+from collections import OrderedDict
+from flask import request, Response
+from werkzeug.http import is_resource_modified
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 7
+
+
+class PayloadCache:
+    """Thread-safe LRU of serialized response bodies, bounded by total bytes.
+
+    Keys start with the upload ID (or another scope such as "history") and
+    carry the row's version stamp, so a stale body is never served even by a
+    process that missed an invalidation. Each entry holds the identity body
+    plus any compressed variants built for it so far.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, encoding):
+        with self._lock:
+            variants = self._entries.get(key)
+            if variants is None:
+                return None
+            self._entries.move_to_end(key)
+            return variants.get(encoding)
+
+    def put(self, key, encoding, body):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            variants = self._entries.pop(key, {})
+            self.size -= len(variants.get(encoding, b""))
+            variants[encoding] = body
+            self._entries[key] = variants
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= sum(len(b) for b in evicted.values())
+
+    def invalidate(self, scope):
+        """Drops every entry whose key starts with ``scope``."""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == scope]:
+                self.size -= sum(len(b) for b in self._entries.pop(key).values())
+
+
+payload_cache = PayloadCache(int(os.getenv("PAYLOAD_CACHE_MAX_BYTES", 64 * 1024 * 1024)))
+
+
+def _choose_encoding():
+    if brotli is not None and request.accept_encodings["br"]:
+        return "br"
+    if request.accept_encodings["gzip"]:
+        return "gzip"
+    return "identity"
+
+
+def _compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def cached_response(key, etag, last_modified, build, mimetype="application/json"):
+    """Conditional, compressed response for a payload that only changes with its version stamp.
+
+    ``build()`` returns the body as bytes or str and is only called on a
+    cache miss. Clients revalidate every time (``no-cache``) and get a 304
+    when their ETag or Last-Modified still matches, without the body being
+    loaded at all.
+    """
+    encoding = _choose_encoding()
+    # Each encoding is a different representation, so it gets its own ETag
+    tag = etag if encoding == "identity" else f"{etag}-{encoding}"
+
+    response = Response(mimetype=mimetype)
+    response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    response.vary.add("Accept-Encoding")
+    # A client holding either representation may keep using it
+    for held in dict.fromkeys((tag, etag)):
+        if not is_resource_modified(request.environ, etag=held, last_modified=last_modified):
+            response.set_etag(held)
+            response.status_code = 304
+            return response
+
+    body = payload_cache.get(key, encoding)
+    if body is None:
+        raw = payload_cache.get(key, "identity")
+        if raw is None:
+            raw = build()
+            if isinstance(raw, str):
+                raw = raw.encode("utf-8")
+            payload_cache.put(key, "identity", raw)
+        if len(raw) < COMPRESS_MIN_BYTES:
+            encoding, body = "identity", raw
+        else:
+            body = raw if encoding == "identity" else _compress(raw, encoding)
+            payload_cache.put(key, encoding, body)
+
+    if encoding != "identity":
+        response.content_encoding = encoding
+    response.set_etag(tag if encoding != "identity" else etag)
+    response.set_data(body)
+    return response
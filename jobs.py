@@ -0,0 +1,244 @@
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from db_models import db, Job, HISTORY_COUNTER, bump_counter
+from tracing import trace
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_STATUSES = ("queued", "running")
+JOB_HEARTBEAT_SECONDS = float(os.getenv("JOB_HEARTBEAT_SECONDS", 15))
+# A queued or running job without a heartbeat for this long belongs to a process that is gone
+JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", 120))
+
+
+class JobQueue:
+    """Background job runner backed by the jobs table and a local thread pool.
+
+    Job state lives in the database so the web tier and the workers only share
+    the DB; no external broker is needed. Status updates go through their own
+    short transactions so they never interleave with the handler's session.
+
+    Once the queue is first used, a heartbeat thread stamps the jobs this
+    process holds. Jobs whose heartbeat stops, because their process crashed
+    or was restarted, are re-queued by whichever process notices first, so
+    recovery works the same under the dev server, gunicorn or a CLI run.
+    ``recover=False`` leaves other processes' jobs alone.
+    """
+
+    def __init__(self, app=None, max_workers=None, recover=True):
+        self.handlers = {}
+        self.app = None
+        self.executor = None
+        self.recover = recover
+        self.heartbeat_seconds = JOB_HEARTBEAT_SECONDS
+        self.stale_seconds = JOB_STALE_SECONDS
+        self._held = set()
+        self._lock = threading.Lock()
+        self._heartbeat = None
+        self._stopping = threading.Event()
+        if app is not None:
+            self.init_app(app, max_workers)
+
+    def init_app(self, app, max_workers=None):
+        self.app = app
+        workers = max_workers or app.config.get("JOB_WORKERS", 2)
+        self.heartbeat_seconds = app.config.get("JOB_HEARTBEAT_SECONDS", self.heartbeat_seconds)
+        self.stale_seconds = app.config.get("JOB_STALE_SECONDS", self.stale_seconds)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job-worker")
+
+    def handler(self, kind):
+        """Registers a function as the handler for jobs of the given kind.
+
+        Handlers are called as ``fn(upload_id, report)`` inside an app context,
+        where ``report(progress, stage)`` publishes progress to the job row. A
+        string return value is stored as the job's result path.
+        """
+        def decorator(fn):
+            self.handlers[kind] = fn
+            return fn
+        return decorator
+
+    def submit(self, kind, upload_id):
+        """Queues a job, reusing an already active job of the same kind for the upload."""
+        if kind not in self.handlers:
+            raise ValueError(f"No handler registered for job kind '{kind}'")
+        job = self.active_job(upload_id, kind)
+        if job:
+            return job
+        job = Job(upload_id=upload_id, kind=kind, status="queued", progress=0, heartbeat_at=datetime.utcnow())
+        db.session.add(job)
+        bump_counter(HISTORY_COUNTER)
+        db.session.commit()
+        self._enqueue(job.id)
+        return job
+
+    def active_job(self, upload_id, *kinds):
+        self.start()
+        query = Job.query.filter(Job.upload_id == upload_id, Job.status.in_(ACTIVE_STATUSES))
+        if kinds:
+            query = query.filter(Job.kind.in_(kinds))
+        return query.order_by(Job.id.desc()).first()
+
+    def latest_job(self, upload_id, *kinds):
+        self.start()
+        query = Job.query.filter_by(upload_id=upload_id)
+        if kinds:
+            query = query.filter(Job.kind.in_(kinds))
+        return query.order_by(Job.id.desc()).first()
+
+    def start(self):
+        """Starts the heartbeat thread and recovers stale jobs; later calls do nothing. Needs an app context."""
+        with self._lock:
+            if self._heartbeat is not None:
+                return
+            self._heartbeat = threading.Thread(target=self._heartbeat_loop, name="job-heartbeat", daemon=True)
+            self._heartbeat.start()
+        if self.recover:
+            self.recover_stale()
+
+    def recover_stale(self):
+        """Re-queues jobs left queued or running by a process that stopped sending heartbeats.
+
+        When several processes recover at once, each job goes to exactly one
+        of them. Returns the number of jobs this process took over.
+        """
+        cutoff = datetime.utcnow() - timedelta(seconds=self.stale_seconds)
+        # Rows written before heartbeats existed have none
+        stale = (Job.status.in_(ACTIVE_STATUSES), db.func.coalesce(Job.heartbeat_at, Job.created_at) < cutoff)
+        with db.engine.begin() as conn:
+            job_ids = conn.execute(db.select(Job.id).where(*stale).order_by(Job.id)).scalars().all()
+        recovered = 0
+        for job_id in job_ids:
+            with db.engine.begin() as conn:
+                result = conn.execute(
+                    db.update(Job)
+                    .where(Job.id == job_id, *stale)
+                    .values(status="queued", started_at=None, stage="Requeued", heartbeat_at=datetime.utcnow())
+                )
+                if result.rowcount == 1:
+                    bump_counter(HISTORY_COUNTER, conn)
+            if result.rowcount == 1:
+                self._enqueue(job_id)
+                recovered += 1
+        if recovered:
+            logger.warning("Re-queued %d jobs left behind by a stopped process", recovered)
+        return recovered
+
+    def abandon_active(self, upload_id, error):
+        """Marks an upload's jobs left queued or running by a process that died as failed."""
+        with db.engine.begin() as conn:
+            result = conn.execute(
+                db.update(Job)
+                .where(Job.upload_id == upload_id, Job.status.in_(ACTIVE_STATUSES))
+                .values(status="failed", error=error, finished_at=datetime.utcnow())
+            )
+            if result.rowcount:
+                bump_counter(HISTORY_COUNTER, conn)
+
+    def finished_jobs(self, job_ids):
+        """The jobs among ``job_ids`` that are no longer queued or running."""
+        if not job_ids:
+            return []
+        # Workers update jobs through their own connections
+        db.session.expire_all()
+        return Job.query.filter(Job.id.in_(job_ids), Job.status.notin_(ACTIVE_STATUSES)).order_by(Job.finished_at).all()
+
+    def shutdown(self, wait=True):
+        self._stopping.set()
+        if self.executor:
+            self.executor.shutdown(wait=wait)
+
+    def _enqueue(self, job_id):
+        with self._lock:
+            self._held.add(job_id)
+        self.executor.submit(self._run, job_id)
+
+    def _heartbeat_loop(self):
+        while not self._stopping.wait(self.heartbeat_seconds):
+            with self.app.app_context():
+                try:
+                    with self._lock:
+                        held = list(self._held)
+                    if held:
+                        with db.engine.begin() as conn:
+                            conn.execute(db.update(Job).where(Job.id.in_(held)).values(heartbeat_at=datetime.utcnow()))
+                    if self.recover:
+                        self.recover_stale()
+                except Exception:
+                    logger.exception("Job heartbeat failed")
+
+    def _update(self, job_id, **values):
+        with db.engine.begin() as conn:
+            conn.execute(db.update(Job).where(Job.id == job_id).values(**values))
+            # Progress alone does not change what /history shows
+            if "status" in values:
+                bump_counter(HISTORY_COUNTER, conn)
+
+    def _claim(self, job_id):
+        """Atomically moves a queued job to running; False if another worker took it."""
+        with db.engine.begin() as conn:
+            result = conn.execute(
+                db.update(Job)
+                .where(Job.id == job_id, Job.status == "queued")
+                .values(status="running", started_at=datetime.utcnow(), heartbeat_at=datetime.utcnow(), stage="Starting")
+            )
+            if result.rowcount == 1:
+                bump_counter(HISTORY_COUNTER, conn)
+        return result.rowcount == 1
+
+    def _run(self, job_id):
+        with self.app.app_context():
+            if not self._claim(job_id):
+                with self._lock:
+                    self._held.discard(job_id)
+                return
+            job = db.session.get(Job, job_id)
+            upload_id, kind = job.upload_id, job.kind
+            db.session.close()
+
+            def report(progress, stage):
+                self._update(job_id, progress=int(progress), stage=stage)
+
+            try:
+                with trace(upload_id, kind, job_id=job_id):
+                    try:
+                        result = self.handlers[kind](upload_id, report)
+                    except Exception:
+                        # Release the handler's transaction before the trace is written
+                        db.session.rollback()
+                        raise
+            except Exception as e:
+                db.session.rollback()
+                logger.exception("Job %s (%s for upload %s) failed", job_id, kind, upload_id)
+                self._update(job_id, status="failed", error=str(e), finished_at=datetime.utcnow())
+            else:
+                self._update(
+                    job_id,
+                    status="done",
+                    progress=100,
+                    stage="Done",
+                    result_path=result if isinstance(result, str) else None,
+                    finished_at=datetime.utcnow()
+                )
+            finally:
+                db.session.remove()
+                with self._lock:
+                    self._held.discard(job_id)
+
+
+def job_to_dict(job):
+    return {
+        "id": job.id,
+        "upload_id": job.upload_id,
+        "kind": job.kind,
+        "status": job.status,
+        "progress": job.progress,
+        "stage": job.stage,
+        "error": job.error,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "started_at": job.started_at.isoformat() if job.started_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
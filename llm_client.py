@@ -0,0 +1,427 @@
+import os
+import json
+import time
+import random
+import sqlite3
+import hashlib
+import logging
+import threading
+from types import SimpleNamespace
+from contextlib import closing
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+import google.auth.credentials
+from google.api_core import exceptions as api_exceptions
+import vertexai
+from vertexai.generative_models import GenerativeModel
+from utils import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+
+class WIFTokenCredentials(google.auth.credentials.Credentials):
+    """Access token read from the WIF token file, re-read when the file changes or the token ages out.
+
+    An external process rotates ``wif_token.txt``; google-auth calls
+    ``before_request`` on every API call, so long-lived clients pick up the new
+    token without being rebuilt.
+    """
+
+    def __init__(self, token_path, ttl):
+        super().__init__()
+        self.token_path = token_path
+        self.ttl = ttl
+        self._mtime = None
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        with open(self.token_path, "r") as f:
+            self.token = f.read().strip()
+        self._mtime = os.path.getmtime(self.token_path)
+        # google-auth compares expiry against naive UTC
+        self.expiry = datetime.utcnow() + timedelta(seconds=self.ttl)
+
+    def refresh(self, request):
+        with self._lock:
+            self._load()
+
+    def force_refresh(self):
+        self.refresh(None)
+
+    def before_request(self, request, method, url, headers):
+        try:
+            changed = os.path.getmtime(self.token_path) != self._mtime
+        except OSError:
+            changed = False
+        if changed:
+            self.refresh(request)
+        super().before_request(request, method, url, headers)
+
+
+class TokenBucket:
+    """Requests-per-minute limiter shared by every thread and process using the same SQLite file.
+
+    Bucket state is updated inside ``BEGIN IMMEDIATE`` transactions, so
+    concurrent gunicorn workers draw from one budget without a broker.
+    """
+
+    def __init__(self, path, rate_per_minute, burst):
+        self.path = path
+        self.rate = rate_per_minute / 60.0
+        self.burst = max(1, burst)
+        self._initialized = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        if not self._initialized:
+            conn.execute("CREATE TABLE IF NOT EXISTS token_bucket (id INTEGER PRIMARY KEY, tokens REAL, updated_at REAL)")
+            conn.execute(
+                "INSERT OR IGNORE INTO token_bucket (id, tokens, updated_at) VALUES (1, ?, ?)",
+                (float(self.burst), time.time())
+            )
+            self._initialized = True
+        return conn
+
+    def acquire(self, timeout=None):
+        """Blocks until a request token is available; False if ``timeout`` seconds pass first."""
+        if self.rate <= 0:
+            return True
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            with closing(self._connect()) as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                tokens, updated_at = conn.execute("SELECT tokens, updated_at FROM token_bucket WHERE id = 1").fetchone()
+                now = time.time()
+                tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+                granted = tokens >= 1
+                if granted:
+                    tokens -= 1
+                conn.execute("UPDATE token_bucket SET tokens = ?, updated_at = ? WHERE id = 1", (tokens, now))
+                conn.execute("COMMIT")
+            if granted:
+                return True
+            wait = (1 - tokens) / self.rate
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(wait)
+
+
+class LLMProvider:
+    """Backend behind the vertex_llm helpers.
+
+    ``generate`` returns an object with a ``text`` attribute, like a Vertex
+    ``GenerationResponse``, and a ``usage_metadata`` with token counts where
+    the backend reports them.
+    """
+
+    def init(self):
+        pass
+
+    def generate(self, model_name, prompt, generation_config):
+        raise NotImplementedError
+
+    def generate_stream(self, model_name, prompt, generation_config, on_usage=None):
+        """Yields the response text in pieces as it is produced; by default all at once.
+
+        ``on_usage(usage_metadata)`` is called whenever the backend reports
+        token counts; the last call carries the totals.
+        """
+        response = self.generate(model_name, prompt, generation_config)
+        if on_usage and getattr(response, "usage_metadata", None) is not None:
+            on_usage(response.usage_metadata)
+        yield response.text
+
+
+def _chunk_text(response):
+    # Stream chunks carrying only finish metadata have no text part
+    try:
+        return response.text
+    except ValueError:
+        return ""
+
+
+def prompt_key(prompt):
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+
+class LLMClient(LLMProvider):
+    """Process-wide Gemini client: warm model instances, refreshing credentials, rate limit, concurrency cap and deadlines."""
+
+    def __init__(self, max_concurrency=4, timeout=300.0, rate_limiter=None):
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.credentials = None
+        self._models = {}
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        # Timed-out calls keep running until the API returns, so leave room beyond the cap
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency * 2, thread_name_prefix="llm-call")
+
+    def init(self):
+        token_path = os.path.join(os.getenv("WIF_HOME"), "wif_token.txt")
+        self.credentials = WIFTokenCredentials(token_path, ttl=float(os.getenv("WIF_TOKEN_TTL", 3000)))
+        vertexai.init(project=os.getenv("PROJECT_NAME"), location=os.getenv("LOCATION"), credentials=self.credentials)
+        with self._lock:
+            self._models.clear()
+
+    def model(self, model_name):
+        with self._lock:
+            model = self._models.get(model_name)
+            if model is None:
+                model = self._models[model_name] = GenerativeModel(model_name)
+            return model
+
+    def generate(self, model_name, prompt, generation_config):
+        """Calls ``generate_content`` within the rate limit, concurrency cap and deadline.
+
+        Raises ``DeadlineExceeded`` when no slot, rate token or response arrives
+        in time. An ``Unauthenticated`` error re-reads the token file and
+        retries once.
+        """
+        try:
+            return self._generate_once(model_name, prompt, generation_config)
+        except api_exceptions.Unauthenticated:
+            if not self.credentials:
+                raise
+            logger.warning("Gemini rejected the access token; re-reading %s", self.credentials.token_path)
+            self.credentials.force_refresh()
+            return self._generate_once(model_name, prompt, generation_config)
+
+    def _generate_once(self, model_name, prompt, generation_config):
+        deadline = time.monotonic() + self.timeout
+        if self.rate_limiter and not self.rate_limiter.acquire(timeout=self.timeout):
+            raise api_exceptions.DeadlineExceeded("Timed out waiting for the LLM rate limit")
+        if not self._slots.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            raise api_exceptions.DeadlineExceeded("Timed out waiting for a free LLM call slot")
+
+        model = self.model(model_name)
+        try:
+            future = self._executor.submit(model.generate_content, prompt, generation_config=generation_config)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=max(0.0, deadline - time.monotonic()))
+        except FutureTimeout:
+            raise api_exceptions.DeadlineExceeded(f"LLM call exceeded {self.timeout:g}s deadline")
+
+    def generate_stream(self, model_name, prompt, generation_config, on_usage=None):
+        """Streams ``generate_content`` text chunks under the same limits as ``generate``.
+
+        The deadline covers the whole stream. An ``Unauthenticated`` error
+        before the first chunk re-reads the token file and retries once.
+        """
+        emitted = False
+        try:
+            for text in self._stream_once(model_name, prompt, generation_config, on_usage):
+                emitted = True
+                yield text
+        except api_exceptions.Unauthenticated:
+            if emitted or not self.credentials:
+                raise
+            logger.warning("Gemini rejected the access token; re-reading %s", self.credentials.token_path)
+            self.credentials.force_refresh()
+            yield from self._stream_once(model_name, prompt, generation_config, on_usage)
+
+    def _stream_once(self, model_name, prompt, generation_config, on_usage=None):
+        deadline = time.monotonic() + self.timeout
+        if self.rate_limiter and not self.rate_limiter.acquire(timeout=self.timeout):
+            raise api_exceptions.DeadlineExceeded("Timed out waiting for the LLM rate limit")
+        if not self._slots.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            raise api_exceptions.DeadlineExceeded("Timed out waiting for a free LLM call slot")
+
+        pending = None
+        try:
+            responses = iter(self.model(model_name).generate_content(prompt, generation_config=generation_config, stream=True))
+            while True:
+                # Read each chunk on the executor so a stalled stream cannot outlive the deadline
+                pending = self._executor.submit(next, responses, None)
+                try:
+                    response = pending.result(timeout=max(0.0, deadline - time.monotonic()))
+                except FutureTimeout:
+                    raise api_exceptions.DeadlineExceeded(f"LLM stream exceeded {self.timeout:g}s deadline")
+                pending = None
+                if response is None:
+                    return
+                if on_usage and getattr(response, "usage_metadata", None) is not None:
+                    on_usage(response.usage_metadata)
+                text = _chunk_text(response)
+                if text:
+                    yield text
+        finally:
+            # A chunk read still blocked on the API keeps its slot until it returns
+            if pending is not None and not pending.done():
+                pending.add_done_callback(lambda _: self._slots.release())
+            else:
+                self._slots.release()
+
+
+class ReplayProvider(LLMProvider):
+    """Offline stand-in for Gemini that replays recorded responses.
+
+    Responses are looked up by prompt hash in a JSONL recording (as written
+    by RecordingProvider). Unrecorded prompts raise ``KeyError`` when
+    ``strict``, otherwise they get a deterministic synthetic answer:
+    entity-relationship JSON when JSON is requested, otherwise text derived
+    from the prompt. ``latency`` (+ up to ``jitter``) seconds are
+    slept per call and ``failure_rate`` of calls raise ServiceUnavailable,
+    both drawn from a seeded RNG so runs are reproducible. Streamed answers
+    are cut into ``stream_chunk_chars`` pieces, ``chunk_delay`` seconds apart.
+    """
+
+    VERBS = ("Reports", "Notifies", "Submits", "Maintains", "Discloses", "Validates")
+    FREQUENCIES = ("daily", "weekly", "monthly", "quarterly", "annually")
+
+    def __init__(self, recordings_path=None, latency=0.0, jitter=0.0, failure_rate=0.0, seed=0, entities=12,
+                 stream_chunk_chars=80, chunk_delay=0.0, strict=False):
+        self.latency = latency
+        self.strict = strict
+        self.stream_chunk_chars = stream_chunk_chars
+        self.chunk_delay = chunk_delay
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.entities = entities
+        self.recordings = {}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        if recordings_path and os.path.exists(recordings_path):
+            with open(recordings_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        self.recordings[record["prompt_hash"]] = record["text"]
+
+    def generate(self, model_name, prompt, generation_config):
+        text = self._respond(prompt, generation_config)
+        return SimpleNamespace(text=text, usage_metadata=self._usage(prompt, text))
+
+    def generate_stream(self, model_name, prompt, generation_config, on_usage=None):
+        text = self._respond(prompt, generation_config)
+        size = self.stream_chunk_chars
+        for start in range(0, len(text), size):
+            if start and self.chunk_delay:
+                time.sleep(self.chunk_delay)
+            yield text[start:start + size]
+        if on_usage:
+            on_usage(self._usage(prompt, text))
+
+    @staticmethod
+    def _usage(prompt, text):
+        # Estimated like the prompt budgets, so replayed runs still report token counts
+        prompt_tokens, response_tokens = estimate_tokens(prompt), estimate_tokens(text)
+        return SimpleNamespace(prompt_token_count=prompt_tokens, candidates_token_count=response_tokens,
+                               total_token_count=prompt_tokens + response_tokens)
+
+    def _respond(self, prompt, generation_config):
+        with self._lock:
+            delay = self.latency + self._rng.random() * self.jitter
+            fail = self._rng.random() < self.failure_rate
+        if delay:
+            time.sleep(delay)
+        if fail:
+            raise api_exceptions.ServiceUnavailable("Injected failure from ReplayProvider")
+
+        key = prompt_key(prompt)
+        text = self.recordings.get(key)
+        if text is None:
+            if self.strict:
+                raise KeyError(f"No recorded response for prompt {key[:12]}")
+            wants_json = "response_schema" in (generation_config or {}) or "valid JSON" in prompt
+            text = self._synthetic_json(key) if wants_json else self._synthetic_text(prompt, key)
+        return text
+
+    def _synthetic_text(self, prompt, key):
+        words = prompt.split()
+        return f"Synthetic summary {key[:8]} ({len(words)} words): " + " ".join(words[-200:])
+
+    def _synthetic_json(self, key):
+        rng = random.Random(key)
+        entities = [
+            {"id": f"E{i}", "name": f"Entity {i}", "type": rng.choice(("organization", "report", "threshold", "customer"))}
+            for i in range(1, self.entities + 1)
+        ]
+        relationships = []
+        for entity in entities[1:]:
+            relationships.append({
+                "subject_id": "E1",
+                "subject_name": entities[0]["name"],
+                "verb": rng.choice(self.VERBS),
+                "object_id": entity["id"],
+                "object_name": entity["name"],
+                "Optionality": rng.choice(("Mandatory", "Conditional")),
+                "Condition for Relationship to be Active": f"Exposure above LKR {rng.randint(1, 50)} million",
+                "Property of Object (part of condition)": "Amount, Currency",
+                "Thresholds": f"LKR {rng.randint(1, 50)} million",
+                "frequency": f"to be validated {rng.choice(self.FREQUENCIES)}",
+            })
+        return json.dumps({"entities": entities, "relationships": relationships})
+
+
+class RecordingProvider(LLMProvider):
+    """Wraps another provider and appends every prompt hash and response to a JSONL file for ReplayProvider."""
+
+    def __init__(self, inner, path):
+        self.inner = inner
+        self.path = path
+        self._lock = threading.Lock()
+
+    def init(self):
+        self.inner.init()
+
+    def generate(self, model_name, prompt, generation_config):
+        response = self.inner.generate(model_name, prompt, generation_config)
+        self._write(model_name, prompt, response.text)
+        return response
+
+    def generate_stream(self, model_name, prompt, generation_config, on_usage=None):
+        parts = []
+        for text in self.inner.generate_stream(model_name, prompt, generation_config, on_usage):
+            parts.append(text)
+            yield text
+        self._write(model_name, prompt, "".join(parts))
+
+    def _write(self, model_name, prompt, text):
+        record = {"prompt_hash": prompt_key(prompt), "model": model_name, "text": text}
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+def create_provider():
+    """Builds the provider selected by LLM_PROVIDER ("vertex", the default, or "replay")."""
+    name = os.getenv("LLM_PROVIDER", "vertex")
+    if name == "replay":
+        provider = ReplayProvider(
+            recordings_path=os.getenv("LLM_REPLAY_PATH"),
+            latency=float(os.getenv("LLM_REPLAY_LATENCY", 0)),
+            jitter=float(os.getenv("LLM_REPLAY_JITTER", 0)),
+            failure_rate=float(os.getenv("LLM_REPLAY_FAILURE_RATE", 0)),
+            seed=int(os.getenv("LLM_REPLAY_SEED", 0)),
+            entities=int(os.getenv("LLM_REPLAY_ENTITIES", 12)),
+            stream_chunk_chars=int(os.getenv("LLM_REPLAY_STREAM_CHUNK_CHARS", 80)),
+            chunk_delay=float(os.getenv("LLM_REPLAY_CHUNK_DELAY", 0)),
+            strict=os.getenv("LLM_REPLAY_STRICT", "0") == "1"
+        )
+    elif name == "vertex":
+        provider = LLMClient(
+            max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", 4)),
+            timeout=float(os.getenv("LLM_CALL_TIMEOUT", 300)),
+            rate_limiter=TokenBucket(
+                os.getenv("LLM_RATE_LIMIT_PATH", "llm_rate_limit.db"),
+                rate_per_minute=float(os.getenv("LLM_RATE_LIMIT_RPM", 60)),
+                burst=int(os.getenv("LLM_RATE_LIMIT_BURST", 10))
+            )
+        )
+    else:
+        raise ValueError(f"Unknown LLM_PROVIDER '{name}'")
+
+    if os.getenv("LLM_RECORD_PATH"):
+        provider = RecordingProvider(provider, os.getenv("LLM_RECORD_PATH"))
+    return provider
+
+
+llm_client = create_provider()
@@ -0,0 +1,242 @@
+import re
+import logging
+from sqlalchemy.exc import OperationalError
+from db_models import db, Regulation, Upload, Obligation
+from timeline import latest_version_upload_ids
+
+logger = logging.getLogger(__name__)
+
+FTS_TABLE = "obligations_fts"
+SEARCH_PAGE_SIZE = 50
+SEARCH_MAX_PAGE_SIZE = 500
+
+# Relationship fields copied onto obligation rows, by column
+OBLIGATION_FIELDS = {
+    "subject_id": "subject_id",
+    "subject_name": "subject_name",
+    "verb": "verb",
+    "object_id": "object_id",
+    "object_name": "object_name",
+    "optionality": "Optionality",
+    "condition": "Condition for Relationship to be Active",
+    "property": "Property of Object (part of condition)",
+    "thresholds": "Thresholds",
+    "frequency": "frequency",
+}
+SEARCH_TEXT_COLUMNS = ("subject_name", "verb", "object_name", "optionality", "condition", "property", "thresholds", "frequency")
+
+# Checked in order, so semi-annual wins over annual
+PERIODS = (
+    ("daily", re.compile(r"\bdaily\b|\b(?:every|each) (?:business |working )?day\b")),
+    ("weekly", re.compile(r"\bweekly\b|\b(?:every|each) week\b")),
+    ("monthly", re.compile(r"\bmonthly\b|\b(?:every|each) month\b")),
+    ("quarterly", re.compile(r"\bquarterly\b|\b(?:every|each) quarter\b")),
+    ("semi-annual", re.compile(r"\bsemi-?annual(?:ly)?\b|\bhalf-?yearly\b|\bbi-?annual(?:ly)?\b")),
+    ("annual", re.compile(r"\bannual(?:ly)?\b|\byearly\b|\b(?:every|each) year\b")),
+)
+PERIOD_NAMES = tuple(name for name, _ in PERIODS)
+
+# ISO 4217 codes recognized as currencies; any other three capitals ("ECB", "CET") are not money
+CURRENCY_CODES = (
+    "AED", "AUD", "BDT", "BRL", "CAD", "CHF", "CNY", "CZK", "DKK", "EUR", "GBP", "HKD", "HUF", "IDR", "INR", "JPY",
+    "KRW", "LKR", "MVR", "MXN", "MYR", "NOK", "NPR", "NZD", "PHP", "PKR", "PLN", "QAR", "RON", "SAR", "SEK", "SGD",
+    "THB", "TRY", "TWD", "USD", "ZAR",
+)
+_CURRENCY_CODE = r"\b(?:" + "|".join(CURRENCY_CODES) + r")\b"
+_AMOUNT = re.compile(
+    rf"(?P<currency>{_CURRENCY_CODE}|[€$£])?\s*(?P<number>\d[\d,]*(?:\.\d+)?)\s*"
+    rf"(?P<scale>(?i:thousand|million|billion|mn|bn|k|m|b)\b)?\s*(?P<suffix>%|{_CURRENCY_CODE})?"
+)
+CURRENCY_SYMBOLS = {"€": "EUR", "$": "USD", "£": "GBP"}
+AMOUNT_SCALES = {"thousand": 1e3, "k": 1e3, "million": 1e6, "mn": 1e6, "m": 1e6, "billion": 1e9, "bn": 1e9, "b": 1e9}
+# Abbreviated scales are also article letters ("Article 10 b)") and units ("5 m"), so
+# without a currency only a spelled-out scale makes a number an amount
+SCALE_WORDS = ("thousand", "million", "billion")
+_SEARCH_TOKEN = re.compile(r"\w+")
+
+
+def parse_period(*texts):
+    """The normalized reporting period named in any of the texts, e.g. "quarterly", or None."""
+    text = " ".join(t for t in texts if t).lower()
+    return next((name for name, pattern in PERIODS if pattern.search(text)), None)
+
+
+def parse_amount(text):
+    """The first money amount in ``text`` as ``(value, currency)``, e.g. "LKR 10 million" -> (1e7, "LKR").
+
+    Numbers without a currency or a spelled-out scale word (days,
+    percentages, article numbers and letters, lengths in "m") are not
+    amounts, and only ISO 4217 codes in CURRENCY_CODES count as currencies;
+    ``(None, None)`` when there is none.
+    """
+    for match in _AMOUNT.finditer(text or ""):
+        currency, scale, suffix = match.group("currency"), match.group("scale"), match.group("suffix")
+        if suffix == "%":
+            continue
+        currency = currency or suffix
+        if not currency and (scale or "").lower() not in SCALE_WORDS:
+            continue
+        try:
+            value = float(match.group("number").replace(",", ""))
+        except ValueError:
+            continue
+        value *= AMOUNT_SCALES.get((scale or "").lower(), 1)
+        return value, CURRENCY_SYMBOLS.get(currency, currency)
+    return None, None
+
+
+def obligation_rows(upload_id, regulation_id, side, data):
+    """Obligation table rows (as dicts) for the relationships of one side of an upload."""
+    if not data:
+        return []
+    types = {entity["id"]: entity.get("type") for entity in data.get("entities", [])}
+    rows = []
+    for rel in data.get("relationships", []):
+        row = {column: (str(rel[field]) if rel.get(field) is not None else None) for column, field in OBLIGATION_FIELDS.items()}
+        amount, currency = parse_amount(row["thresholds"])
+        if amount is None:
+            amount, currency = parse_amount(row["condition"])
+        row.update(
+            upload_id=upload_id,
+            regulation_id=regulation_id,
+            side=side,
+            subject_type=types.get(rel.get("subject_id")),
+            object_type=types.get(rel.get("object_id")),
+            period=parse_period(row["frequency"], row["condition"]),
+            threshold_amount=amount,
+            threshold_currency=currency,
+            search_text=" ".join(row[column] for column in SEARCH_TEXT_COLUMNS if row[column]).lower(),
+        )
+        rows.append(row)
+    return rows
+
+
+def _is_sqlite():
+    return db.engine.dialect.name == "sqlite"
+
+
+def ensure_fts():
+    """Creates the FTS5 index over obligation text when the database is SQLite with FTS5; True if it exists.
+
+    Without it, text search falls back to LIKE on ``search_text``.
+    """
+    if not _is_sqlite():
+        return False
+    try:
+        with db.engine.begin() as conn:
+            exists = conn.execute(db.text("SELECT 1 FROM sqlite_master WHERE name = :name"), {"name": FTS_TABLE}).first()
+            if not exists:
+                conn.execute(db.text(
+                    f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(search_text, content='obligations', content_rowid='id')"
+                ))
+                conn.execute(db.text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+    except OperationalError as e:
+        logger.warning("SQLite FTS5 unavailable, obligation search uses LIKE: %s", e)
+        return False
+    return True
+
+
+def fts_enabled():
+    if not _is_sqlite():
+        return False
+    return db.session.execute(
+        db.text("SELECT 1 FROM sqlite_master WHERE name = :name"), {"name": FTS_TABLE}
+    ).first() is not None
+
+
+def replace_obligations(upload_id, rows):
+    """Swaps an upload's obligation rows in the current transaction; the caller commits."""
+    fts = fts_enabled()
+    if fts:
+        # External-content FTS tables are told what to forget before the rows go
+        db.session.execute(db.text(
+            f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, search_text) "
+            "SELECT 'delete', id, search_text FROM obligations WHERE upload_id = :upload_id"
+        ), {"upload_id": upload_id})
+    db.session.query(Obligation).filter_by(upload_id=upload_id).delete()
+    if rows:
+        db.session.execute(db.insert(Obligation), rows)
+    if fts:
+        db.session.execute(db.text(
+            f"INSERT INTO {FTS_TABLE}(rowid, search_text) SELECT id, search_text FROM obligations WHERE upload_id = :upload_id"
+        ), {"upload_id": upload_id})
+
+
+def _fts_query(text):
+    # Every word must appear, as a prefix; quoting keeps FTS5 operators in the input literal
+    return " AND ".join(f'"{token}"*' for token in _SEARCH_TOKEN.findall(text.lower()))
+
+
+def search_obligations(q=None, regulation_ids=None, period=None, min_amount=None, max_amount=None, currency=None,
+                       side=None, latest=False, before=None, limit=SEARCH_PAGE_SIZE):
+    """One page of obligations across regulations and versions, most recently indexed first.
+
+    ``q`` matches words in the relationship text (all words, as prefixes).
+    ``latest`` keeps only the new side of each regulation's newest
+    whole-document version, as on its timeline; page-range uploads are left out.
+    ``before`` is the ID of the last row of the previous page. Returns
+    ``(rows, next_cursor)``; rows carry the regulation name and upload time.
+    """
+    query = db.session.query(Obligation, Regulation.name.label("regulation"), Upload.upload_time)
+    order = Obligation.id
+    if q and _SEARCH_TOKEN.search(q):
+        if fts_enabled():
+            # Driving the join from the FTS index in rowid order lets a page stop
+            # early instead of collecting every match of a common word first
+            fts = db.table(FTS_TABLE, db.column("rowid"))
+            query = (
+                query.select_from(fts)
+                .join(Obligation, Obligation.id == fts.c.rowid)
+                .filter(db.text(f"{FTS_TABLE} MATCH :match").bindparams(match=_fts_query(q)))
+            )
+            order = fts.c.rowid
+        else:
+            for token in _SEARCH_TOKEN.findall(q.lower()):
+                query = query.filter(Obligation.search_text.like(f"%{token}%"))
+    query = (
+        query.join(Regulation, Regulation.id == Obligation.regulation_id)
+        .join(Upload, Upload.id == Obligation.upload_id)
+    )
+    if regulation_ids:
+        query = query.filter(Obligation.regulation_id.in_(regulation_ids))
+    if period:
+        query = query.filter(Obligation.period == period)
+    if min_amount is not None:
+        query = query.filter(Obligation.threshold_amount >= min_amount)
+    if max_amount is not None:
+        query = query.filter(Obligation.threshold_amount <= max_amount)
+    if currency:
+        query = query.filter(Obligation.threshold_currency == currency.upper())
+    if latest:
+        # From the processed uploads, a far smaller table than the obligations
+        query = query.filter(Obligation.upload_id.in_(latest_version_upload_ids()), Obligation.side == "new")
+    elif side:
+        query = query.filter(Obligation.side == side)
+    if before:
+        query = query.filter(order < before)
+
+    rows = query.order_by(order.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1].Obligation.id
+    return rows, next_cursor
+
+
+def obligation_to_dict(row):
+    obligation = row.Obligation
+    result = {
+        "id": obligation.id,
+        "regulation": row.regulation,
+        "regulation_id": obligation.regulation_id,
+        "upload_id": obligation.upload_id,
+        "upload_time": row.upload_time.isoformat() if row.upload_time else None,
+        "side": obligation.side,
+        "subject_type": obligation.subject_type,
+        "object_type": obligation.object_type,
+        "period": obligation.period,
+        "threshold_amount": obligation.threshold_amount,
+        "threshold_currency": obligation.threshold_currency,
+    }
+    result.update({column: getattr(obligation, column) for column in OBLIGATION_FIELDS})
+    return result
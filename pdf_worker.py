@@ -0,0 +1,12 @@
+"""PDF page extraction run in the spawned worker processes of utils.iter_pdf_pages.
+
+Workers import this module to unpickle their task, so it imports nothing
+beyond PyMuPDF: no app, database or LLM setup runs in them.
+"""
+import fitz  # PyMuPDF
+
+
+def extract_pages(path, page_numbers):
+    """Opens the PDF independently and extracts the given pages as (page number, text) pairs."""
+    with fitz.open(path) as doc:
+        return [(n, doc[n].get_text()) for n in page_numbers]
@@ -0,0 +1,94 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import tracing
+
+
+class Stage:
+    """A pipeline step. ``fn`` is called with the results of ``deps`` as keyword arguments."""
+
+    def __init__(self, name, fn, deps=(), label=None):
+        self.name = name
+        self.fn = fn
+        self.deps = tuple(deps)
+        self.label = label or name
+
+
+class StageTiming:
+    def __init__(self, name, started, finished):
+        self.name = name
+        self.started = started
+        self.finished = finished
+
+    @property
+    def duration(self):
+        return self.finished - self.started
+
+    def to_dict(self):
+        return {"stage": self.name, "start": round(self.started, 3), "duration": round(self.duration, 3)}
+
+
+def run_stages(stages, max_workers=4, on_stage_done=None):
+    """Runs a DAG of stages on a thread pool, starting each one as soon as its deps finish.
+
+    Returns ``(results, timings)`` where ``results`` maps stage name to return
+    value and ``timings`` is a list of StageTiming with offsets relative to the
+    start of the run. ``on_stage_done(stage, done_count, total)`` is called from
+    the calling thread after every stage. The first stage failure cancels the
+    stages not yet started and is re-raised. Each stage is recorded as a
+    tracing span under the caller's current span.
+    """
+    by_name = {stage.name: stage for stage in stages}
+    for stage in stages:
+        missing = [dep for dep in stage.deps if dep not in by_name]
+        if missing:
+            raise ValueError(f"Stage '{stage.name}' depends on unknown stages {missing}")
+
+    results = {}
+    timings = []
+    pending = list(stages)
+    running = {}
+    t0 = time.perf_counter()
+
+    def timed(stage, kwargs):
+        started = time.perf_counter() - t0
+        with tracing.span(stage.name, label=stage.label):
+            value = stage.fn(**kwargs)
+        return value, StageTiming(stage.name, started, time.perf_counter() - t0)
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stage") as executor:
+        while pending or running:
+            ready = [stage for stage in pending if all(dep in results for dep in stage.deps)]
+            for stage in ready:
+                pending.remove(stage)
+                kwargs = {dep: results[dep] for dep in stage.deps}
+                running[tracing.submit(executor, timed, stage, kwargs)] = stage
+
+            if not running:
+                raise ValueError(f"Stages {[stage.name for stage in pending]} have cyclic dependencies")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    value, timing = future.result()
+                except Exception:
+                    for other in running:
+                        other.cancel()
+                    raise
+                results[stage.name] = value
+                timings.append(timing)
+                if on_stage_done:
+                    on_stage_done(stage, len(results), len(stages))
+
+    return results, timings
+
+
+def timing_summary(timings):
+    """Wall-clock time of a run next to the time the same stages would take back to back."""
+    wall = max((timing.finished for timing in timings), default=0.0)
+    serial = sum(timing.duration for timing in timings)
+    return {
+        "wall": round(wall, 3),
+        "serial": round(serial, 3),
+        "stages": [timing.to_dict() for timing in timings]
+    }
@@ -0,0 +1,82 @@
+import os
+import time
+import tempfile
+
+import fitz
+import pytest
+from flask import Flask
+
+# Read when llm_client and app_sqllite are first imported: an offline LLM and a scratch database
+_SCRATCH = tempfile.mkdtemp(prefix="regulation-tests-")
+os.environ.update(
+    LLM_PROVIDER="replay",
+    LLM_REPLAY_LATENCY="0",
+    LLM_REPLAY_FAILURE_RATE="0",
+    LLM_CACHE_PATH=os.path.join(_SCRATCH, "llm_cache.db"),
+    DATABASE_URL="sqlite:///" + os.path.join(_SCRATCH, "regulations.db"),
+)
+os.environ.pop("LLM_RECORD_PATH", None)
+os.environ.pop("LLM_REPLAY_PATH", None)
+
+from db_models import db, Upload, Job
+from obligation_index import FTS_TABLE
+
+
+@pytest.fixture
+def app(tmp_path):
+    """A bare Flask app bound to an empty SQLite database with every table created."""
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{tmp_path / 'test.db'}"
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+
+
+@pytest.fixture
+def web(monkeypatch):
+    """The application on a freshly initialized scratch database, with its job queue and an empty payload cache."""
+    import app_sqllite
+    import http_cache
+
+    cache = http_cache.PayloadCache(http_cache.payload_cache.max_bytes)
+    monkeypatch.setattr(http_cache, "payload_cache", cache)
+    monkeypatch.setattr(app_sqllite, "payload_cache", cache)
+    with app_sqllite.app.app_context():
+        db.drop_all()
+        db.session.execute(db.text(f"DROP TABLE IF EXISTS {FTS_TABLE}"))
+        db.session.commit()
+        app_sqllite.init_db()
+    yield app_sqllite.app
+    with app_sqllite.app.app_context():
+        db.session.remove()
+
+
+def make_pdf(path, pages):
+    """Writes a PDF with one page per text in ``pages``."""
+    doc = fitz.open()
+    for text in pages:
+        doc.new_page().insert_text((72, 72), text)
+    doc.save(str(path))
+    doc.close()
+    return str(path)
+
+
+def add_upload(regulation_id, new_path, old_path=None):
+    upload = Upload(regulation_id=regulation_id, new_path=new_path, old_path=old_path)
+    db.session.add(upload)
+    db.session.commit()
+    return upload.id
+
+
+def wait_for_job(job_id, timeout=30):
+    """The job once it has finished, polling the database like the compare page does."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        db.session.expire_all()
+        job = db.session.get(Job, job_id)
+        if job.status not in ("queued", "running"):
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f"Job {job_id} did not finish within {timeout}s")
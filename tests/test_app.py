@@ -0,0 +1,184 @@
+import json
+import threading
+from datetime import datetime
+
+from sqlalchemy import event
+from werkzeug.datastructures import MultiDict
+
+from db_models import db, Regulation, Upload, HISTORY_COUNTER, counter_value
+from conftest import make_pdf, add_upload, wait_for_job
+
+
+def _revalidate(client, url, etag):
+    return client.get(url, headers={"If-None-Match": f'"{etag}"'}).status_code
+
+
+def test_history_etag_follows_uploads_and_job_status_but_not_progress(web, tmp_path):
+    import app_sqllite
+
+    client = web.test_client()
+    with web.app_context():
+        etag = client.get("/history").get_etag()[0]
+        assert _revalidate(client, "/history", etag) == 304
+
+        upload_id = add_upload(Regulation.query.first().id, make_pdf(tmp_path / "new.pdf", ["Article 1 Banks shall report."]))
+        job = app_sqllite.job_queue.submit("process", upload_id)
+        assert _revalidate(client, "/history", etag) == 200
+        wait_for_job(job.id)
+
+        etag = client.get("/history").get_etag()[0]
+        before = counter_value(HISTORY_COUNTER)
+        app_sqllite.job_queue._update(job.id, progress=50, stage="Still going")
+        assert _revalidate(client, "/history", etag) == 304
+        app_sqllite.job_queue._update(job.id, status="failed", error="Stopped")
+        assert counter_value(HISTORY_COUNTER) == before + 1
+        assert _revalidate(client, "/history", etag) == 200
+
+
+def test_history_revalidation_only_reads_the_counter(web):
+    client = web.test_client()
+    statements, test_thread = [], threading.get_ident()
+
+    def record(conn, cursor, statement, *args):
+        # Job heartbeats run on their own thread
+        if threading.get_ident() == test_thread:
+            statements.append(statement)
+
+    with web.app_context():
+        etag = client.get("/history").get_etag()[0]
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            assert _revalidate(client, "/history", etag) == 304
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+    assert [statement for statement in statements if "FROM" in statement.upper()] == [
+        statement for statement in statements if "FROM counters" in statement]
+    assert statements
+
+
+def _processed_upload(tmp_path):
+    import app_sqllite
+
+    path = make_pdf(tmp_path / "new.pdf", ["Article 1 Scope\nBanks shall report their capital monthly.",
+                                           "Article 2 Fees\nA supervision fee applies."])
+    upload_id = add_upload(Regulation.query.first().id, path)
+    assert wait_for_job(app_sqllite.job_queue.submit("process", upload_id).id).status == "done"
+    return upload_id
+
+
+def test_approve_reuses_the_stored_kop_until_a_new_version_is_requested(web, tmp_path):
+    client = web.test_client()
+    with web.app_context():
+        upload_id = _processed_upload(tmp_path)
+
+        response = client.post(f"/approve/{upload_id}")
+        assert response.status_code == 202
+        assert wait_for_job(response.get_json()["id"]).status == "done"
+        [first] = client.get(f"/kop/{upload_id}/versions").get_json()
+
+        again = client.post(f"/approve/{upload_id}")
+        assert again.status_code == 200
+        assert again.get_json()["document"]["id"] == first["id"]
+        assert len(client.get(f"/kop/{upload_id}/versions").get_json()) == 1
+
+        response = client.post(f"/approve/{upload_id}?regenerate=1")
+        assert response.status_code == 202
+        assert wait_for_job(response.get_json()["id"]).status == "done"
+        versions = client.get(f"/kop/{upload_id}/versions").get_json()
+        assert [version["id"] for version in versions][1:] == [first["id"]]
+        assert versions[0]["id"] != first["id"]
+        # The latest version is the one downloaded
+        assert client.get(f"/kop/{upload_id}").get_etag()[0] == versions[0]["content_hash"]
+
+
+def test_history_pages_have_no_gaps_or_duplicates(web):
+    import app_sqllite
+
+    with web.app_context():
+        regulation_id = Regulation.query.first().id
+        times = [datetime(2024, 1, 1), datetime(2024, 1, 2), datetime(2024, 1, 2), datetime(2024, 1, 2),
+                 datetime(2024, 1, 3, 12, 30, 0, 500), datetime(2024, 1, 3, 12, 30, 0, 500), datetime(2024, 1, 4)]
+        for upload_time in times:
+            db.session.add(Upload(regulation_id=regulation_id, new_path="new.pdf", upload_time=upload_time))
+        db.session.commit()
+        expected = [upload.id for upload in
+                    Upload.query.order_by(Upload.upload_time.desc(), Upload.id.desc()).all()]
+
+        seen, cursor = [], None
+        while True:
+            args = MultiDict({"limit": "2", **({"before": cursor} if cursor else {})})
+            rows, cursor = app_sqllite.history_rows(**app_sqllite._parse_history_filters(args))
+            assert len(rows) <= 2
+            seen.extend(row.id for row in rows)
+            if len(seen) == 2:
+                # A newer upload arriving mid-scan does not shift later pages
+                db.session.add(Upload(regulation_id=regulation_id, new_path="late.pdf", upload_time=datetime(2025, 1, 1)))
+                db.session.commit()
+            if cursor is None:
+                break
+        assert seen == expected
+
+
+def _events(response):
+    """``(event, data)`` pairs of a server-sent event stream, checking each block's framing."""
+    body = response.get_data(as_text=True)
+    assert body.endswith("\n\n")
+    events = []
+    for block in body[:-2].split("\n\n"):
+        event_line, data_line = block.split("\n")
+        assert event_line.startswith("event: ") and data_line.startswith("data: ")
+        events.append((event_line[len("event: "):], json.loads(data_line[len("data: "):])))
+    return events
+
+
+def test_approve_stream_sends_chunks_then_the_stored_document(web, tmp_path):
+    client = web.test_client()
+    with web.app_context():
+        upload_id = _processed_upload(tmp_path)
+
+        # Bypasses the LLM cache so the answer streams in pieces
+        response = client.post(f"/approve/{upload_id}/stream?regenerate=1")
+        assert response.mimetype == "text/event-stream"
+        assert response.headers["Cache-Control"] == "no-cache"
+        events = _events(response)
+        names = [name for name, _ in events]
+        assert names[-1] == "done" and set(names[:-1]) == {"chunk"} and len(names) > 2
+        document = events[-1][1]["document"]
+        markdown = "".join(data["text"] for name, data in events if name == "chunk")
+
+        # The stored document is replayed as one chunk
+        assert _events(client.post(f"/approve/{upload_id}/stream")) == [
+            ("chunk", {"text": markdown}), ("done", {"document": document})]
+
+
+def test_approve_stream_ends_with_an_error_event(web, tmp_path, monkeypatch):
+    import app_sqllite
+
+    def failing_stream(*args, **kwargs):
+        yield "# Key Operating Procedure\n"
+        raise RuntimeError("model stream dropped")
+
+    client = web.test_client()
+    with web.app_context():
+        upload_id = _processed_upload(tmp_path)
+        monkeypatch.setattr(app_sqllite, "stream_kop_doc", failing_stream)
+        assert _events(client.post(f"/approve/{upload_id}/stream")) == [
+            ("chunk", {"text": "# Key Operating Procedure\n"}), ("error", {"error": "model stream dropped"})]
+        assert client.get(f"/kop/{upload_id}/versions").get_json() == []
+
+
+def test_only_runs_that_reuse_the_previous_upload_link_to_it(web, tmp_path):
+    import app_sqllite
+
+    with web.app_context():
+        first_id = _processed_upload(tmp_path)
+        first = db.session.get(Upload, first_id)
+        new_path = make_pdf(tmp_path / "newer.pdf", ["Article 1 Scope\nBanks shall report their capital quarterly."])
+        second_id = add_upload(first.regulation_id, new_path, old_path=first.new_path)
+
+        assert wait_for_job(app_sqllite.job_queue.submit("process", second_id).id).status == "done"
+        assert db.session.get(Upload, second_id).previous_upload_id == first_id
+
+        # A regenerate recomputes the old side instead of reusing the earlier upload
+        assert wait_for_job(app_sqllite.job_queue.submit("regenerate", second_id).id).status == "done"
+        assert db.session.get(Upload, second_id).previous_upload_id is None
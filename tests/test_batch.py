@@ -0,0 +1,29 @@
+from db_models import db, Regulation, Job
+from batch import load_manifest, run_batch, batch_summary
+
+
+def test_duplicate_rows_are_reported_not_lost(app, tmp_path):
+    db.session.add(Regulation(name="SFTR"))
+    db.session.commit()
+    for name in ("v1.pdf", "v2.pdf"):
+        (tmp_path / name).write_bytes(name.encode())
+    manifest = tmp_path / "manifest.csv"
+    manifest.write_text(
+        "regulation,old_path,new_path\n"
+        "SFTR,,v1.pdf\n"
+        "SFTR,v1.pdf,v2.pdf\n"
+        "SFTR,,v1.pdf\n"
+    )
+    processed = []
+    entries = load_manifest(str(manifest))
+    lines = []
+    wall = run_batch(app, {"process": lambda upload_id, report: processed.append(upload_id)}, entries,
+                     echo=lines.append, poll_interval=0.01)
+
+    assert [entry.status for entry in entries] == ["done", "done", "duplicate"]
+    assert entries[2].duplicate_of == 1
+    assert sorted(processed) == [entries[0].upload_id, entries[1].upload_id]
+    assert Job.query.count() == 2
+    summary = batch_summary(entries, wall)
+    assert (summary["done"], summary["duplicates"], summary["failed"]) == (2, 1, 0)
+    assert "Entry 3 repeats entry 1; ignoring it" in lines
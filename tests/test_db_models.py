@@ -0,0 +1,26 @@
+from flask import Flask
+
+from db_models import db, upgrade_schema
+
+
+def test_upgrade_schema_adds_missing_columns_and_is_repeatable(tmp_path):
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{tmp_path / 'old.db'}"
+    db.init_app(app)
+    with app.app_context():
+        with db.engine.begin() as conn:
+            conn.execute(db.text("CREATE TABLE regulations (id INTEGER PRIMARY KEY, name VARCHAR(255) UNIQUE NOT NULL)"))
+            conn.execute(db.text(
+                "CREATE TABLE entity_graphs (id INTEGER PRIMARY KEY, upload_id INTEGER NOT NULL, "
+                "old_json TEXT, new_json TEXT, graph_old TEXT, graph_new TEXT)"
+            ))
+            conn.execute(db.text("INSERT INTO entity_graphs (upload_id, new_json) VALUES (1, '{}')"))
+        db.create_all()
+        upgrade_schema()
+        upgrade_schema()
+
+        inspector = db.inspect(db.engine)
+        columns = {column["name"] for column in inspector.get_columns("entity_graphs")}
+        assert {"old_packed", "new_packed", "diff_json", "version", "updated_at"} <= columns
+        assert "ix_entity_graphs_upload_id" in {index["name"] for index in inspector.get_indexes("entity_graphs")}
+        assert db.session.execute(db.text("SELECT version FROM entity_graphs")).scalar() == 1
@@ -0,0 +1,57 @@
+import json
+
+import pytest
+
+from entity_schema import SchemaError, parse_json_response, validate_entity_relationships
+
+GRAPH = {
+    "entities": [{"id": "E1", "name": "Bank", "type": "Organization"}, {"id": "E2", "name": "CBSL", "type": "Regulator"}],
+    "relationships": [{"subject_id": "E1", "verb": "must report to", "object_id": "E2"}],
+}
+TEXT = json.dumps(GRAPH, indent=2)
+
+
+def test_parse_json_response_plain():
+    assert parse_json_response(TEXT) == (GRAPH, False)
+
+
+def test_parse_json_response_strips_fences_and_chatter():
+    assert parse_json_response(f"```json\n{TEXT}\n```") == (GRAPH, False)
+    assert parse_json_response(f"Here is the JSON:\n{TEXT}\nLet me know if you need more.") == (GRAPH, False)
+
+
+def test_parse_json_response_repairs_truncated_output():
+    # Cut off inside the second entity, as at the output token limit
+    cut = TEXT[:TEXT.index('"CBSL"')]
+    data, repaired = parse_json_response(cut)
+    assert repaired
+    assert data == {"entities": [GRAPH["entities"][0]]}
+
+
+def test_parse_json_response_repairs_fenced_output_cut_after_a_comma():
+    # A streamed response ends right after the first entity and its comma, with no closing fence
+    cut = "```json\n" + TEXT[:TEXT.index('{\n      "id": "E2"')]
+    assert cut.rstrip().endswith("},")
+    assert parse_json_response(cut) == ({"entities": [GRAPH["entities"][0]]}, True)
+
+
+@pytest.mark.parametrize("text", ["I cannot help with that.", '{"entities": [', ""])
+def test_parse_json_response_rejects_unrepairable_output(text):
+    with pytest.raises(SchemaError):
+        parse_json_response(text)
+
+
+def test_validate_entity_relationships_adds_referenced_entities():
+    data, repaired = validate_entity_relationships({
+        "entities": [],
+        "relationships": [{"subject_id": "E1", "subject_name": "Bank", "verb": "reports", "object_id": "E2"},
+                          {"subject_id": "E1", "verb": ""}],
+    })
+    assert repaired
+    assert [entity["name"] for entity in data["entities"]] == ["Bank", "E2"]
+    assert len(data["relationships"]) == 1
+
+
+def test_validate_entity_relationships_rejects_wrong_shape():
+    with pytest.raises(SchemaError):
+        validate_entity_relationships({"nodes": [], "edges": []})
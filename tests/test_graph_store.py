@@ -0,0 +1,112 @@
+import json
+
+import pytest
+
+from db_models import EntityGraph
+from graph_store import (TOOLTIP_ATTRS, RELATIONSHIP_FIELDS, RelationGraph, pack_graph, PackedGraph,
+                         stored_relationships, iter_stored_vis_json)
+
+GRAPH = {
+    "entities": [
+        {"id": "E1", "name": "Licensed bank", "type": "Organization"},
+        {"id": "E2", "name": "Central Bank of Sri Lanka", "type": "Regulator"},
+        {"id": "E3", "name": "Capital report \"Form A\"", "type": "Document"},
+    ],
+    "relationships": [
+        {"subject_id": "E1", "subject_name": "Licensed bank", "verb": "must submit", "object_id": "E3",
+         "object_name": "Capital report", "Optionality": "mandatory", "Condition for Relationship to be Active": "",
+         "Property of Object (part of condition)": "capital ratio", "Thresholds": "LKR 10 million",
+         "frequency": "quarterly"},
+        {"subject_id": "E3", "verb": "is sent to", "object_id": "E2", "frequency": "Überweisung\nnext line"},
+    ],
+}
+
+
+def _normalized(data):
+    # Packing stores every relationship field, empty when missing
+    return {
+        "entities": data["entities"],
+        "relationships": [{field: rel.get(field, "") for field in RELATIONSHIP_FIELDS} for rel in data["relationships"]],
+    }
+
+
+def test_pack_round_trip_keeps_entities_relationships_and_attributes():
+    graph = PackedGraph(pack_graph(GRAPH))
+    assert (graph.node_count, graph.edge_count) == (3, 2)
+    assert graph.relationships() == _normalized(GRAPH)
+    assert json.loads(graph.relationships_json()) == _normalized(GRAPH)
+
+
+def test_pack_adds_nodes_for_entities_only_named_in_relationships():
+    data = {"entities": [], "relationships": [{"subject_id": "E1", "verb": "reports to", "object_id": "E2"}]}
+    assert PackedGraph(pack_graph(data)).relationships()["entities"] == [
+        {"id": "E1", "name": "E1", "type": ""}, {"id": "E2", "name": "E2", "type": ""}]
+
+
+def test_packed_graph_rejects_other_blobs():
+    with pytest.raises(ValueError):
+        PackedGraph(b'{"entities": []}')
+
+
+@pytest.mark.parametrize("chunk_bytes", [1, 64 * 1024])
+def test_streamed_vis_payload_is_json_with_attrs_and_tooltip_fields(chunk_bytes):
+    positions = {"E1": {"x": 1.5, "y": -2.0}, "E2": {"x": 0.0, "y": 3.25}}
+    chunks = list(PackedGraph(pack_graph(GRAPH, positions)).iter_vis_json(chunk_bytes=chunk_bytes))
+    payload = json.loads(b"".join(chunks))
+
+    assert payload["tooltip_fields"] == [label for label, _ in TOOLTIP_ATTRS]
+    assert payload["nodes"][0] == {"id": "E1", "label": "Licensed bank", "group": "Organization", "x": 1.5, "y": -2.0}
+    # No stored position: the browser lays the node out
+    assert payload["nodes"][2] == {"id": "E3", "label": "Capital report \"Form A\"", "group": "Document"}
+    first, second = payload["edges"]
+    assert (first["id"], first["from"], first["to"], first["label"]) == (0, "E1", "E3", "must submit")
+    assert dict(zip(payload["tooltip_fields"], first["attrs"])) == {
+        label: GRAPH["relationships"][0][field] for label, field in TOOLTIP_ATTRS}
+    assert second["attrs"][-1] == "Überweisung\nnext line"
+
+
+def test_graphs_stored_before_packing_still_load():
+    vis = json.dumps({"nodes": [{"id": "E1"}], "edges": []})
+    entry = EntityGraph(new_json=json.dumps(GRAPH), graph_new=vis)
+    assert json.loads(stored_relationships(entry, "new")) == GRAPH
+    assert b"".join(iter_stored_vis_json(entry, "new")).decode("utf-8") == vis
+    assert stored_relationships(entry, "old") is None
+    assert json.loads(b"".join(iter_stored_vis_json(entry, "old"))) == {}
+
+
+def test_packed_rows_are_read_from_the_blob():
+    entry = EntityGraph(new_packed=pack_graph(GRAPH), new_json="stale", graph_new="stale")
+    assert json.loads(stored_relationships(entry, "new")) == _normalized(GRAPH)
+    assert len(json.loads(b"".join(iter_stored_vis_json(entry, "new")))["edges"]) == 2
+
+
+PARALLEL = {
+    "entities": [{"id": "E1", "name": "Bank", "type": "Organization"}, {"id": "E2", "name": "CBSL", "type": "Regulator"}],
+    "relationships": [
+        {"subject_id": "E1", "verb": "must report capital to", "object_id": "E2", "frequency": "monthly"},
+        {"subject_id": "E1", "verb": "must report liquidity to", "object_id": "E2", "frequency": "daily"},
+    ],
+}
+
+
+def test_relation_graph_keeps_parallel_relationships():
+    graph = RelationGraph(PARALLEL)
+    assert (graph.node_count, graph.edge_count) == (2, 2)
+    assert list(graph.columns["edge.subject_id"]) == [0, 0]
+    assert list(graph.columns["edge.object_id"]) == [1, 1]
+    assert [graph.strings[i] for i in graph.columns["edge.verb"]] == ["must report capital to", "must report liquidity to"]
+    # The networkx view is only for layout and collapses the pair
+    assert graph.to_networkx().number_of_edges() == 1
+
+    edges = json.loads(b"".join(graph.iter_vis_json()))["edges"]
+    assert [(edge["id"], edge["from"], edge["to"], edge["label"]) for edge in edges] == [
+        (0, "E1", "E2", "must report capital to"), (1, "E1", "E2", "must report liquidity to")]
+
+
+def test_relation_graph_columns_round_trip_through_a_pack():
+    graph = RelationGraph(PARALLEL)
+    packed = PackedGraph(pack_graph(graph))
+    assert packed.strings == [json.dumps(value, ensure_ascii=False).encode("utf-8") for value in graph.strings]
+    for name, column in graph.columns.items():
+        assert list(packed.columns[name]) == list(column), name
+    assert packed.relationships() == _normalized(PARALLEL)
@@ -0,0 +1,104 @@
+import gzip
+import json
+from datetime import datetime
+
+import pytest
+from flask import Flask
+
+import http_cache
+from http_cache import PayloadCache, cached_response
+from db_models import Regulation, EntityGraph
+from conftest import make_pdf, add_upload, wait_for_job
+
+BODY = json.dumps({"nodes": [{"id": f"E{i}", "label": "Licensed bank"} for i in range(100)]}).encode("utf-8")
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(http_cache, "payload_cache", PayloadCache(1024 * 1024))
+    app = Flask(__name__)
+    builds = []
+
+    @app.route("/payload/<int:version>")
+    def payload(version):
+        def build():
+            builds.append(version)
+            return BODY
+        return cached_response(("payload", version), f"payload-v{version}", datetime(2024, 1, 1), build)
+
+    client = app.test_client()
+    client.builds = builds
+    return client
+
+
+def test_etag_names_the_version(client):
+    response = client.get("/payload/1", headers={"Accept-Encoding": "identity"})
+    assert response.status_code == 200
+    assert response.get_etag() == ("payload-v1", False)
+    assert response.headers["Cache-Control"] == "no-cache"
+    assert response.data == BODY
+    assert client.get("/payload/2", headers={"Accept-Encoding": "identity"}).get_etag() == ("payload-v2", False)
+
+
+def test_if_none_match_gets_a_304_without_building_the_body(client):
+    client.get("/payload/1", headers={"Accept-Encoding": "identity"})
+    response = client.get("/payload/1", headers={"Accept-Encoding": "identity", "If-None-Match": '"payload-v1"'})
+    assert response.status_code == 304
+    assert response.data == b""
+    assert client.builds == [1]
+    assert client.get("/payload/1", headers={"If-None-Match": '"payload-v0"'}).status_code == 200
+
+
+def test_each_encoding_has_its_own_etag(client):
+    identity = client.get("/payload/1", headers={"Accept-Encoding": "identity"})
+    gzipped = client.get("/payload/1", headers={"Accept-Encoding": "gzip"})
+    assert gzipped.headers["Content-Encoding"] == "gzip"
+    assert gzipped.get_etag() == ("payload-v1-gzip", False)
+    assert gzip.decompress(gzipped.data) == identity.data
+    assert "Accept-Encoding" in gzipped.headers["Vary"]
+    # Both representations come from one build and revalidate with their own tag
+    assert client.builds == [1]
+    response = client.get("/payload/1", headers={"Accept-Encoding": "gzip", "If-None-Match": '"payload-v1-gzip"'})
+    assert response.status_code == 304
+
+
+def test_small_bodies_are_not_compressed(monkeypatch, client):
+    monkeypatch.setattr(http_cache, "COMPRESS_MIN_BYTES", len(BODY) + 1)
+    response = client.get("/payload/1", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in response.headers
+    assert response.get_etag() == ("payload-v1", False)
+
+
+def test_payload_cache_evicts_least_recently_used():
+    cache = PayloadCache(10)
+    cache.put((1, "graph"), "identity", b"aaaa")
+    cache.put((2, "graph"), "identity", b"bbbb")
+    assert cache.get((1, "graph"), "identity") == b"aaaa"
+    cache.put((3, "graph"), "identity", b"cccc")
+    assert cache.get((2, "graph"), "identity") is None
+    assert cache.size == 8
+    cache.invalidate(1)
+    assert cache.get((1, "graph"), "identity") is None
+    assert cache.size == 4
+
+
+def test_graph_etag_changes_after_regenerate(web, tmp_path):
+    client = web.test_client()
+    with web.app_context():
+        regulation_id = Regulation.query.first().id
+        upload_id = add_upload(regulation_id, make_pdf(tmp_path / "new.pdf", ["Article 1 Banks shall report monthly."]))
+        job_id = client.post(f"/regenerate/{upload_id}").get_json()["id"]
+        assert wait_for_job(job_id).status == "done"
+
+        first = client.get(f"/graph_data/{upload_id}/new")
+        assert first.status_code == 200
+        etag = first.get_etag()[0]
+        assert client.get(f"/graph_data/{upload_id}/new", headers={"If-None-Match": f'"{etag}"'}).status_code == 304
+
+        job_id = client.post(f"/regenerate/{upload_id}").get_json()["id"]
+        assert wait_for_job(job_id).status == "done"
+        second = client.get(f"/graph_data/{upload_id}/new", headers={"If-None-Match": f'"{etag}"'})
+        assert second.status_code == 200
+        assert second.get_etag()[0] != etag
+        assert EntityGraph.query.filter_by(upload_id=upload_id).one().version == 2
+
@@ -0,0 +1,74 @@
+import time
+import threading
+from datetime import datetime, timedelta
+
+from db_models import db, Job
+from jobs import JobQueue
+
+
+def _queue(app, recover=True):
+    app.config["JOB_HEARTBEAT_SECONDS"] = 0.05
+    app.config["JOB_STALE_SECONDS"] = 60
+    queue = JobQueue(app, max_workers=1, recover=recover)
+    queue.handlers["process"] = lambda upload_id, report: None
+    return queue
+
+
+def _add_job(status, heartbeat_age):
+    job = Job(upload_id=1, kind="process", status=status, progress=0,
+              heartbeat_at=datetime.utcnow() - timedelta(seconds=heartbeat_age))
+    db.session.add(job)
+    db.session.commit()
+    return job.id
+
+
+def _wait_for(job_id, status, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        db.session.expire_all()
+        if db.session.get(Job, job_id).status == status:
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_stale_jobs_are_requeued_on_first_use(app):
+    stale_id = _add_job("running", heartbeat_age=3600)
+    live_id = _add_job("running", heartbeat_age=0)
+    queue = _queue(app)
+    try:
+        queue.active_job(1, "process")
+        assert _wait_for(stale_id, "done")
+        assert db.session.get(Job, live_id).status == "running"
+    finally:
+        queue.shutdown()
+
+
+def test_recover_false_leaves_stale_jobs(app):
+    stale_id = _add_job("queued", heartbeat_age=3600)
+    queue = _queue(app, recover=False)
+    try:
+        queue.active_job(1, "process")
+        time.sleep(0.2)
+        db.session.expire_all()
+        assert db.session.get(Job, stale_id).status == "queued"
+    finally:
+        queue.shutdown()
+
+
+def test_heartbeat_keeps_held_jobs_fresh(app):
+    queue = _queue(app)
+    release = threading.Event()
+    queue.handlers["process"] = lambda upload_id, report: release.wait(5)
+    try:
+        job = queue.submit("process", 1)
+        assert _wait_for(job.id, "running")
+        first = db.session.get(Job, job.id).heartbeat_at
+        time.sleep(0.2)
+        db.session.expire_all()
+        assert db.session.get(Job, job.id).heartbeat_at > first
+        release.set()
+        assert _wait_for(job.id, "done")
+    finally:
+        release.set()
+        queue.shutdown()
@@ -0,0 +1,201 @@
+import os
+import json
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from types import SimpleNamespace
+
+import pytest
+from google.api_core import exceptions as api_exceptions
+
+from llm_client import WIFTokenCredentials, TokenBucket, LLMClient, LLMProvider, ReplayProvider, RecordingProvider
+
+
+def _age_bucket(path, seconds):
+    # Stands in for time passing since the last grant
+    with closing(sqlite3.connect(path)) as conn, conn:
+        conn.execute("UPDATE token_bucket SET updated_at = updated_at - ?", (seconds,))
+
+
+def test_token_bucket_refills_at_the_rate_up_to_the_burst(tmp_path):
+    path = str(tmp_path / "bucket.db")
+    bucket = TokenBucket(path, rate_per_minute=60, burst=2)
+    assert bucket.acquire(timeout=0) and bucket.acquire(timeout=0)
+    assert not bucket.acquire(timeout=0)
+
+    _age_bucket(path, 1)
+    assert bucket.acquire(timeout=0)
+    assert not bucket.acquire(timeout=0)
+
+    # A long idle spell refills only to the burst
+    _age_bucket(path, 3600)
+    assert bucket.acquire(timeout=0) and bucket.acquire(timeout=0)
+    assert not bucket.acquire(timeout=0)
+
+
+def test_token_bucket_budget_is_shared_through_the_file(tmp_path):
+    path = str(tmp_path / "bucket.db")
+    assert TokenBucket(path, rate_per_minute=60, burst=1).acquire(timeout=0)
+    # Another worker process opens the same file
+    assert not TokenBucket(path, rate_per_minute=60, burst=1).acquire(timeout=0.05)
+
+
+def test_token_bucket_makes_contending_threads_wait_for_the_rate(tmp_path):
+    bucket = TokenBucket(str(tmp_path / "bucket.db"), rate_per_minute=3000, burst=1)
+    results, lock = [], threading.Lock()
+
+    def worker():
+        for _ in range(5):
+            granted = bucket.acquire(timeout=10)
+            with lock:
+                results.append(granted)
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # 20 grants at 50 per second after the single burst token
+    assert results == [True] * 20
+    assert time.monotonic() - started >= 19 / 50 * 0.9
+
+
+def test_wif_credentials_reread_the_token_file_when_it_changes(tmp_path):
+    path = tmp_path / "wif_token.txt"
+    path.write_text("first-token\n")
+    credentials = WIFTokenCredentials(str(path), ttl=3000)
+    headers = {}
+    credentials.before_request(None, "POST", "https://example.invalid", headers)
+    assert headers["authorization"] == "Bearer first-token"
+    assert credentials.valid
+
+    # Same mtime: the cached token is kept
+    mtime = os.path.getmtime(path)
+    path.write_text("second-token\n")
+    os.utime(path, (mtime, mtime))
+    credentials.before_request(None, "POST", "https://example.invalid", headers)
+    assert headers["authorization"] == "Bearer first-token"
+
+    os.utime(path, (mtime + 10, mtime + 10))
+    credentials.before_request(None, "POST", "https://example.invalid", headers)
+    assert headers["authorization"] == "Bearer second-token"
+
+
+def test_wif_credentials_reload_once_the_token_ages_out(tmp_path):
+    path = tmp_path / "wif_token.txt"
+    path.write_text("first-token")
+    credentials = WIFTokenCredentials(str(path), ttl=0)
+    assert not credentials.valid
+    mtime = os.path.getmtime(path)
+    path.write_text("second-token")
+    os.utime(path, (mtime, mtime))
+    headers = {}
+    credentials.before_request(None, "POST", "https://example.invalid", headers)
+    assert headers["authorization"] == "Bearer second-token"
+
+
+class StalledModel:
+    """A model whose calls block until released."""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.calls = 0
+
+    def generate_content(self, prompt, generation_config=None):
+        self.calls += 1
+        self.release.wait(10)
+        return SimpleNamespace(text=f"answer to {prompt}")
+
+
+@pytest.fixture
+def stalled(monkeypatch):
+    client = LLMClient(max_concurrency=1, timeout=0.2)
+    model = StalledModel()
+    monkeypatch.setattr(client, "model", lambda model_name: model)
+    yield client, model
+    model.release.set()
+    client._executor.shutdown(wait=True)
+
+
+def test_llm_client_raises_deadline_exceeded_and_holds_the_slot_until_the_call_returns(stalled):
+    client, model = stalled
+    started = time.monotonic()
+    with pytest.raises(api_exceptions.DeadlineExceeded, match="deadline"):
+        client.generate("gemini", "first", None)
+    assert time.monotonic() - started < 2
+
+    # The timed-out call is still running, so the only slot is taken
+    with pytest.raises(api_exceptions.DeadlineExceeded, match="free LLM call slot"):
+        client.generate("gemini", "second", None)
+    assert model.calls == 1
+
+    model.release.set()
+    deadline = time.monotonic() + 5
+    while not client._slots.acquire(timeout=0.05):
+        assert time.monotonic() < deadline
+    client._slots.release()
+    assert client.generate("gemini", "third", None).text == "answer to third"
+
+
+def test_llm_client_gives_up_when_the_rate_limit_does_not_grant_in_time(stalled):
+    client, model = stalled
+    client.rate_limiter = SimpleNamespace(acquire=lambda timeout: False)
+    with pytest.raises(api_exceptions.DeadlineExceeded, match="rate limit"):
+        client.generate("gemini", "first", None)
+    assert model.calls == 0
+
+
+def test_llm_client_rereads_the_token_once_when_rejected(tmp_path, monkeypatch):
+    path = tmp_path / "wif_token.txt"
+    path.write_text("stale-token")
+    client = LLMClient(max_concurrency=1, timeout=5)
+    client.credentials = WIFTokenCredentials(str(path), ttl=3000)
+    attempts = []
+
+    def generate_content(prompt, generation_config=None):
+        attempts.append(client.credentials.token)
+        if len(attempts) == 1:
+            path.write_text("fresh-token")
+            raise api_exceptions.Unauthenticated("expired")
+        return SimpleNamespace(text="ok")
+
+    monkeypatch.setattr(client, "model", lambda model_name: SimpleNamespace(generate_content=generate_content))
+    assert client.generate("gemini", "prompt", None).text == "ok"
+    assert attempts == ["stale-token", "fresh-token"]
+    client._executor.shutdown(wait=True)
+
+
+class ScriptedProvider(LLMProvider):
+    def generate(self, model_name, prompt, generation_config):
+        return SimpleNamespace(text=f"{model_name} says {prompt[::-1]}")
+
+
+def test_recorded_responses_are_replayed(tmp_path):
+    path = str(tmp_path / "recording.jsonl")
+    recorder = RecordingProvider(ScriptedProvider(), path)
+    assert recorder.generate("gemini", "summarize", None).text == "gemini says ezirammus"
+    assert "".join(recorder.generate_stream("gemini", "compare", None)) == "gemini says erapmoc"
+    with open(path, encoding="utf-8") as f:
+        assert [json.loads(line)["model"] for line in f] == ["gemini", "gemini"]
+
+    replay = ReplayProvider(path, strict=True, stream_chunk_chars=4)
+    assert replay.generate("other-model", "summarize", None).text == "gemini says ezirammus"
+    chunks = list(replay.generate_stream("gemini", "compare", None))
+    assert len(chunks) > 1 and "".join(chunks) == "gemini says erapmoc"
+
+
+def test_strict_replay_raises_for_unrecorded_prompts(tmp_path):
+    replay = ReplayProvider(str(tmp_path / "missing.jsonl"), strict=True)
+    with pytest.raises(KeyError, match="No recorded response"):
+        replay.generate("gemini", "never recorded", None)
+    with pytest.raises(KeyError):
+        list(replay.generate_stream("gemini", "never recorded", None))
+
+
+def test_lenient_replay_synthesizes_deterministic_answers():
+    first, second = ReplayProvider(), ReplayProvider()
+    prompt = "Return valid JSON with the entities"
+    assert first.generate("gemini", prompt, None).text == second.generate("gemini", prompt, None).text
+    assert len(json.loads(first.generate("gemini", prompt, None).text)["entities"]) == 12
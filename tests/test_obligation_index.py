@@ -0,0 +1,82 @@
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from db_models import db, Regulation, Upload, EntityGraph
+from obligation_index import parse_amount, parse_period, obligation_rows, replace_obligations, search_obligations
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("LKR 10 million", (1e7, "LKR")),
+    ("Exposure above LKR 41 million", (41e6, "LKR")),
+    ("€2.5bn", (2.5e9, "EUR")),
+    ("10,000 USD", (10000.0, "USD")),
+    ("USD 1.5 million or 5% of capital", (1.5e6, "USD")),
+    ("a million customers", (None, None)),
+    ("LKR 5 m", (5e6, "LKR")),
+    ("see Article 10 b) for exposures above USD 2 million", (2e6, "USD")),
+])
+def test_parse_amount(text, expected):
+    assert parse_amount(text) == expected
+
+
+@pytest.mark.parametrize("text", [
+    "5% of capital",
+    "within 10 days",
+    "Article 9",
+    "Article 5 ECB",
+    "by 10 CET",
+    "see Article 10 b) of the Regulation",
+    "paragraph 3 b",
+    "under 5 m of the boundary",
+    "exposures over 50 mn",
+    "",
+    None,
+])
+def test_parse_amount_ignores_numbers_that_are_not_money(text):
+    assert parse_amount(text) == (None, None)
+
+
+def test_parse_amount_scale_without_currency():
+    assert parse_amount("exposures over 50 million") == (5e7, None)
+
+
+@pytest.mark.parametrize("texts, expected", [
+    (("to be validated quarterly",), "quarterly"),
+    (("semi-annually",), "semi-annual"),
+    (("half-yearly return",), "semi-annual"),
+    (("each year",), "annual"),
+    ((None, "every business day"), "daily"),
+    (("within 30 days",), None),
+])
+def test_parse_period(texts, expected):
+    assert parse_period(*texts) == expected
+
+
+def _upload(regulation_id, minutes, page_range=None, verb="must report to"):
+    upload = Upload(regulation_id=regulation_id, new_path="new.pdf", page_range=page_range,
+                    upload_time=datetime(2025, 1, 1) + timedelta(minutes=minutes))
+    db.session.add(upload)
+    db.session.commit()
+    data = {
+        "entities": [{"id": "E1", "name": "Licensed Bank", "type": "organization"},
+                     {"id": "E2", "name": "Central Bank", "type": "authority"}],
+        "relationships": [{"subject_id": "E1", "object_id": "E2", "verb": verb, "frequency": "quarterly"}],
+    }
+    db.session.add(EntityGraph(upload_id=upload.id, new_json=json.dumps(data)))
+    replace_obligations(upload.id, obligation_rows(upload.id, regulation_id, "new", data))
+    db.session.commit()
+    return upload.id
+
+
+def test_latest_uses_newest_whole_document_version(app):
+    db.session.add(Regulation(name="AWPR"))
+    db.session.commit()
+    whole = _upload(1, minutes=0, verb="must report to")
+    _upload(1, minutes=10, page_range="1-3", verb="must notify")
+    # Processed later but uploaded earlier, so it is not the newest version
+    _upload(1, minutes=-10, verb="must submit")
+
+    rows, _ = search_obligations(latest=True)
+    assert [(row.Obligation.upload_id, row.Obligation.verb) for row in rows] == [(whole, "must report to")]
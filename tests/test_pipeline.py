@@ -0,0 +1,60 @@
+import threading
+
+import pytest
+
+from pipeline import Stage, run_stages, timing_summary
+
+
+def test_stages_get_their_dependencies_results_in_order():
+    started, lock = [], threading.Lock()
+
+    def stage(name, value):
+        def run(**deps):
+            with lock:
+                started.append((name, sorted(deps)))
+            return value + sum(deps.values())
+        return run
+
+    done = []
+    results, timings = run_stages([
+        Stage("summary", stage("summary", 10), deps=["text"]),
+        Stage("text", stage("text", 1)),
+        Stage("old_text", stage("old_text", 100)),
+        Stage("graph", stage("graph", 1000), deps=["summary", "old_text"]),
+    ], on_stage_done=lambda stage, count, total: done.append((stage.name, count, total)))
+
+    assert results == {"text": 1, "old_text": 100, "summary": 11, "graph": 1111}
+    order = [name for name, _ in started]
+    assert order.index("text") < order.index("summary") < order.index("graph")
+    assert order.index("old_text") < order.index("graph")
+    assert dict(started)["graph"] == ["old_text", "summary"]
+    assert [count for _, count, _ in done] == [1, 2, 3, 4]
+    assert {total for _, _, total in done} == {4}
+    assert sorted(timing.name for timing in timings) == sorted(results)
+    assert timing_summary(timings)["wall"] >= 0
+
+
+def test_independent_stages_run_in_parallel():
+    both_running = threading.Barrier(2, timeout=5)
+    run_stages([Stage("old", both_running.wait), Stage("new", both_running.wait)], max_workers=2)
+
+
+def test_a_failing_stage_is_raised_and_skips_its_dependents():
+    called = []
+
+    def fail():
+        raise RuntimeError("LLM call failed")
+
+    with pytest.raises(RuntimeError, match="LLM call failed"):
+        run_stages([
+            Stage("text", fail),
+            Stage("summary", lambda text: called.append("summary"), deps=["text"]),
+        ])
+    assert called == []
+
+
+def test_unknown_and_cyclic_dependencies_are_rejected():
+    with pytest.raises(ValueError, match="unknown stages"):
+        run_stages([Stage("summary", lambda text: text, deps=["text"])])
+    with pytest.raises(ValueError, match="cyclic"):
+        run_stages([Stage("a", lambda b: b, deps=["b"]), Stage("b", lambda a: a, deps=["a"])])
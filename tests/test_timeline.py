@@ -0,0 +1,192 @@
+import json
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+import timeline
+from db_models import db, Regulation, Upload, EntityGraph, GraphVersion
+from graph_store import pack_graph, PackedGraph
+from timeline import graph_delta, apply_delta, rebuild_version, iter_versions, update_timeline
+
+OLD = {
+    "entities": [
+        {"id": "E1", "name": "Licensed bank", "type": "Organization"},
+        {"id": "E2", "name": "Central bank", "type": "Regulator"},
+        {"id": "E3", "name": "Capital report", "type": "Document"},
+    ],
+    "relationships": [
+        {"subject_id": "E1", "object_id": "E2", "verb": "must report to", "frequency": "monthly"},
+        {"subject_id": "E1", "object_id": "E3", "verb": "must submit"},
+        {"subject_id": "E2", "object_id": "E1", "verb": "supervises"},
+    ],
+}
+NEW = {
+    "entities": [
+        {"id": "E1", "name": "Licensed bank", "type": "Organization"},
+        {"id": "E2", "name": "Central bank", "type": "Supervisor"},
+        {"id": "E4", "name": "Liquidity report", "type": "Document"},
+    ],
+    "relationships": [
+        {"subject_id": "E1", "object_id": "E2", "verb": "must report to", "frequency": "quarterly"},
+        {"subject_id": "E1", "object_id": "E4", "verb": "must submit"},
+        {"subject_id": "E2", "object_id": "E1", "verb": "supervises"},
+    ],
+}
+
+
+def _canonical(data):
+    # apply_delta keeps the old order and appends additions, so compare contents
+    return (
+        sorted(json.dumps(entity, sort_keys=True) for entity in data["entities"]),
+        sorted(json.dumps(rel, sort_keys=True) for rel in data["relationships"]),
+    )
+
+
+def test_apply_delta_round_trip():
+    assert _canonical(apply_delta(OLD, graph_delta(OLD, NEW))) == _canonical(NEW)
+    assert _canonical(apply_delta(NEW, graph_delta(NEW, OLD))) == _canonical(OLD)
+    assert apply_delta(OLD, graph_delta(OLD, OLD)) == OLD
+
+
+def _version_graph(n, threshold="LKR 10 million"):
+    # Each version adds a bank and drops the oldest but one, so entities are added and removed along the timeline
+    names = ["Central bank"] + [f"Licensed bank {i}" for i in range(max(1, n - 2), n + 3)]
+    entities = [{"id": f"E{i}", "name": name, "type": "Organization"} for i, name in enumerate(names)]
+    relationships = [
+        {"subject_id": entity["id"], "object_id": "E0", "verb": "must report to", "Thresholds": threshold}
+        for entity in entities[1:]
+    ]
+    # Normalized the way stored graphs are
+    return PackedGraph(pack_graph({"entities": entities, "relationships": relationships})).relationships()
+
+
+def _by_name(data):
+    names = {entity["id"]: entity["name"] for entity in data["entities"]}
+    return (
+        sorted(names.values()),
+        sorted((names[rel["subject_id"]], rel["verb"], names[rel["object_id"]], rel["Thresholds"])
+               for rel in data["relationships"]),
+    )
+
+
+def _timeline(count):
+    regulation = Regulation(name="Capital adequacy")
+    db.session.add(regulation)
+    db.session.flush()
+    start = datetime(2024, 1, 1)
+    uploads = []
+    for n in range(count):
+        upload = Upload(regulation_id=regulation.id, new_path=f"v{n}.pdf", upload_time=start + timedelta(days=n))
+        db.session.add(upload)
+        db.session.flush()
+        db.session.add(EntityGraph(upload_id=upload.id, new_packed=pack_graph(_version_graph(n))))
+        uploads.append(upload.id)
+    db.session.commit()
+    return regulation.id, uploads
+
+
+def test_rebuild_version_matches_upload_graph_across_snapshots(app, monkeypatch):
+    monkeypatch.setattr(timeline, "TIMELINE_SNAPSHOT_INTERVAL", 3)
+    regulation_id, uploads = _timeline(7)
+    assert update_timeline(regulation_id) == 7
+    stored = {version.sequence: version.snapshot is not None for version in GraphVersion.query}
+    assert stored == {0: True, 1: False, 2: False, 3: True, 4: False, 5: False, 6: True}
+
+    replayed = {version.sequence: data for version, data in iter_versions(regulation_id)}
+    for sequence in range(7):
+        version, data = rebuild_version(regulation_id, sequence)
+        assert version.upload_id == uploads[sequence]
+        assert _by_name(data) == _by_name(_version_graph(sequence))
+        assert _canonical(data) == _canonical(replayed[sequence])
+    assert rebuild_version(regulation_id, 7) is None
+
+
+def test_reprocessing_a_middle_upload_rewrites_only_later_versions(app, monkeypatch):
+    monkeypatch.setattr(timeline, "TIMELINE_SNAPSHOT_INTERVAL", 3)
+    regulation_id, uploads = _timeline(5)
+    update_timeline(regulation_id)
+    # Marks every stored version so rewritten ones can be told apart
+    marker = datetime(2000, 1, 1)
+    GraphVersion.query.update({"created_at": marker})
+    db.session.commit()
+
+    EntityGraph.query.filter_by(upload_id=uploads[2]).update(
+        {"new_packed": pack_graph(_version_graph(2, threshold="LKR 50 million"))})
+    db.session.commit()
+    assert update_timeline(regulation_id, upload_id=uploads[2]) == 3
+
+    kept = {version.sequence: version.created_at == marker for version in GraphVersion.query}
+    assert kept == {0: True, 1: True, 2: False, 3: False, 4: False}
+    assert _by_name(rebuild_version(regulation_id, 2)[1]) == _by_name(_version_graph(2, threshold="LKR 50 million"))
+    for sequence in (0, 1, 3, 4):
+        assert _by_name(rebuild_version(regulation_id, sequence)[1]) == _by_name(_version_graph(sequence))
+    # Nothing moved, so a rerun without an upload writes nothing
+    assert update_timeline(regulation_id) == 0
+
+
+def test_reprocessing_replays_from_the_nearest_snapshot(app, monkeypatch):
+    monkeypatch.setattr(timeline, "TIMELINE_SNAPSHOT_INTERVAL", 3)
+    regulation_id, uploads = _timeline(7)
+    update_timeline(regulation_id)
+    full = {version.sequence: data for version, data in iter_versions(regulation_id)}
+
+    replayed, replay = [], timeline._replay
+
+    def recording_replay(versions, data=None):
+        for version, data in replay(versions, data):
+            replayed.append(version.sequence)
+            yield version, data
+    monkeypatch.setattr(timeline, "_replay", recording_replay)
+    assert update_timeline(regulation_id, upload_id=uploads[5]) == 2
+    assert replayed == [3, 4]
+    monkeypatch.setattr(timeline, "_replay", replay)
+
+    # Entity IDs come out as in a rebuild from the first version
+    assert {version.sequence: data for version, data in iter_versions(regulation_id)} == full
+    assert json.loads(GraphVersion.query.filter_by(sequence=6).one().reserved_ids) == sorted(
+        {entity["id"] for data in full.values() for entity in data["entities"]})
+
+
+def test_timelines_written_before_reserved_ids_replay_from_the_start(app, monkeypatch):
+    monkeypatch.setattr(timeline, "TIMELINE_SNAPSHOT_INTERVAL", 3)
+    regulation_id, uploads = _timeline(5)
+    update_timeline(regulation_id)
+    full = {version.sequence: data for version, data in iter_versions(regulation_id)}
+    GraphVersion.query.update({"reserved_ids": None})
+    db.session.commit()
+
+    assert update_timeline(regulation_id, upload_id=uploads[4]) == 1
+    assert {version.sequence: data for version, data in iter_versions(regulation_id)} == full
+
+
+def test_update_waits_for_another_connections_write(app):
+    regulation_id, uploads = _timeline(3)
+    update_timeline(regulation_id)
+    path = db.engine.url.database
+
+    # Another worker process is storing a new upload of the regulation
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    upload_id = other.execute("INSERT INTO uploads (regulation_id, new_path, upload_time) VALUES (?, ?, ?)",
+                              (regulation_id, "v3.pdf", "2024-01-04 00:00:00.000000")).lastrowid
+    other.execute("INSERT INTO entity_graphs (upload_id, new_packed, version) VALUES (?, ?, 1)",
+                  (upload_id, pack_graph(_version_graph(3))))
+
+    written = []
+
+    def update():
+        with app.app_context():
+            written.append(update_timeline(regulation_id))
+            db.session.remove()
+
+    worker = threading.Thread(target=update)
+    worker.start()
+    worker.join(0.5)
+    assert worker.is_alive()
+    other.execute("COMMIT")
+    other.close()
+    worker.join(10)
+
+    assert written == [1]
+    db.session.expire_all()
+    assert [version.upload_id for version in GraphVersion.query.order_by(GraphVersion.sequence)] == uploads + [upload_id]
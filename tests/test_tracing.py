@@ -0,0 +1,77 @@
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+import tracing
+from tracing import Metrics, prometheus_text, upload_traces
+
+
+@pytest.fixture
+def metrics(monkeypatch):
+    metrics = Metrics(buckets=(0.1, 1))
+    monkeypatch.setattr(tracing, "metrics", metrics)
+    return metrics
+
+
+def test_spans_nest_across_executor_threads_and_are_stored(app, metrics):
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        with tracing.trace(7, "process", job_id=3):
+            with tracing.span("summary", pages=2) as summary:
+                tracing.record_llm_usage("summary", SimpleNamespace(prompt_token_count=100, candidates_token_count=20))
+                summary.set(cache="miss")
+
+            def graph():
+                with tracing.span("llm.entity_relationship"):
+                    pass
+            tracing.submit(executor, graph).result()
+            with pytest.raises(ValueError):
+                with tracing.span("commit"):
+                    raise ValueError("locked")
+
+    [stored] = upload_traces(7)
+    assert (stored["kind"], stored["job_id"], stored["prompt_tokens"], stored["response_tokens"]) == ("process", 3, 100, 20)
+    spans = {span["name"]: span for span in stored["spans"]}
+    assert spans["process"]["parent"] is None
+    assert spans["summary"]["parent"] == spans["process"]["index"]
+    assert spans["summary"]["attributes"] == {"pages": 2, "cache": "miss"}
+    # The worker thread inherits the caller's span
+    assert spans["llm.entity_relationship"]["parent"] == spans["process"]["index"]
+    assert (spans["commit"]["status"], spans["commit"]["attributes"]) == ("error", {"error": "ValueError"})
+    assert spans["process"]["duration"] >= spans["summary"]["duration"]
+
+
+def test_spans_outside_a_trace_only_feed_the_metrics(app, metrics):
+    with tracing.span("docx") as span:
+        span.set(rows=3)
+    assert upload_traces(7) == []
+    [family, _] = metrics.families()
+    assert [sample for sample in family[3] if sample[0] == "_count"] == [("_count", {"span": "docx", "status": "ok"}, 1)]
+
+
+def test_prometheus_text_format(metrics):
+    metrics.observe("summary", "ok", 0.05)
+    metrics.observe("summary", "ok", 0.5)
+    metrics.observe("summary", "ok", 5)
+    metrics.add_tokens("kop", 10, 4)
+    text = prometheus_text(metrics.families() + [
+        ("jobs", "gauge", "Jobs by status.", [("", {"status": 'say "hi"\nnow'}, 1), ("_total", {}, 2)])])
+
+    assert text.endswith("\n")
+    assert text.splitlines() == [
+        "# HELP regcompare_span_duration_seconds Duration of traced pipeline spans.",
+        "# TYPE regcompare_span_duration_seconds histogram",
+        'regcompare_span_duration_seconds_bucket{span="summary",status="ok",le="0.1"} 1',
+        'regcompare_span_duration_seconds_bucket{span="summary",status="ok",le="1"} 2',
+        'regcompare_span_duration_seconds_bucket{span="summary",status="ok",le="+Inf"} 3',
+        'regcompare_span_duration_seconds_sum{span="summary",status="ok"} 5.55',
+        'regcompare_span_duration_seconds_count{span="summary",status="ok"} 3',
+        "# HELP regcompare_llm_tokens_total LLM tokens by call kind and direction, from the response usage metadata.",
+        "# TYPE regcompare_llm_tokens_total counter",
+        'regcompare_llm_tokens_total{kind="kop",direction="prompt"} 10',
+        'regcompare_llm_tokens_total{kind="kop",direction="response"} 4',
+        "# HELP regcompare_jobs Jobs by status.",
+        "# TYPE regcompare_jobs gauge",
+        'regcompare_jobs{status="say \\"hi\\"\\nnow"} 1',
+        "regcompare_jobs_total 2",
+    ]
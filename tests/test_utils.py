@@ -0,0 +1,203 @@
+import json
+import time
+
+import networkx as nx
+import pytest
+from docx import Document
+
+import utils
+from utils import (align_entities, remap_entity_ids, iter_sections, split_sections, layout_graphs, diff_sections,
+                   diff_relationships, markdown_to_docx, MarkdownDocxWriter)
+
+
+def _graph(entities, relationships=()):
+    return {
+        "entities": [{"id": entity_id, "name": name, "type": entity_type} for entity_id, name, entity_type in entities],
+        "relationships": list(relationships),
+    }
+
+
+def test_align_entities_prefers_exact_name_over_type():
+    old = _graph([("E1", "Tier 1 Capital", "metric"), ("E2", "Tier 2 Capital", "threshold")])
+    new = _graph([("X", "Tier 1 Capital", "threshold")])
+    assert align_entities(old, new) == {"X": "E1"}
+
+
+def test_align_entities_does_not_match_different_numbers():
+    old = _graph([("E1", "Entity 1", "organization"), ("E2", "Article 5 Report", "report")])
+    new = _graph([("X", "Entity 9", "organization"), ("Y", "Article 6 Report", "report"), ("Z", "Third Party", "organization")])
+    assert align_entities(old, new) == {}
+
+
+def test_align_entities_fuzzy_matches_renamed_entity():
+    old = _graph([("E1", "Central Bank of Sri Lanka", "authority")])
+    new = _graph([("X", "The Central Bank, Sri Lanka", "authority")])
+    assert align_entities(old, new) == {"X": "E1"}
+
+
+def test_remap_entity_ids_keeps_unmatched_ids_unique():
+    old = _graph([("E1", "Licensed Bank", "organization"), ("E2", "Central Bank", "authority")])
+    new = _graph(
+        [("E1", "Central Bank", "authority"), ("E2", "Trade Repository", "organization")],
+        [{"subject_id": "E2", "object_id": "E1", "verb": "must report to"}],
+    )
+    remapped = remap_entity_ids(new, align_entities(old, new), old)
+    ids = [entity["id"] for entity in remapped["entities"]]
+    assert ids[0] == "E2"
+    assert ids[1] not in ("E1", "E2")
+    assert remapped["relationships"][0] == {"subject_id": ids[1], "object_id": "E2", "verb": "must report to"}
+
+
+REGULATION_TEXT = (
+    "Preamble text.\n"
+    "Article 1 Scope\nThis regulation applies to licensed banks.\n\n"
+    "Article 2 Definitions\nIn this regulation:\n1. Bank means a licensed bank.\n"
+    "Chapter II\nReporting\n"
+    "Article 3\nBanks shall report quarterly.\n"
+)
+
+
+def test_iter_sections_is_independent_of_page_breaks():
+    expected = split_sections(REGULATION_TEXT)
+    assert [section.strip().split("\n")[0] for section in expected] == [
+        "Preamble text.", "Article 1 Scope", "Article 2 Definitions", "1. Bank means a licensed bank.",
+        "Chapter II", "Article 3",
+    ]
+    for cut in range(1, len(REGULATION_TEXT)):
+        pages = [REGULATION_TEXT[:cut], REGULATION_TEXT[cut:]]
+        assert list(iter_sections(pages)) == expected, cut
+
+
+def test_iter_sections_with_sparse_headings_stays_linear():
+    pages = ["lorem ipsum dolor sit amet\n" * 80] * 2000
+    started = time.perf_counter()
+    assert sum(len(section) for section in iter_sections(pages)) == sum(len(page) for page in pages)
+    assert time.perf_counter() - started < 2
+
+
+def test_layout_graphs_skips_graphs_above_the_node_limit(monkeypatch):
+    monkeypatch.setattr(utils, "GRAPH_LAYOUT_MAX_NODES", 3)
+    small, large = nx.path_graph(3, create_using=nx.DiGraph), nx.path_graph(4, create_using=nx.DiGraph)
+    old_positions, new_positions = layout_graphs(small, small)
+    assert set(old_positions) == set(new_positions) == {0, 1, 2}
+    assert layout_graphs(small, large) == ({}, {})
+    assert layout_graphs(None, large) == (None, {})
+
+
+ARTICLES = [
+    "Article 1 Scope\nThis regulation applies to licensed banks.\n",
+    "Article 2 Reporting\nBanks shall report their capital monthly.\n",
+    "Article 3 Fees\nA supervision fee applies.\n",
+]
+
+
+def test_diff_sections_inserted_section():
+    new = ARTICLES[:2] + ["Article 2A Liquidity\nBanks shall hold liquid assets.\n"] + ARTICLES[2:]
+    diff = diff_sections("".join(ARTICLES), "".join(new))
+    assert diff.unchanged == ARTICLES
+    assert diff.added == [new[2]]
+    assert (diff.changed, diff.removed) == ([], [])
+    assert diff.changed_headings() == ["Article 2A Liquidity"]
+
+
+def test_diff_sections_deleted_section():
+    diff = diff_sections("".join(ARTICLES), ARTICLES[0] + ARTICLES[2])
+    assert diff.unchanged == [ARTICLES[0], ARTICLES[2]]
+    assert diff.removed == [ARTICLES[1]]
+    assert (diff.changed, diff.added) == ([], [])
+    assert diff.stats()["sections_skipped"] == 2
+
+
+def test_diff_sections_renamed_heading_is_a_change():
+    renamed = "Article 2 Disclosure\nBanks shall report their capital monthly.\n"
+    diff = diff_sections("".join(ARTICLES), ARTICLES[0] + renamed + ARTICLES[2])
+    assert diff.unchanged == [ARTICLES[0], ARTICLES[2]]
+    assert diff.changed == [(ARTICLES[1], renamed)]
+    assert (diff.added, diff.removed) == ([], [])
+    assert diff.has_changes
+
+
+KOP_MARKDOWN = (
+    "# Key Operating Procedure\n"
+    "Intro with **bold**, *italic* and `code` text\n"
+    "continued on a second line.\n\n"
+    "## 1. Reporting\n"
+    "- Report capital **monthly**\n"
+    "  - to the *Central Bank*\n"
+    "1. Collect the figures\n"
+    "2. Submit the return\n\n"
+    "| Obligation | Frequency | Threshold |\n"
+    "|---|---|---|\n"
+    "| Capital report | Monthly | LKR 10 million |\n"
+    "| Liquidity report | Quarterly | |\n\n"
+    "```\nraw *text*\n```\n"
+    "---\n"
+    "Closing line without a newline"
+)
+
+
+def _rel(subject_id, object_id, verb, **attrs):
+    return {"subject_id": subject_id, "object_id": object_id, "verb": verb, **attrs}
+
+
+def test_diff_relationships_reports_added_removed_and_modified_edges():
+    entities = [("E1", "Licensed bank", "organization"), ("E2", "Monthly return", "report"),
+                ("E3", "Central Bank", "regulator")]
+    old = _graph(entities, [
+        _rel("E1", "E2", "Submits", frequency="monthly", Thresholds="LKR 10 million"),
+        _rel("E1", "E3", "Notifies"),
+        _rel("E3", "E2", "Validates"),
+    ])
+    new = _graph(entities[:2] + [("E3", "Central Bank of Sri Lanka", "regulator"), ("E4", "Auditor", "organization")], [
+        _rel("E1", "E2", "Submits", frequency="quarterly", Thresholds="LKR 10 million"),
+        _rel("E3", "E2", "Validates"),
+        _rel("E4", "E2", "Reviews"),
+    ])
+
+    diff = diff_relationships(json.dumps(old), new)
+    assert [(edge["key"], edge["attributes"]["verb"]) for edge in diff["added_edges"]] == [("E4->E2", "Reviews")]
+    assert [(edge["key"], edge["to_label"]) for edge in diff["removed_edges"]] == [("E1->E3", "Central Bank")]
+    [modified] = diff["modified_edges"]
+    assert modified["key"] == "E1->E2"
+    assert modified["changes"] == {"frequency": {"old": "monthly", "new": "quarterly"}}
+    assert modified["old_attributes"]["frequency"] == "monthly"
+    assert modified["attributes"]["frequency"] == "quarterly"
+    assert [node["id"] for node in diff["added_nodes"]] == ["E4"]
+    assert diff["modified_nodes"] == [{"id": "E3", "label": "Central Bank of Sri Lanka", "group": "regulator",
+                                       "changes": {"name": {"old": "Central Bank", "new": "Central Bank of Sri Lanka"}}}]
+    assert diff["summary"] == {"added_edges": 1, "removed_edges": 1, "modified_edges": 1,
+                               "added_nodes": 1, "removed_nodes": 0, "modified_nodes": 1}
+
+
+def test_diff_relationships_pairs_parallel_edges_by_verb():
+    entities = [("E1", "Licensed bank", "organization"), ("E2", "Central Bank", "regulator")]
+    old = _graph(entities, [_rel("E1", "E2", "Reports capital to", frequency="monthly"),
+                            _rel("E1", "E2", "Reports liquidity to", frequency="daily")])
+    new = _graph(entities, [_rel("E1", "E2", "Reports liquidity to", frequency="daily"),
+                            _rel("E1", "E2", "Reports capital to", frequency="quarterly"),
+                            _rel("E1", "E2", "Notifies breaches to")])
+
+    diff = diff_relationships(old, new)
+    assert [edge["changes"] for edge in diff["modified_edges"]] == [
+        {"frequency": {"old": "monthly", "new": "quarterly"}}]
+    assert [edge["attributes"]["verb"] for edge in diff["added_edges"]] == ["Notifies breaches to"]
+    assert diff["removed_edges"] == []
+    assert diff_relationships(old, old)["summary"] == dict.fromkeys(diff["summary"], 0)
+
+
+def _docx_body(doc):
+    return doc.element.body.xml
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 64])
+def test_streamed_markdown_docx_matches_one_shot(chunk_size):
+    expected = Document()
+    markdown_to_docx(expected, KOP_MARKDOWN)
+    assert [p.style.name for p in expected.paragraphs[:2]] == ["Heading 1", "Normal"]
+    assert [[cell.text for cell in row.cells] for row in expected.tables[0].rows][1] == [
+        "Capital report", "Monthly", "LKR 10 million"]
+
+    writer = MarkdownDocxWriter(Document())
+    for start in range(0, len(KOP_MARKDOWN), chunk_size):
+        writer.feed(KOP_MARKDOWN[start:start + chunk_size])
+    assert _docx_body(writer.close()) == _docx_body(expected)
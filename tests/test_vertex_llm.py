@@ -0,0 +1,147 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import vertex_llm
+from entity_schema import SchemaError
+
+VALID = json.dumps({
+    "entities": [{"id": "E1", "name": "Bank", "type": "Organization"}, {"id": "E2", "name": "CBSL", "type": "Regulator"}],
+    "relationships": [{"subject_id": "E1", "verb": "must report to", "object_id": "E2"},
+                      {"subject_id": "E2", "verb": "supervises", "object_id": "E1"}],
+})
+
+
+@pytest.fixture
+def responses(tmp_path, monkeypatch):
+    """Makes the model answer with the listed texts in turn; returns the list of prompts it was sent."""
+    monkeypatch.setattr(vertex_llm, "llm_cache", vertex_llm.LLMCache(str(tmp_path / "llm_cache.db")))
+    monkeypatch.setattr(vertex_llm, "LLM_RETRY_BASE_DELAY", 0)
+    monkeypatch.setattr(vertex_llm, "call_metrics", {})
+    prompts, answers = [], []
+
+    def generate(model_name, prompt, generation_config):
+        prompts.append(prompt)
+        return SimpleNamespace(text=answers.pop(0))
+    monkeypatch.setattr(vertex_llm.llm_client, "generate", generate)
+    return prompts, answers
+
+
+def test_schema_invalid_response_is_retried(responses):
+    prompts, answers = responses
+    answers.extend(['{"nodes": [], "edges": []}', VALID])
+    result = json.loads(vertex_llm.get_entity_relationship_with_context("Banks must report to CBSL.", use_cache=False))
+    assert [entity["id"] for entity in result["entities"]] == ["E1", "E2"]
+    assert len(prompts) == 2
+    metrics = vertex_llm.get_call_metrics()["entity_relationship"]
+    assert (metrics["calls"], metrics["attempts"], metrics["retries"], metrics["failures"]) == (1, 2, 1, 0)
+
+
+def test_truncated_response_is_repaired_without_a_retry(responses):
+    prompts, answers = responses
+    # Cut off inside the second relationship
+    answers.append("```json\n" + VALID[:VALID.index('{"subject_id": "E2"')])
+    result = json.loads(vertex_llm.get_entity_relationship_with_context("Banks must report to CBSL.", use_cache=False))
+    assert [rel["verb"] for rel in result["relationships"]] == ["must report to"]
+    assert len(prompts) == 1
+    assert vertex_llm.get_call_metrics()["entity_relationship"]["repairs"] == 1
+
+
+def test_gives_up_after_max_attempts(responses, monkeypatch):
+    prompts, answers = responses
+    monkeypatch.setattr(vertex_llm, "ENTITY_MAX_ATTEMPTS", 2)
+    answers.extend(["No JSON here.", "Still none."])
+    with pytest.raises(SchemaError):
+        vertex_llm.get_entity_relationship_with_context("Banks must report to CBSL.", use_cache=False)
+    assert len(prompts) == 2
+    assert vertex_llm.get_call_metrics()["entity_relationship"]["failures"] == 1
+
+
+
+def test_json_mode_falls_back_per_model_when_rejected(responses, monkeypatch):
+    monkeypatch.setattr(vertex_llm, "_structured_unsupported", set())
+    configs = []
+
+    def generate(model_name, prompt, generation_config):
+        configs.append((model_name, "response_schema" in generation_config))
+        if model_name == "gemini-old" and "response_schema" in generation_config:
+            raise vertex_llm.api_exceptions.InvalidArgument("response_schema is not supported")
+        return SimpleNamespace(text=VALID)
+    monkeypatch.setattr(vertex_llm.llm_client, "generate", generate)
+
+    for model_name in ("gemini-old", "gemini-old", "gemini-new"):
+        monkeypatch.setenv("GEMINI_MODEL", model_name)
+        vertex_llm.get_entity_relationship_with_context("Banks must report to CBSL.", use_cache=False)
+    assert configs == [("gemini-old", True), ("gemini-old", False), ("gemini-old", False), ("gemini-new", True)]
+    assert vertex_llm.STRUCTURED_OUTPUT
+
+class Clock:
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(vertex_llm.time, "time", clock)
+    return clock
+
+
+def test_cache_key_covers_model_prompt_version_inputs_and_parameters(monkeypatch):
+    key = vertex_llm.LLMCache.make_key("summary", "gemini-pro", "text", "context", {"temperature": 0.1})
+    assert key == vertex_llm.LLMCache.make_key("summary", "gemini-pro", "text", "context", {"temperature": 0.1})
+    assert len({
+        key,
+        vertex_llm.LLMCache.make_key("kop", "gemini-pro", "text", "context", {"temperature": 0.1}),
+        vertex_llm.LLMCache.make_key("summary", "gemini-flash", "text", "context", {"temperature": 0.1}),
+        vertex_llm.LLMCache.make_key("summary", "gemini-pro", "other text", "context", {"temperature": 0.1}),
+        vertex_llm.LLMCache.make_key("summary", "gemini-pro", "text", None, {"temperature": 0.1}),
+        vertex_llm.LLMCache.make_key("summary", "gemini-pro", "text", "context", {"temperature": 0.2}),
+    }) == 6
+    monkeypatch.setattr(vertex_llm, "PROMPT_VERSION", "changed")
+    assert vertex_llm.LLMCache.make_key("summary", "gemini-pro", "text", "context", {"temperature": 0.1}) != key
+
+
+def test_cache_counts_hits_and_misses(tmp_path, clock):
+    cache = vertex_llm.LLMCache(str(tmp_path / "cache.db"))
+    assert cache.get("k1", "summary") is None
+    cache.put("k1", "summary", "answer")
+    assert cache.get("k1", "summary") == "answer"
+    stats = cache.stats()
+    assert (stats["entries"], stats["hits"], stats["misses"]) == (1, {"summary": 1}, {"summary": 1})
+
+
+def test_cache_evicts_least_recently_used_entries(tmp_path, clock):
+    cache = vertex_llm.LLMCache(str(tmp_path / "cache.db"), max_entries=2)
+    cache.put("k1", "summary", "one")
+    clock.now += 1
+    cache.put("k2", "summary", "two")
+    clock.now += 1
+    assert cache.get("k1", "summary") == "one"
+    clock.now += 1
+    cache.put("k3", "summary", "three")
+    assert cache.get("k2", "summary") is None
+    assert (cache.get("k1", "summary"), cache.get("k3", "summary")) == ("one", "three")
+
+
+def test_cache_ignores_and_purges_expired_entries(tmp_path, clock):
+    cache = vertex_llm.LLMCache(str(tmp_path / "cache.db"), max_age=60)
+    cache.put("old", "summary", "stale")
+    clock.now += 61
+    assert cache.get("old", "summary") is None
+    cache.put("new", "summary", "fresh")
+    assert cache.stats()["entries"] == 1
+
+
+def test_use_cache_false_calls_the_model_and_refreshes_the_cache(responses):
+    prompts, answers = responses
+    answers.extend(["first", "second"])
+    assert vertex_llm.get_kop_doc("summary", "{}") == "first"
+    assert vertex_llm.get_kop_doc("summary", "{}") == "first"
+    assert vertex_llm.get_kop_doc("summary", "{}", use_cache=False) == "second"
+    assert vertex_llm.get_kop_doc("summary", "{}") == "second"
+    assert len(prompts) == 2
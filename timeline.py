@@ -0,0 +1,295 @@
+import os
+import json
+import zlib
+from db_models import db, Upload, EntityGraph, GraphVersion, bump_counter
+from graph_store import pack_graph, PackedGraph
+from utils import align_entities, remap_entity_ids, match_relationships, diff_relationships
+
+# A full snapshot every this many versions bounds how many deltas a rebuild applies
+TIMELINE_SNAPSHOT_INTERVAL = int(os.getenv("TIMELINE_SNAPSHOT_INTERVAL", 10))
+DELTA_COMPRESSION_LEVEL = 6
+
+
+def graph_delta(old, new):
+    """The changes turning ``old`` into ``new``, two entity-relationship dicts with aligned entity IDs.
+
+    Entities are upserted or removed by ID. Relationships are matched the
+    way diff_relationships matches them: a changed one is replaced at its
+    position in ``old``, removed ones are dropped by position and new ones
+    are appended.
+    """
+    old_entities = {entity["id"]: entity for entity in old["entities"]}
+    new_ids = {entity["id"] for entity in new["entities"]}
+    positions = {id(rel): i for i, rel in enumerate(old["relationships"])}
+    update, remove, add = [], [], []
+    for matched, removed, added in match_relationships(old, new):
+        update.extend([positions[id(old_rel)], new_rel] for old_rel, new_rel in matched if old_rel != new_rel)
+        remove.extend(positions[id(rel)] for rel in removed)
+        add.extend(added)
+    return {
+        "entities": {
+            "upsert": [entity for entity in new["entities"] if old_entities.get(entity["id"]) != entity],
+            "remove": [entity_id for entity_id in old_entities if entity_id not in new_ids],
+        },
+        "relationships": {
+            "update": sorted(update, key=lambda item: item[0]),
+            "remove": sorted(remove),
+            "add": add,
+        },
+    }
+
+
+def apply_delta(data, delta):
+    """The graph ``delta`` (from graph_delta) turns ``data`` into; same content as the delta's ``new``.
+
+    Entities and relationships keep their order in ``data``, with additions at the end.
+    """
+    entities = {entity["id"]: entity for entity in data["entities"]}
+    for entity_id in delta["entities"]["remove"]:
+        entities.pop(entity_id, None)
+    for entity in delta["entities"]["upsert"]:
+        entities[entity["id"]] = entity
+    relationships = list(data["relationships"])
+    for position, rel in delta["relationships"]["update"]:
+        relationships[position] = rel
+    removed = set(delta["relationships"]["remove"])
+    relationships = [rel for i, rel in enumerate(relationships) if i not in removed]
+    return {"entities": list(entities.values()), "relationships": relationships + delta["relationships"]["add"]}
+
+
+def delta_counts(old, delta):
+    old_ids = {entity["id"] for entity in old["entities"]}
+    upserted = delta["entities"]["upsert"]
+    return {
+        "entities_added": sum(1 for entity in upserted if entity["id"] not in old_ids),
+        "entities_changed": sum(1 for entity in upserted if entity["id"] in old_ids),
+        "entities_removed": len(delta["entities"]["remove"]),
+        "relationships_added": len(delta["relationships"]["add"]),
+        "relationships_changed": len(delta["relationships"]["update"]),
+        "relationships_removed": len(delta["relationships"]["remove"]),
+    }
+
+
+def _upload_graph(graph_entry):
+    if graph_entry.new_packed:
+        return PackedGraph(graph_entry.new_packed).relationships()
+    # Rows written before graphs were packed; a round trip normalizes them like packed ones
+    return PackedGraph(pack_graph(json.loads(graph_entry.new_json))).relationships()
+
+
+def _version_uploads(*columns):
+    # Every processed upload of the whole document is a version; uploads of a
+    # page range only cover part of it and are left out
+    return (
+        db.select(*columns)
+        .join(EntityGraph, EntityGraph.upload_id == Upload.id)
+        .where(
+            Upload.page_range.is_(None),
+            db.or_(EntityGraph.new_packed.isnot(None), EntityGraph.new_json.isnot(None))
+        )
+    )
+
+
+def timeline_upload_ids(regulation_id):
+    """IDs of the uploads that make up a regulation's timeline, oldest first."""
+    query = _version_uploads(Upload.id).where(Upload.regulation_id == regulation_id).order_by(Upload.upload_time, Upload.id)
+    return db.session.execute(query).scalars().all()
+
+
+def latest_version_upload_ids():
+    """A select of the upload ID of every regulation's newest timeline version, for use in a subquery."""
+    ranked = _version_uploads(
+        Upload.id,
+        db.func.row_number().over(
+            partition_by=Upload.regulation_id, order_by=(Upload.upload_time.desc(), Upload.id.desc())
+        ).label("position")
+    ).subquery()
+    return db.select(ranked.c.id).where(ranked.c.position == 1)
+
+
+def _replay(versions, data=None):
+    for version in versions:
+        if version.snapshot is not None:
+            data = PackedGraph(version.snapshot).relationships()
+        else:
+            data = apply_delta(data, json.loads(zlib.decompress(version.delta)))
+        yield version, data
+
+
+def iter_versions(regulation_id, until=None):
+    """Yields ``(version, data)`` for each stored version of a regulation in order, up to sequence ``until``."""
+    query = GraphVersion.query.filter_by(regulation_id=regulation_id)
+    if until is not None:
+        query = query.filter(GraphVersion.sequence <= until)
+    return _replay(query.order_by(GraphVersion.sequence))
+
+
+def rebuild_version(regulation_id, sequence):
+    """``(version, data)`` of one version, rebuilt from the nearest snapshot before it, or None."""
+    base = (
+        db.session.query(db.func.max(GraphVersion.sequence))
+        .filter(GraphVersion.regulation_id == regulation_id, GraphVersion.sequence <= sequence,
+                GraphVersion.snapshot.isnot(None))
+        .scalar()
+    )
+    if base is None:
+        return None
+    versions = (
+        GraphVersion.query
+        .filter(GraphVersion.regulation_id == regulation_id, GraphVersion.sequence.between(base, sequence))
+        .order_by(GraphVersion.sequence)
+    )
+    result = None
+    for result in _replay(versions):
+        pass
+    return result if result and result[0].sequence == sequence else None
+
+
+def _timeline_before(regulation_id, start):
+    """``(data, reserved_ids)`` of the version before ``start``: its graph and every entity ID used up to it.
+
+    Replays from the nearest snapshot that records its reserved IDs; older
+    snapshots without them fall back to a replay from the first version.
+    """
+    if start == 0:
+        return None, set()
+    base = (
+        db.session.query(db.func.max(GraphVersion.sequence))
+        .filter(GraphVersion.regulation_id == regulation_id, GraphVersion.sequence < start,
+                GraphVersion.snapshot.isnot(None), GraphVersion.reserved_ids.isnot(None))
+        .scalar()
+    ) or 0
+    versions = (
+        GraphVersion.query
+        .filter(GraphVersion.regulation_id == regulation_id, GraphVersion.sequence.between(base, start - 1))
+        .order_by(GraphVersion.sequence)
+    )
+    data, reserved_ids = None, set()
+    for version, data in _replay(versions):
+        if version.sequence == base and version.reserved_ids:
+            reserved_ids.update(json.loads(version.reserved_ids))
+        reserved_ids.update(entity["id"] for entity in data["entities"])
+    return data, reserved_ids
+
+
+def update_timeline(regulation_id, upload_id=None):
+    """Brings a regulation's stored timeline in line with its processed uploads and commits.
+
+    Versions before the first upload that moved, or before ``upload_id``
+    when it was just (re)processed, are kept. The rest are rebuilt from the
+    stored graphs, so no LLM calls are made. Each version's entity IDs are
+    aligned with the version before, so an entity keeps its ID along the
+    whole timeline. Returns the number of versions written.
+
+    Commits the caller's transaction first, since the run holds a write lock
+    from its first statement.
+    """
+    # The first write of the transaction: under SQLite it takes the database
+    # write lock, elsewhere it locks the regulation's counter row, until the
+    # commit. Workers in other processes finishing an upload of the same
+    # regulation wait here and then see this run's versions.
+    db.session.commit()
+    bump_counter(f"timeline-{regulation_id}")
+
+    upload_ids = timeline_upload_ids(regulation_id)
+    stored = [
+        row.upload_id for row in
+        db.session.query(GraphVersion.upload_id).filter_by(regulation_id=regulation_id).order_by(GraphVersion.sequence)
+    ]
+    start = 0
+    while (start < len(upload_ids) and start < len(stored) and stored[start] == upload_ids[start]
+           and upload_ids[start] != upload_id):
+        start += 1
+    if start == len(upload_ids) == len(stored):
+        db.session.commit()
+        return 0
+
+    previous, seen_ids = _timeline_before(regulation_id, start)
+    db.session.query(GraphVersion).filter(
+        GraphVersion.regulation_id == regulation_id, GraphVersion.sequence >= start
+    ).delete()
+
+    for sequence in range(start, len(upload_ids)):
+        graph_entry = EntityGraph.query.filter_by(upload_id=upload_ids[sequence]).first()
+        data = _upload_graph(graph_entry)
+        version = GraphVersion(regulation_id=regulation_id, upload_id=upload_ids[sequence], sequence=sequence)
+        if previous is not None:
+            # IDs used anywhere earlier in the timeline stay reserved for their entities
+            data = remap_entity_ids(data, align_entities(previous, data), {"entities": [{"id": i} for i in seen_ids]})
+            delta = graph_delta(previous, data)
+            version.changes = json.dumps(delta_counts(previous, delta))
+        seen_ids.update(entity["id"] for entity in data["entities"])
+        if previous is None or sequence % TIMELINE_SNAPSHOT_INTERVAL == 0:
+            version.snapshot = pack_graph(data)
+            version.reserved_ids = json.dumps(sorted(seen_ids))
+        else:
+            version.delta = zlib.compress(json.dumps(delta, ensure_ascii=False).encode("utf-8"), DELTA_COMPRESSION_LEVEL)
+            # Later deltas refer to positions in the graph as rebuilt
+            data = apply_delta(previous, delta)
+        version.node_count = len(data["entities"])
+        version.edge_count = len(data["relationships"])
+        db.session.add(version)
+        previous = data
+    db.session.commit()
+    return len(upload_ids) - start
+
+def diff_versions(regulation_id, from_sequence, to_sequence):
+    """diff_relationships between two versions of a regulation, or None if either does not exist."""
+    old, new = rebuild_version(regulation_id, from_sequence), rebuild_version(regulation_id, to_sequence)
+    if old is None or new is None:
+        return None
+    return diff_relationships(old[1], new[1])
+
+
+def _entity_ids(data, key):
+    key = key.strip().lower()
+    return {entity["id"] for entity in data["entities"] if entity["id"].lower() == key or (entity.get("name") or "").lower() == key}
+
+
+def _canonical(relationships):
+    return sorted(json.dumps(rel, sort_keys=True) for rel in relationships)
+
+
+def edge_history(regulation_id, subject, obj, verb=None):
+    """The relationships from ``subject`` to ``obj`` (entity IDs or names) in every version, oldest first.
+
+    Each entry has the version's sequence and upload, the matching
+    relationships and a status against the version before: added, changed,
+    unchanged, removed or absent.
+    """
+    history, previous = [], []
+    for version, data in iter_versions(regulation_id):
+        subject_ids, object_ids = _entity_ids(data, subject), _entity_ids(data, obj)
+        relationships = [
+            rel for rel in data["relationships"]
+            if rel["subject_id"] in subject_ids and rel["object_id"] in object_ids
+            and (verb is None or (rel.get("verb") or "").lower() == verb.lower())
+        ]
+        if not relationships:
+            status = "removed" if previous else "absent"
+        elif not previous:
+            status = "added"
+        else:
+            status = "unchanged" if _canonical(relationships) == _canonical(previous) else "changed"
+        history.append({
+            "sequence": version.sequence,
+            "upload_id": version.upload_id,
+            "status": status,
+            "relationships": relationships,
+        })
+        previous = relationships
+    return history
+
+
+def version_to_dict(version, upload=None):
+    return {
+        "sequence": version.sequence,
+        "upload_id": version.upload_id,
+        "upload_time": upload.upload_time.isoformat() if upload and upload.upload_time else None,
+        "new_path": upload.new_path if upload else None,
+        "stored_as": "snapshot" if version.snapshot is not None else "delta",
+        "stored_bytes": len(version.snapshot if version.snapshot is not None else version.delta),
+        "node_count": version.node_count,
+        "edge_count": version.edge_count,
+        "changes": json.loads(version.changes) if version.changes else None,
+    }
@@ -0,0 +1,270 @@
+import json
+import time
+import uuid
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from datetime import datetime
+from db_models import db, TraceSpan
+
+logger = logging.getLogger(__name__)
+
+METRICS_PREFIX = "regcompare"
+# Upper bounds in seconds; spans range from a DB commit to a multi-minute LLM call
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_current_trace = ContextVar("trace", default=None)
+_current_span = ContextVar("span", default=None)
+
+
+class Span:
+    def __init__(self, index, parent, name, start_offset, attributes):
+        self.index = index
+        self.parent = parent
+        self.name = name
+        self.start_offset = start_offset
+        self.duration = None
+        self.status = "ok"
+        self.prompt_tokens = None
+        self.response_tokens = None
+        self.attributes = attributes
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add_tokens(self, prompt_tokens, response_tokens):
+        self.prompt_tokens = (self.prompt_tokens or 0) + prompt_tokens
+        self.response_tokens = (self.response_tokens or 0) + response_tokens
+
+
+class _UntracedSpan(Span):
+    """Stands in for a span outside any trace; its data is only used for metrics."""
+
+    def __init__(self, name):
+        super().__init__(None, None, name, 0.0, {})
+
+
+class Trace:
+    """Spans of one job run or KOP stream, written to trace_spans when it ends."""
+
+    def __init__(self, upload_id, kind, job_id=None):
+        self.trace_id = uuid.uuid4().hex
+        self.upload_id = upload_id
+        self.kind = kind
+        self.job_id = job_id
+        self.spans = []
+        self._t0 = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def start_span(self, name, parent, attributes):
+        with self._lock:
+            span = Span(len(self.spans), parent, name, time.perf_counter() - self._t0, attributes)
+            self.spans.append(span)
+        return span
+
+    def rows(self):
+        created_at = datetime.utcnow()
+        return [
+            {
+                "upload_id": self.upload_id,
+                "job_id": self.job_id,
+                "trace_id": self.trace_id,
+                "kind": self.kind,
+                "span_index": span.index,
+                "parent_index": span.parent.index if span.parent else None,
+                "name": span.name,
+                "start_offset": round(span.start_offset, 6),
+                "duration": round(span.duration if span.duration is not None else 0.0, 6),
+                "status": span.status,
+                "prompt_tokens": span.prompt_tokens,
+                "response_tokens": span.response_tokens,
+                "attributes": json.dumps(span.attributes) if span.attributes else None,
+                "created_at": created_at,
+            }
+            for span in self.spans
+        ]
+
+
+class Metrics:
+    """In-process span duration histograms and LLM token counters in Prometheus form."""
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self._durations = {}
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, status, duration):
+        with self._lock:
+            counts, total = self._durations.get((name, status), ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect_left(self.buckets, duration)] += 1
+            self._durations[(name, status)] = (counts, total + duration)
+
+    def add_tokens(self, kind, prompt_tokens, response_tokens):
+        with self._lock:
+            for direction, count in (("prompt", prompt_tokens), ("response", response_tokens)):
+                self._tokens[(kind, direction)] = self._tokens.get((kind, direction), 0) + count
+
+    def families(self):
+        with self._lock:
+            durations = {key: (list(counts), total) for key, (counts, total) in self._durations.items()}
+            tokens = dict(self._tokens)
+
+        histogram = []
+        for (name, status), (counts, total) in sorted(durations.items()):
+            labels = {"span": name, "status": status}
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                histogram.append(("_bucket", {**labels, "le": str(bound)}, cumulative))
+            histogram.append(("_sum", labels, round(total, 6)))
+            histogram.append(("_count", labels, cumulative))
+        return [
+            ("span_duration_seconds", "histogram", "Duration of traced pipeline spans.", histogram),
+            ("llm_tokens_total", "counter", "LLM tokens by call kind and direction, from the response usage metadata.",
+             [("", {"kind": kind, "direction": direction}, count) for (kind, direction), count in sorted(tokens.items())]),
+        ]
+
+
+metrics = Metrics()
+
+
+@contextmanager
+def trace(upload_id, kind, job_id=None):
+    """Collects the spans recorded while the block runs and stores them for the upload.
+
+    The block itself is the root span, named after ``kind``. Storing happens
+    in its own transaction and never fails the traced work.
+    """
+    current = Trace(upload_id, kind, job_id)
+    trace_token = _current_trace.set(current)
+    try:
+        with span(kind):
+            yield current
+    finally:
+        try:
+            _current_trace.reset(trace_token)
+        except ValueError:
+            pass
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(db.insert(TraceSpan), current.rows())
+        except Exception:
+            logger.exception("Could not store trace %s of upload %s", current.trace_id, upload_id)
+
+
+@contextmanager
+def span(name, **attributes):
+    """Times the block as a span of the current trace, nested under the current span.
+
+    Outside a trace the duration still feeds the metrics. The yielded span
+    takes extra attributes (``set``) and token counts (``add_tokens``).
+    """
+    current = _current_trace.get()
+    parent = _current_span.get()
+    started = time.perf_counter()
+    if current is None:
+        record = _UntracedSpan(name)
+    else:
+        record = current.start_span(name, parent, attributes)
+    span_token = _current_span.set(record)
+    try:
+        yield record
+    except BaseException as e:
+        record.status = "error"
+        record.attributes["error"] = type(e).__name__
+        raise
+    finally:
+        try:
+            _current_span.reset(span_token)
+        except ValueError:
+            # A streaming generator closed from another context, e.g. after the client went away
+            pass
+        record.duration = time.perf_counter() - started
+        metrics.observe(name, record.status, record.duration)
+
+
+def record_llm_usage(kind, usage):
+    """Adds the token counts of a Gemini ``usage_metadata`` to the current span and the metrics."""
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, "prompt_token_count", 0) or 0
+    response_tokens = getattr(usage, "candidates_token_count", 0) or 0
+    metrics.add_tokens(kind, prompt_tokens, response_tokens)
+    current = _current_span.get()
+    if current is not None:
+        current.add_tokens(prompt_tokens, response_tokens)
+
+
+def submit(executor, fn, *args, **kwargs):
+    """executor.submit that keeps the caller's trace, so spans in ``fn`` nest under the current one."""
+    return executor.submit(copy_context().run, fn, *args, **kwargs)
+
+
+def _label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def prometheus_text(families):
+    """Renders ``(name, type, help, [(suffix, labels, value)])`` families in the text exposition format."""
+    lines = []
+    for name, kind, help_text, samples in families:
+        name = f"{METRICS_PREFIX}_{name}"
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for suffix, labels, value in samples:
+            label_text = ",".join(f'{key}="{_label_value(val)}"' for key, val in labels.items())
+            lines.append(f"{name}{suffix}{{{label_text}}} {value}" if label_text else f"{name}{suffix} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def span_to_dict(span):
+    return {
+        "index": span.span_index,
+        "parent": span.parent_index,
+        "name": span.name,
+        "start": span.start_offset,
+        "duration": span.duration,
+        "status": span.status,
+        "prompt_tokens": span.prompt_tokens,
+        "response_tokens": span.response_tokens,
+        "attributes": json.loads(span.attributes) if span.attributes else {},
+    }
+
+
+def upload_traces(upload_id, limit=5):
+    """The latest ``limit`` traces of an upload, newest first, each with its spans in start order."""
+    latest = (
+        db.session.query(TraceSpan.trace_id, db.func.max(TraceSpan.id).label("last_id"))
+        .filter(TraceSpan.upload_id == upload_id)
+        .group_by(TraceSpan.trace_id)
+        .order_by(db.desc("last_id"))
+        .limit(limit)
+        .all()
+    )
+    trace_ids = [row.trace_id for row in latest]
+    spans = (
+        TraceSpan.query
+        .filter(TraceSpan.upload_id == upload_id, TraceSpan.trace_id.in_(trace_ids))
+        .order_by(TraceSpan.start_offset, TraceSpan.span_index)
+        .all()
+    )
+    traces = {trace_id: [] for trace_id in trace_ids}
+    for row in spans:
+        traces[row.trace_id].append(row)
+    result = []
+    for trace_id, rows in traces.items():
+        root = next((row for row in rows if row.parent_index is None), rows[0])
+        result.append({
+            "trace_id": trace_id,
+            "kind": root.kind,
+            "job_id": root.job_id,
+            "created_at": root.created_at.isoformat() if root.created_at else None,
+            "duration": root.duration,
+            "prompt_tokens": sum(row.prompt_tokens or 0 for row in rows),
+            "response_tokens": sum(row.response_tokens or 0 for row in rows),
+            "spans": [span_to_dict(row) for row in rows],
+        })
+    return result
@@ -1,19 +1,368 @@
 import fitz  # PyMuPDF
+import os
 import json
+import hashlib
+import threading
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
 import networkx as nx
 from docx import Document
+from docx.oxml import parse_xml
+from docx.oxml.ns import nsdecls
+from docx.oxml.table import CT_Tbl
+from xml.sax.saxutils import escape as xml_escape
 import re
+from difflib import SequenceMatcher
+from pdf_worker import extract_pages as _extract_pages
 
-def extract_text_from_pdf(path):
-    """Extracts text from a PDF file."""
-    text = ""
+# Page counts below this are extracted in-process; spawning workers costs more than it saves
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", 64))
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", min(4, os.cpu_count() or 1)))
+PDF_PAGES_PER_TASK = 16
+
+
+class PageTextCache:
+    """Thread-safe LRU of extracted page text keyed by (file hash, page number), bounded by total characters."""
+
+    def __init__(self, max_chars):
+        self.max_chars = max_chars
+        self.size = 0
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, file_hash, page_no):
+        with self._lock:
+            text = self._pages.get((file_hash, page_no))
+            if text is not None:
+                self._pages.move_to_end((file_hash, page_no))
+            return text
+
+    def put(self, file_hash, page_no, text):
+        if len(text) > self.max_chars:
+            return
+        with self._lock:
+            previous = self._pages.pop((file_hash, page_no), None)
+            if previous is not None:
+                self.size -= len(previous)
+            self._pages[(file_hash, page_no)] = text
+            self.size += len(text)
+            while self.size > self.max_chars:
+                _, evicted = self._pages.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+            self.size = 0
+
+
+page_cache = PageTextCache(int(os.getenv("PAGE_CACHE_MAX_CHARS", 50_000_000)))
+
+def parse_page_range(spec, page_count):
+    """Turns a 1-based spec like "1-3, 10, 200-" into sorted 0-based page numbers.
+
+    An empty spec selects every page. Raises ValueError on malformed input.
+    """
+    if not spec or not spec.strip():
+        return list(range(page_count))
+    pages = set()
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        match = re.fullmatch(r"(\d*)\s*-\s*(\d*)|(\d+)", part)
+        if not match or part == "-":
+            raise ValueError(f"Invalid page range '{part}'")
+        if match.group(3):
+            start = end = int(match.group(3))
+        else:
+            start = int(match.group(1) or 1)
+            end = int(match.group(2) or page_count)
+        if start < 1 or end < start:
+            raise ValueError(f"Invalid page range '{part}'")
+        pages.update(range(start - 1, min(end, page_count)))
+    return sorted(pages)
+
+def iter_pdf_pages(path, page_range=None, file_hash=None, workers=None):
+    """Yields the text of each selected page in order.
+
+    Large documents are fanned out across a process pool in batches, with at
+    most two batches per worker in flight so memory stays bounded. Pages are
+    served from and stored in ``page_cache`` keyed by the file's content hash.
+    """
+    file_hash = file_hash or file_sha256(path)
+    workers = PDF_EXTRACT_WORKERS if workers is None else workers
     with fitz.open(path) as doc:
-        for page in doc:
-            text += page.get_text()
-    return text
+        pages = parse_page_range(page_range, doc.page_count)
+        missing = [n for n in pages if page_cache.get(file_hash, n) is None]
+
+        if workers <= 1 or len(missing) < PDF_PARALLEL_MIN_PAGES:
+            for n in pages:
+                text = page_cache.get(file_hash, n)
+                if text is None:
+                    text = doc[n].get_text()
+                    page_cache.put(file_hash, n, text)
+                yield text
+            return
+
+    batches = [missing[i:i + PDF_PAGES_PER_TASK] for i in range(0, len(missing), PDF_PAGES_PER_TASK)]
+    extracted = {}
+    # spawn, not fork: callers run on worker threads of a multi-threaded server
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        in_flight = deque()
+        next_batch = 0
+        for n in pages:
+            text = page_cache.get(file_hash, n)
+            if text is None:
+                text = extracted.pop(n, None)
+            while text is None:
+                while next_batch < len(batches) and len(in_flight) < workers * 2:
+                    in_flight.append(executor.submit(_extract_pages, path, batches[next_batch]))
+                    next_batch += 1
+                if not in_flight:
+                    # Cached when we planned the batches but evicted since
+                    text = _extract_pages(path, [n])[0][1]
+                    break
+                for page_no, page_text in in_flight.popleft().result():
+                    page_cache.put(file_hash, page_no, page_text)
+                    extracted[page_no] = page_text
+                text = extracted.pop(n, None)
+            yield text
+
+def extract_text_from_pdf(path, page_range=None, file_hash=None):
+    """Extracts text from a PDF file, optionally limited to a page range such as "120-180"."""
+    return "".join(iter_pdf_pages(path, page_range=page_range, file_hash=file_hash))
+
+# Headings regulation texts are structured by; a chunk boundary is only ever placed before one of these
+SECTION_HEADING = re.compile(
+    r"^\s*(?:(?:article|section|chapter|title|part|annex|schedule)\s+[0-9ivxlcdm]+[a-z]?\b|\d+(?:\.\d+)*\.?\s+(?-i:[A-Z]))",
+    re.IGNORECASE | re.MULTILINE
+)
+
+def estimate_tokens(text):
+    """Rough token count for budgeting prompts (about four characters per token)."""
+    return len(text) // 4 + 1
+
+def _rescan_start(text):
+    """Where a heading search of ``text`` plus more text must restart to find every new match.
+
+    A heading match begins at a line start and may take in blank lines before
+    the heading, so the search restarts at the first line after the content
+    that precedes the last line with content.
+    """
+    end = len(text)
+    while end and text[end - 1].isspace():
+        end -= 1
+    start = text.rfind("\n", 0, end) + 1
+    while start and text[start - 1].isspace():
+        start -= 1
+    return text.find("\n", start) + 1 if start else 0
+
+def iter_sections(pages):
+    """Lazily splits a stream of page texts into sections starting at article/chapter/annex style headings.
+
+    Only the section currently being read is buffered, so this can consume
+    ``iter_pdf_pages`` without materializing the whole document. Each page
+    is searched once, plus the line it continues, so long stretches without
+    headings stay linear.
+    """
+    buffer = ""
+    scan_from = heading_end = 0
+    for page in pages:
+        buffer += page
+        matches = list(SECTION_HEADING.finditer(buffer, scan_from))
+        starts = [m.start() for m in matches]
+        # The last heading's section may continue on the next page
+        for a, b in zip([0] + starts, starts):
+            if buffer[a:b].strip():
+                yield buffer[a:b]
+        if starts:
+            last = matches[-1]
+            # Headings never overlap, so none can start inside the last one. One
+            # that runs to the end of the text may read differently with the next
+            # page, so it is searched again from its start.
+            heading_end = last.end() - last.start() if last.end() < len(buffer) else None
+            buffer = buffer[last.start():]
+        elif scan_from == 0:
+            heading_end = 0
+        scan_from = 0 if heading_end is None else max(_rescan_start(buffer), heading_end)
+    if buffer.strip():
+        yield buffer
+
+def split_sections(text):
+    """Splits text into sections starting at article/chapter/annex style headings."""
+    return list(iter_sections([text]))
+
+def _split_oversized(section, max_tokens):
+    """Splits a section that alone exceeds the budget on paragraph, then line boundaries."""
+    pieces = []
+    current = ""
+    for separator in ("\n\n", "\n"):
+        parts = section.split(separator)
+        if all(estimate_tokens(part) <= max_tokens for part in parts):
+            break
+    else:
+        max_chars = max_tokens * 4
+        return [section[i:i + max_chars] for i in range(0, len(section), max_chars)]
+    for part in parts:
+        candidate = current + separator + part if current else part
+        if current and estimate_tokens(candidate) > max_tokens:
+            pieces.append(current)
+            current = part
+        else:
+            current = candidate
+    if current:
+        pieces.append(current)
+    return pieces
+
+def iter_chunks(pages, max_tokens):
+    """Lazily packs consecutive sections from a stream of page texts into chunks of at most ``max_tokens``.
+
+    Boundaries follow section headings, so editing one article only changes
+    the chunk holding it (unless the edit pushes a boundary).
+    """
+    current = ""
+    for section in iter_sections(pages):
+        if estimate_tokens(section) > max_tokens:
+            if current:
+                yield current
+                current = ""
+            yield from _split_oversized(section, max_tokens)
+        elif current and estimate_tokens(current + section) > max_tokens:
+            yield current
+            current = section
+        else:
+            current += section
+    if current:
+        yield current
+
+def split_into_chunks(text, max_tokens):
+    """Splits text into section-aligned chunks of at most ``max_tokens`` estimated tokens."""
+    if estimate_tokens(text) <= max_tokens:
+        return [text]
+    return list(iter_chunks([text], max_tokens))
+
+def _section_key(section):
+    """Normalized heading used to align a section across versions, e.g. "article 5"."""
+    match = SECTION_HEADING.match(section)
+    if not match:
+        return None
+    return " ".join(match.group(0).lower().rstrip(".").split())
+
+def _normalize_section(section):
+    return " ".join(section.split())
+
+
+class SectionDiff:
+    """Result of aligning the sections of two versions of a document."""
+
+    def __init__(self):
+        self.unchanged = []
+        self.changed = []
+        self.added = []
+        self.removed = []
+
+    @property
+    def has_changes(self):
+        return bool(self.changed or self.added or self.removed)
+
+    def stats(self):
+        total = len(self.unchanged) + len(self.changed) + len(self.added)
+        skipped_tokens = sum(estimate_tokens(section) for section in self.unchanged)
+        sent_tokens = sum(estimate_tokens(new) for _, new in self.changed) + sum(estimate_tokens(s) for s in self.added)
+        return {
+            "sections": total,
+            "unchanged": len(self.unchanged),
+            "changed": len(self.changed),
+            "added": len(self.added),
+            "removed": len(self.removed),
+            "sections_skipped": len(self.unchanged),
+            "tokens_total": skipped_tokens + sent_tokens,
+            "tokens_skipped": skipped_tokens,
+        }
+
+    def changed_headings(self):
+        return [_section_heading(new) for _, new in self.changed] + [_section_heading(s) for s in self.added]
+
+    def changes_text(self):
+        """Compact description of what changed: full text of changed/added sections, headings otherwise."""
+        parts = []
+        if self.changed:
+            parts.append("AMENDED SECTIONS (current wording):")
+            parts.extend(new.strip() for _, new in self.changed)
+        if self.added:
+            parts.append("NEW SECTIONS:")
+            parts.extend(section.strip() for section in self.added)
+        if self.removed:
+            parts.append("REMOVED SECTIONS: " + "; ".join(_section_heading(s) for s in self.removed))
+        if self.unchanged:
+            parts.append("UNCHANGED SECTIONS: " + "; ".join(_section_heading(s) for s in self.unchanged))
+        return "\n\n".join(parts)
+
+
+def _section_heading(section):
+    return section.strip().split("\n", 1)[0][:120]
+
+def diff_sections(old_text, new_text):
+    """Aligns two versions section by section on their headings and classifies each section.
+
+    Sections are matched by normalized heading with a sequence matcher, so
+    inserted, deleted and duplicate headings stay aligned; text without a
+    recognizable heading falls back to matching on its content.
+    """
+    result = SectionDiff()
+    old_sections = split_sections(old_text)
+    new_sections = split_sections(new_text)
+    old_keys = [_section_key(s) or _normalize_section(s) for s in old_sections]
+    new_keys = [_section_key(s) or _normalize_section(s) for s in new_sections]
+
+    matcher = SequenceMatcher(None, old_keys, new_keys, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "insert":
+            result.added.extend(new_sections[j1:j2])
+            continue
+        if tag == "delete":
+            result.removed.extend(old_sections[i1:i2])
+            continue
+        # "equal" pairs share a heading; "replace" pairs are positional best guesses
+        pairs = min(i2 - i1, j2 - j1)
+        for old, new in zip(old_sections[i1:i1 + pairs], new_sections[j1:j1 + pairs]):
+            if _normalize_section(old) == _normalize_section(new):
+                result.unchanged.append(new)
+            elif tag == "equal":
+                result.changed.append((old, new))
+            else:
+                result.removed.append(old)
+                result.added.append(new)
+        result.removed.extend(old_sections[i1 + pairs:i2])
+        result.added.extend(new_sections[j1 + pairs:j2])
+    return result
+
+def file_sha256(path):
+    """Returns the SHA-256 hex digest of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+# (label, relationship field) pairs shown in the vis.js edge tooltip
+EDGE_TOOLTIP_FIELDS = (
+    ("Verb", "verb"),
+    ("Optionality", "Optionality"),
+    ("Condition", "Condition for Relationship to be Active"),
+    ("Property", "Property of Object (part of condition)"),
+    ("Thresholds", "Thresholds"),
+    ("Frequency", "frequency"),
+)
 
 def parse_graph_data(relationship_json):
-    """Parses entity relationship JSON into NetworkX DiGraph with vis.js-compatible properties."""
+    """Parses entity relationship JSON into NetworkX DiGraph with vis.js-compatible properties.
+
+    A DiGraph keeps one edge per entity pair. Storage and rendering use
+    graph_store.RelationGraph instead, which keeps every relationship.
+    """
     if isinstance(relationship_json, str):
         relationship_json = json.loads(relationship_json)
 
@@ -23,15 +372,7 @@ def parse_graph_data(relationship_json):
         G.add_node(entity["id"], label=entity["name"], group=entity["type"])
 
     for rel in relationship_json.get("relationships", []):
-        tooltip_lines = [
-            f"Verb: {rel.get('verb', '')}",
-            f"Optionality: {rel.get('Optionality', '')}",
-            f"Condition: {rel.get('Condition for Relationship to be Active', '')}",
-            f"Property: {rel.get('Property of Object (part of condition)', '')}",
-            f"Thresholds: {rel.get('Thresholds', '')}",
-            f"Frequency: {rel.get('frequency', '')}"
-        ]
-        tooltip_text = "\n".join(tooltip_lines)
+        tooltip_text = "\n".join(f"{label}: {rel.get(field, '')}" for label, field in EDGE_TOOLTIP_FIELDS)
 
         G.add_edge(
             rel["subject_id"],
@@ -42,6 +383,50 @@ def parse_graph_data(relationship_json):
 
     return G
 
+GRAPH_LAYOUT_SEED = 42
+GRAPH_LAYOUT_ITERATIONS = 100
+# networkx switches to its slower sparse solver from 500 nodes; fewer iterations keep big layouts to seconds
+GRAPH_LAYOUT_LARGE_ITERATIONS = 50
+# Spring layout grows quadratically with the node count (about 5s at 1000 nodes); larger graphs
+# are stored without positions and laid out by vis.js in the browser instead of the upload job
+GRAPH_LAYOUT_MAX_NODES = int(os.getenv("GRAPH_LAYOUT_MAX_NODES", 1000))
+
+def _spring_positions(G, initial=None, seed=GRAPH_LAYOUT_SEED):
+    """Seeded spring layout of ``G`` in unit coordinates; nodes in ``initial`` keep their positions."""
+    if not len(G):
+        return {}
+    fixed = [n for n in G if n in initial] if initial else None
+    if fixed and len(fixed) == len(G):
+        return {n: tuple(initial[n]) for n in G}
+    pos = nx.spring_layout(
+        G.to_undirected(as_view=True),
+        pos={n: initial[n] for n in fixed} if fixed else None,
+        fixed=fixed or None,
+        iterations=GRAPH_LAYOUT_ITERATIONS if len(G) < 500 else GRAPH_LAYOUT_LARGE_ITERATIONS,
+        seed=seed
+    )
+    return {n: tuple(float(c) for c in xy) for n, xy in pos.items()}
+
+def layout_graphs(G_old, G_new):
+    """Deterministic vis.js coordinates for the old and new graph of an upload.
+
+    The old graph (when present) is laid out first; nodes shared with the new
+    graph are pinned to the same coordinates so only added nodes move. Both
+    layouts use one pixel scale based on the larger graph. Returns
+    ``(old_positions, new_positions)`` mapping node ID to ``{"x", "y"}``;
+    both are empty when either graph has more than GRAPH_LAYOUT_MAX_NODES nodes.
+    """
+    if max(len(G_old) if G_old is not None else 0, len(G_new)) > GRAPH_LAYOUT_MAX_NODES:
+        return ({} if G_old is not None else None), {}
+    old_unit = _spring_positions(G_old) if G_old is not None else {}
+    new_unit = _spring_positions(G_new, initial=old_unit)
+    scale = max(300, 120 * max(len(old_unit), len(new_unit)) ** 0.5)
+
+    def to_pixels(unit):
+        return {n: {"x": round(x * scale, 1), "y": round(y * scale, 1)} for n, (x, y) in unit.items()}
+
+    return (to_pixels(old_unit) if G_old is not None else None), to_pixels(new_unit)
+
 def compare_graphs(G_old, G_new):
     """Compares old and new graphs to identify changed edges and nodes."""
     changed_edges = []
@@ -59,31 +444,426 @@ def compare_graphs(G_old, G_new):
 
     return changed_edges, added_nodes, removed_nodes
 
-def markdown_to_docx(doc: Document, text: str):
-    lines = text.split('\n')
-    for line in lines:
-        stripped = line.strip()
-        if not stripped:
-            doc.add_paragraph()
+_NAME_TOKEN = re.compile(r"[a-z0-9]+")
+_NAME_STOPWORDS = frozenset(("the", "of", "and", "a", "an", "for", "to", "in", "on", "by", "with", "or"))
+# "Tier 1" and "Tier 2", or "Article 5" and "Article 6", name different things however alike they read
+_NAME_ORDINAL = re.compile(
+    r"^(?:\d+(?:st|nd|rd|th)?|ii|iii|iv|vi{0,3}|ix|x|first|second|third|fourth|fifth|sixth|seventh|eighth|ninth|tenth)$"
+)
+
+def _name_tokens(name):
+    return [t for t in _NAME_TOKEN.findall((name or "").lower()) if t not in _NAME_STOPWORDS]
+
+def _ordinal_tokens(tokens):
+    return {t for t in tokens if _NAME_ORDINAL.match(t)}
+
+def _jaccard(a, b):
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+def align_entities(old_data, new_data, threshold=0.6, max_block_size=50):
+    """Matches new entities to old ones by normalized name, type and neighbourhood.
+
+    LLM-assigned IDs are regenerated on every run, so they cannot be used to
+    line versions up. Candidates are found through an inverted index on name
+    tokens (tokens shared by more than ``max_block_size`` old entities are
+    too common to block on), scored, and assigned greedily one-to-one:
+    entities with the same normalized name are paired first, so a changed
+    type cannot hand an exact name to a look-alike, and the rest are fuzzy
+    matched. Names that differ in a number or ordinal never fuzzy match.
+    Returns a dict mapping new entity ID to old entity ID.
+    """
+    old_entities = old_data.get("entities", [])
+    new_entities = new_data.get("entities", [])
+
+    def profile(data):
+        names = {e["id"]: " ".join(_name_tokens(e.get("name"))) for e in data.get("entities", [])}
+        neighbours = {entity_id: set() for entity_id in names}
+        for rel in data.get("relationships", []):
+            subject, obj, verb = rel.get("subject_id"), rel.get("object_id"), (rel.get("verb") or "").lower()
+            if subject in neighbours:
+                neighbours[subject].add((verb, ">", names.get(obj, "")))
+            if obj in neighbours:
+                neighbours[obj].add((verb, "<", names.get(subject, "")))
+        return names, neighbours
+
+    old_names, old_neighbours = profile(old_data)
+    new_names, new_neighbours = profile(new_data)
+    old_types = {e["id"]: (e.get("type") or "").lower() for e in old_entities}
+
+    index = {}
+    by_name = {}
+    for entity in old_entities:
+        by_name.setdefault(old_names[entity["id"]], []).append(entity["id"])
+        for token in set(old_names[entity["id"]].split()):
+            index.setdefault(token, []).append(entity["id"])
+
+    scored = []
+    for entity in new_entities:
+        new_id, name = entity["id"], new_names[entity["id"]]
+        tokens = set(name.split())
+        candidates = set(by_name.get(name, []))
+        for token in tokens:
+            block = index.get(token, [])
+            if len(block) <= max_block_size:
+                candidates.update(block)
+        for old_id in candidates:
+            old_name = old_names[old_id]
+            exact = name == old_name
+            if exact:
+                name_score = 1.0
+            else:
+                old_tokens = set(old_name.split())
+                if _ordinal_tokens(tokens) != _ordinal_tokens(old_tokens):
+                    continue
+                name_score = max(SequenceMatcher(None, name, old_name).ratio(), _jaccard(tokens, old_tokens))
+            type_score = 1.0 if (entity.get("type") or "").lower() == old_types[old_id] else 0.0
+            neighbour_score = _jaccard(new_neighbours[new_id], old_neighbours[old_id])
+            score = 0.6 * name_score + 0.15 * type_score + 0.25 * neighbour_score
+            if exact or score >= threshold:
+                scored.append((exact, score, new_id, old_id))
+
+    mapping, taken = {}, set()
+    for _, score, new_id, old_id in sorted(scored, key=lambda c: (c[0], c[1]), reverse=True):
+        if new_id not in mapping and old_id not in taken:
+            mapping[new_id] = old_id
+            taken.add(old_id)
+    return mapping
+
+def remap_entity_ids(new_data, mapping, old_data):
+    """Rewrites new entity IDs to their matched old IDs; unmatched entities get IDs unused by either version."""
+    used = {e["id"] for e in old_data.get("entities", [])} | set(mapping.values())
+    counter = len(used)
+    ids = dict(mapping)
+    for entity in new_data.get("entities", []):
+        if entity["id"] in ids:
             continue
-        if stripped.startswith("###"):
-            doc.add_heading(stripped.lstrip("#").strip(), level=3)
-        elif stripped.startswith("##"):
-            doc.add_heading(stripped.lstrip("#").strip(), level=2)
-        elif stripped.startswith("#"):
-            doc.add_heading(stripped.lstrip("#").strip(), level=1)
-        elif stripped.startswith("- "):
-            doc.add_paragraph(stripped[2:], style='List Bullet')
-        elif re.match(r'^\d+\.\s', stripped):
-            doc.add_paragraph(re.sub(r'^\d+\.\s', '', stripped), style='List Number')
-        elif "**" in stripped:
-            para = doc.add_paragraph()
-            while "**" in stripped:
-                before, bold, rest = stripped.split("**", 2)
-                para.add_run(before)
-                bold_run = para.add_run(bold)
-                bold_run.bold = True
-                stripped = rest
-            para.add_run(stripped)
+        candidate = entity["id"]
+        while candidate in used:
+            counter += 1
+            candidate = f"E{counter}"
+        ids[entity["id"]] = candidate
+        used.add(candidate)
+
+    return {
+        **new_data,
+        "entities": [{**e, "id": ids[e["id"]]} for e in new_data.get("entities", [])],
+        "relationships": [
+            {**r, "subject_id": ids.get(r["subject_id"], r["subject_id"]), "object_id": ids.get(r["object_id"], r["object_id"])}
+            for r in new_data.get("relationships", [])
+        ],
+    }
+
+# Relationship attributes compared by diff_relationships, keyed by the label shown to analysts
+EDGE_DIFF_FIELDS = {
+    "verb": "verb",
+    "Optionality": "Optionality",
+    "Condition": "Condition for Relationship to be Active",
+    "Property": "Property of Object (part of condition)",
+    "Thresholds": "Thresholds",
+    "frequency": "frequency",
+}
+
+def _edge_record(rel, entities):
+    return {
+        "key": f"{rel['subject_id']}->{rel['object_id']}",
+        "from": rel["subject_id"],
+        "to": rel["object_id"],
+        "from_label": entities.get(rel["subject_id"], {}).get("name") or rel.get("subject_name") or rel["subject_id"],
+        "to_label": entities.get(rel["object_id"], {}).get("name") or rel.get("object_name") or rel["object_id"],
+        "attributes": {label: rel.get(field, "") for label, field in EDGE_DIFF_FIELDS.items()},
+    }
+
+def _match_parallel_edges(old_rels, new_rels):
+    """Pairs relationships between the same subject and object: same verb first, then in order."""
+    old_left, new_left, pairs = list(old_rels), [], []
+    for rel in new_rels:
+        match = next((o for o in old_left if o.get("verb") == rel.get("verb")), None)
+        if match is None:
+            new_left.append(rel)
+        else:
+            old_left.remove(match)
+            pairs.append((match, rel))
+    while old_left and new_left:
+        pairs.append((old_left.pop(0), new_left.pop(0)))
+    return pairs, old_left, new_left
+
+def match_relationships(old_data, new_data):
+    """Yields ``(matched, removed, added)`` per (subject_id, object_id) pair of two entity-relationship dicts.
+
+    ``matched`` holds (old, new) relationship pairs, parallel relationships
+    paired by verb first; the yielded dicts are the ones in the inputs.
+    """
+    def by_pair(data):
+        groups = {}
+        for rel in data.get("relationships", []):
+            groups.setdefault((rel["subject_id"], rel["object_id"]), []).append(rel)
+        return groups
+
+    old_groups = by_pair(old_data)
+    new_groups = by_pair(new_data)
+    for pair in list(new_groups) + [p for p in old_groups if p not in new_groups]:
+        yield _match_parallel_edges(old_groups.get(pair, []), new_groups.get(pair, []))
+
+def diff_relationships(old_data, new_data):
+    """Structured diff of two entity-relationship JSON documents.
+
+    Relationships are matched on (subject_id, object_id), with parallel
+    relationships paired by verb, and compared attribute by attribute.
+    Returns a JSON-serializable dict of added, removed and modified edges
+    (with the fields that changed) and added, removed and modified nodes.
+    """
+    if isinstance(old_data, str):
+        old_data = json.loads(old_data)
+    if isinstance(new_data, str):
+        new_data = json.loads(new_data)
+
+    old_entities = {e["id"]: e for e in old_data.get("entities", [])}
+    new_entities = {e["id"]: e for e in new_data.get("entities", [])}
+
+    added_edges, removed_edges, modified_edges = [], [], []
+    for pairs, removed, added in match_relationships(old_data, new_data):
+        for old_rel, new_rel in pairs:
+            changes = {
+                label: {"old": old_rel.get(field, ""), "new": new_rel.get(field, "")}
+                for label, field in EDGE_DIFF_FIELDS.items()
+                if (old_rel.get(field) or "") != (new_rel.get(field) or "")
+            }
+            if changes:
+                record = _edge_record(new_rel, new_entities)
+                record["old_attributes"] = _edge_record(old_rel, old_entities)["attributes"]
+                record["changes"] = changes
+                modified_edges.append(record)
+        removed_edges.extend(_edge_record(rel, old_entities) for rel in removed)
+        added_edges.extend(_edge_record(rel, new_entities) for rel in added)
+
+    def node(entity):
+        return {"id": entity["id"], "label": entity.get("name", ""), "group": entity.get("type", "")}
+
+    modified_nodes = []
+    for entity_id in old_entities.keys() & new_entities.keys():
+        old, new = old_entities[entity_id], new_entities[entity_id]
+        changes = {
+            field: {"old": old.get(field, ""), "new": new.get(field, "")}
+            for field in ("name", "type") if old.get(field) != new.get(field)
+        }
+        if changes:
+            modified_nodes.append({**node(new), "changes": changes})
+
+    result = {
+        "added_edges": added_edges,
+        "removed_edges": removed_edges,
+        "modified_edges": modified_edges,
+        "added_nodes": [node(e) for i, e in new_entities.items() if i not in old_entities],
+        "removed_nodes": [node(e) for i, e in old_entities.items() if i not in new_entities],
+        "modified_nodes": sorted(modified_nodes, key=lambda n: n["id"]),
+    }
+    result["summary"] = {name: len(items) for name, items in result.items()}
+    return result
+
+_MD_HEADING = re.compile(r"^(#{1,6})\s*(.*?)[\s#]*$")
+_MD_LIST_ITEM = re.compile(r"^([ \t]*)([-*+]|\d+[.)])\s+(.*)$")
+_MD_RULE = re.compile(r"^ {0,3}([-*_])(?:\s*\1){2,}\s*$")
+_MD_FENCE = re.compile(r"^\s*(```|~~~)")
+_MD_TABLE_ROW = re.compile(r"^\s*\|.*\|\s*$")
+_MD_TABLE_DIVIDER = re.compile(r"^\s*\|?(?:\s*:?-+:?\s*\|)+(?:\s*:?-+:?\s*)?$")
+_MD_CELL_SPLIT = re.compile(r"(?<!\\)\|")
+_MD_INLINE_MARKER = re.compile(r"[*_`]")
+_MD_INLINE = re.compile(
+    r"\*\*(?=\S)(.+?)(?<=\S)\*\*"
+    r"|__(?=\S)(.+?)(?<=\S)__"
+    r"|(?<![*\w])\*(?=[^\s*])(.+?)(?<=[^\s*])\*(?![*\w])"
+    r"|(?<![_\w])_(?=[^\s_])(.+?)(?<=[^\s_])_(?![_\w])"
+    r"|`([^`]+)`"
+)
+_XML_INVALID_CHARS = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]")
+_W_NAMESPACE = nsdecls("w")
+MD_LIST_MAX_DEPTH = 3
+MD_CODE_FONT = "Courier New"
+
+def _run_xml(text, bold=False, italic=False, code=False):
+    """One ``w:r`` element as XML; tabs and newlines become ``w:tab``/``w:br`` as with Run.text."""
+    text = xml_escape(_XML_INVALID_CHARS.sub("", text))
+    text = text.replace("\t", '</w:t><w:tab/><w:t xml:space="preserve">')
+    text = text.replace("\n", '</w:t><w:br/><w:t xml:space="preserve">')
+    properties = (
+        (f'<w:rFonts w:ascii="{MD_CODE_FONT}" w:hAnsi="{MD_CODE_FONT}"/>' if code else "")
+        + ("<w:b/>" if bold else "")
+        + ("<w:i/>" if italic else "")
+    )
+    if properties:
+        properties = f"<w:rPr>{properties}</w:rPr>"
+    return f'<w:r>{properties}<w:t xml:space="preserve">{text}</w:t></w:r>'
+
+class MarkdownDocxWriter:
+    """Incremental markdown-to-docx converter: text can be fed as it streams in.
+
+    Lines are tokenized once each as they complete (the trailing partial line
+    waits for the next chunk or ``close()``). Supports headings, nested bullet
+    and numbered lists, pipe tables, fenced code, horizontal rules and inline
+    bold, italics and ``code``; markers without a closing pair stay literal.
+    Consecutive text lines are joined into one paragraph, and a table is
+    written once its last row has arrived.
+    """
+
+    def __init__(self, doc):
+        self.doc = doc
+        self._pending = ""
+        self._block = None  # (style, [text lines]) of the paragraph being collected
+        self._table = []
+        self._code = None
+        self._style_ids = {}
+        # python-docx finds the trailing sectPr (and, for tables, the page
+        # width) by scanning the body on every insert, which is quadratic on
+        # long documents, so both are looked up once.
+        self._end = doc.element.body.sectPr
+        self._table_width = None
+
+    def feed(self, text):
+        lines = (self._pending + text).split("\n")
+        self._pending = lines.pop()
+        for line in lines:
+            self._write_line(line)
+
+    def close(self):
+        if self._pending:
+            self._write_line(self._pending)
+        self._pending = ""
+        if self._code is not None:
+            self._flush_code()
+        self._flush()
+        return self.doc
+
+    def _style_id(self, name, fallback=None):
+        # Setting Paragraph.style by name scans every style in the document,
+        # so IDs are resolved once per document and written to pStyle directly.
+        if name not in self._style_ids:
+            try:
+                self._style_ids[name] = self.doc.styles[name].style_id
+            except KeyError:
+                self._style_ids[name] = self._style_id(fallback) if fallback else None
+        return self._style_ids[name]
+
+    def _paragraph(self, runs, style=None, fallback=None):
+        # Runs are written as one XML fragment per paragraph: building them
+        # through Paragraph.add_run costs several element insertions each.
+        style_id = self._style_id(style, fallback) if style else None
+        properties = f'<w:pPr><w:pStyle w:val="{style_id}"/></w:pPr>' if style_id else ""
+        return parse_xml(f"<w:p {_W_NAMESPACE}>{properties}{runs}</w:p>")
+
+    def _inline_runs(self, text, bold=False):
+        if not _MD_INLINE_MARKER.search(text):
+            return _run_xml(text, bold=bold) if text else ""
+        runs = []
+        pos = 0
+        for match in _MD_INLINE.finditer(text):
+            if match.start() > pos:
+                runs.append(_run_xml(text[pos:match.start()], bold=bold))
+            strong, strong_alt, emphasis, emphasis_alt, code = match.groups()
+            if code is not None:
+                runs.append(_run_xml(code, bold=bold, code=True))
+            elif strong is not None or strong_alt is not None:
+                runs.append(_run_xml(strong if strong is not None else strong_alt, bold=True))
+            else:
+                runs.append(_run_xml(emphasis if emphasis is not None else emphasis_alt, bold=bold, italic=True))
+            pos = match.end()
+        if pos < len(text):
+            runs.append(_run_xml(text[pos:], bold=bold))
+        return "".join(runs)
+
+    def _insert(self, element):
+        if self._end is not None:
+            self._end.addprevious(element)
         else:
-            doc.add_paragraph(stripped)
+            self.doc.element.body.append(element)
+
+    def _add_paragraph(self, text, style=None, fallback=None):
+        self._insert(self._paragraph(self._inline_runs(text), style, fallback))
+
+    def _flush(self):
+        if self._block is not None:
+            style, lines = self._block
+            self._block = None
+            fallback = "List Bullet" if style and style.startswith("List Bullet") else "List Number"
+            self._add_paragraph(" ".join(lines), style, fallback)
+        if self._table:
+            self._flush_table()
+
+    def _flush_table(self):
+        rows, self._table = self._table, []
+        has_header = len(rows) > 1 and _MD_TABLE_DIVIDER.match(rows[1])
+        if has_header:
+            del rows[1]
+        cells = [
+            [cell.strip().replace("\\|", "|") for cell in _MD_CELL_SPLIT.split(row.strip().strip("|"))]
+            for row in rows
+        ]
+        if self._table_width is None:
+            self._table_width = self.doc._block_width
+        table = CT_Tbl.new_tbl(len(cells), max(len(row) for row in cells), self._table_width)
+        style_id = self._style_id("Table Grid")
+        if style_id:
+            table.tblPr.style = style_id
+        self._insert(table)
+        for i, (tr, values) in enumerate(zip(table.tr_lst, cells)):
+            for tc, value in zip(tr.tc_lst, values):
+                tc.replace(tc.p_lst[0], self._paragraph(self._inline_runs(value, bold=has_header and i == 0)))
+
+    def _flush_code(self):
+        lines, self._code = self._code, None
+        runs = _run_xml("\n".join(lines), code=True) if lines else ""
+        self._insert(self._paragraph(runs))
+
+    def _write_line(self, line):
+        if self._code is not None:
+            if _MD_FENCE.match(line):
+                self._flush_code()
+            else:
+                self._code.append(line)
+            return
+
+        stripped = line.strip()
+        if self._table and not _MD_TABLE_ROW.match(line) and not (len(self._table) == 1 and _MD_TABLE_DIVIDER.match(line)):
+            self._flush_table()
+        if not stripped:
+            self._flush()
+            return
+        if _MD_TABLE_ROW.match(line) or (len(self._table) == 1 and _MD_TABLE_DIVIDER.match(line)):
+            if not self._table:
+                self._flush()
+            self._table.append(line)
+            return
+        if _MD_FENCE.match(line):
+            self._flush()
+            self._code = []
+            return
+        if stripped[0] == "#":
+            heading = _MD_HEADING.match(stripped)
+            self._flush()
+            self._add_paragraph(heading.group(2), f"Heading {len(heading.group(1))}")
+            return
+        if _MD_RULE.match(line):
+            self._flush()
+            self._add_paragraph("")
+            return
+        item = _MD_LIST_ITEM.match(line)
+        if item:
+            self._flush()
+            indent = len(item.group(1).expandtabs(4))
+            depth = min(indent // 2, MD_LIST_MAX_DEPTH - 1)
+            kind = "List Bullet" if item.group(2) in "-*+" else "List Number"
+            self._block = (kind if depth == 0 else f"{kind} {depth + 1}", [item.group(3).strip()])
+            return
+        if self._block is not None and self._block[0] and line[:1] not in (" ", "\t"):
+            # An unindented line after a list item starts a new paragraph
+            self._flush()
+        if self._block is None:
+            self._block = (None, [])
+        self._block[1].append(stripped)
+
+
+def markdown_to_docx(doc: Document, text: str):
+    writer = MarkdownDocxWriter(doc)
+    writer.feed(text)
+    writer.close()
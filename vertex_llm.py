@@ -1,22 +1,258 @@
 import os
-import re
 import json
+import time
+import random
+import logging
+import sqlite3
+import hashlib
+import threading
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from google.oauth2.credentials import Credentials
-import vertexai
-from vertexai.generative_models import GenerativeModel
+from google.api_core import exceptions as api_exceptions
+import tracing
+from llm_client import llm_client
+from utils import split_into_chunks, estimate_tokens
+from entity_schema import ENTITY_RELATIONSHIP_SCHEMA, parse_json_response, validate_entity_relationships
 
 load_dotenv()
 
-def init_vertexai():
-    token_path = os.path.join(os.getenv("WIF_HOME"), "wif_token.txt")
-    with open(token_path, "r") as f:
-        access_token = f.read().strip()
-    credentials = Credentials(token=access_token, scopes=["https://www.googleapis.com/auth/cloud-platform"])
-    vertexai.init(project=os.getenv("PROJECT_NAME"), location=os.getenv("LOCATION"), credentials=credentials)
+logger = logging.getLogger(__name__)
 
-def get_summary_with_context(text, context=None):
-    model = GenerativeModel(os.getenv("GEMINI_MODEL"))
+# Bump whenever a prompt below changes so cached responses for the old wording are not reused
+PROMPT_VERSION = "1"
+GENERATION_CONFIG = {"temperature": 0.01, "top_p": 0.1, "top_k": 40}
+
+# Entity extraction asks for schema-constrained JSON where the model supports it
+STRUCTURED_OUTPUT = os.getenv("STRUCTURED_OUTPUT", "1") == "1"
+STRUCTURED_GENERATION_CONFIG = {
+    **GENERATION_CONFIG,
+    "response_mime_type": "application/json",
+    "response_schema": ENTITY_RELATIONSHIP_SCHEMA,
+}
+# Models that rejected the JSON response mode; entity calls run on worker threads
+_structured_unsupported = set()
+_structured_lock = threading.Lock()
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", 3))
+ENTITY_MAX_ATTEMPTS = int(os.getenv("ENTITY_MAX_ATTEMPTS", LLM_MAX_ATTEMPTS))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", 2.0))
+# Worth another attempt: bad output (ValueError, including blocked responses) and transient API errors
+RETRYABLE_ERRORS = (
+    ValueError,
+    api_exceptions.ResourceExhausted,
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.DeadlineExceeded,
+    api_exceptions.InternalServerError,
+)
+
+# Documents above this estimated token count are summarized chunk by chunk and then reduced
+SUMMARY_CHUNK_TOKENS = int(os.getenv("SUMMARY_CHUNK_TOKENS", 30000))
+SUMMARY_MAX_PARALLEL = int(os.getenv("SUMMARY_MAX_PARALLEL", 4))
+
+
+class LLMCache:
+    """Persistent SQLite cache of LLM responses, keyed by a hash of everything that shapes the answer.
+
+    Entries older than ``max_age`` seconds are ignored and purged; beyond
+    ``max_entries`` the least recently used ones are evicted.
+    """
+
+    def __init__(self, path, max_entries=5000, max_age=30 * 24 * 3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = {}
+        self.misses = {}
+        self._lock = threading.Lock()
+        self._initialized = False
+
+    @staticmethod
+    def make_key(kind, model_name, text, context=None, generation_config=None):
+        def digest(value):
+            return hashlib.sha256((value or "").encode("utf-8")).hexdigest()
+
+        material = json.dumps([
+            kind,
+            model_name,
+            PROMPT_VERSION,
+            digest(text),
+            digest(context),
+            generation_config or {}
+        ], sort_keys=True)
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        if not self._initialized:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "key TEXT PRIMARY KEY, kind TEXT, response TEXT, created_at REAL, last_used REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_llm_cache_last_used ON llm_cache (last_used)")
+            self._initialized = True
+        return conn
+
+    def _count(self, counter, kind):
+        with self._lock:
+            counter[kind] = counter.get(kind, 0) + 1
+
+    def get(self, key, kind):
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute(
+                "SELECT response FROM llm_cache WHERE key = ? AND created_at >= ?",
+                (key, now - self.max_age)
+            ).fetchone()
+            if row:
+                conn.execute("UPDATE llm_cache SET last_used = ? WHERE key = ?", (now, key))
+        self._count(self.hits if row else self.misses, kind)
+        return row[0] if row else None
+
+    def put(self, key, kind, response):
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, kind, response, created_at, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, kind, response, now, now)
+            )
+            conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - self.max_age,))
+            conn.execute(
+                "DELETE FROM llm_cache WHERE key IN ("
+                "SELECT key FROM llm_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def stats(self):
+        with closing(self._connect()) as conn, conn:
+            entries = conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        with self._lock:
+            hits, misses = dict(self.hits), dict(self.misses)
+        return {
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "max_age_seconds": self.max_age,
+            "hits": hits,
+            "misses": misses,
+        }
+
+
+llm_cache = LLMCache(
+    os.getenv("LLM_CACHE_PATH", "llm_cache.db"),
+    max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", 5000)),
+    max_age=float(os.getenv("LLM_CACHE_MAX_AGE_DAYS", 30)) * 24 * 3600
+)
+
+
+_metrics_lock = threading.Lock()
+call_metrics = {}
+
+def _record(kind, counter, n=1):
+    with _metrics_lock:
+        counters = call_metrics.setdefault(kind, {"calls": 0, "attempts": 0, "retries": 0, "repairs": 0, "failures": 0})
+        counters[counter] += n
+
+def get_call_metrics():
+    """Per call kind: model calls, attempts, retries, repaired responses and calls that failed for good."""
+    with _metrics_lock:
+        return {kind: dict(counters) for kind, counters in call_metrics.items()}
+
+def _cached_generate(kind, prompt, text, context, use_cache, postprocess=None, generation_config=None, max_attempts=LLM_MAX_ATTEMPTS):
+    """Runs ``prompt`` through Gemini unless an equivalent call is cached.
+
+    ``use_cache=False`` skips the lookup but still stores the fresh answer.
+    ``postprocess`` validates/cleans the raw response before it is cached; if
+    it raises ValueError (or the API fails transiently) only this call is
+    retried, up to ``max_attempts`` times with exponential backoff.
+    """
+    model_name = os.getenv("GEMINI_MODEL")
+    config = generation_config or GENERATION_CONFIG
+    key = LLMCache.make_key(kind, model_name, text, context, config)
+    with tracing.span(f"llm.{kind}") as call:
+        if use_cache:
+            cached = llm_cache.get(key, kind)
+            if cached is not None:
+                call.set(cache="hit")
+                return cached
+        call.set(cache="miss" if use_cache else "bypass")
+        if model_name:
+            call.set(model=model_name)
+
+        _record(kind, "calls")
+        for attempt in range(1, max_attempts + 1):
+            _record(kind, "attempts")
+            call.set(attempts=attempt)
+            try:
+                response = llm_client.generate(model_name, prompt, config)
+                # Every attempt is billed, so failed ones count towards the tokens too
+                tracing.record_llm_usage(kind, getattr(response, "usage_metadata", None))
+                result = postprocess(response.text) if postprocess else response.text
+                break
+            except RETRYABLE_ERRORS as e:
+                if attempt == max_attempts:
+                    _record(kind, "failures")
+                    raise
+                _record(kind, "retries")
+                delay = LLM_RETRY_BASE_DELAY * 2 ** (attempt - 1) * (1 + random.random() / 4)
+                logger.warning("%s call failed (attempt %d/%d): %s; retrying in %.1fs", kind, attempt, max_attempts, e, delay)
+                time.sleep(delay)
+        llm_cache.put(key, kind, result)
+        return result
+
+def _cached_stream(kind, prompt, text, context, use_cache, max_attempts=LLM_MAX_ATTEMPTS):
+    """Streaming counterpart of _cached_generate, sharing its cache entries.
+
+    A cached answer is yielded in one piece; a fresh one chunk by chunk and
+    cached once the stream completes. Transient failures are retried only
+    while nothing has been yielded yet.
+    """
+    model_name = os.getenv("GEMINI_MODEL")
+    key = LLMCache.make_key(kind, model_name, text, context, GENERATION_CONFIG)
+    with tracing.span(f"llm.{kind}") as call:
+        if use_cache:
+            cached = llm_cache.get(key, kind)
+            if cached is not None:
+                call.set(cache="hit")
+                yield cached
+                return
+        call.set(cache="miss" if use_cache else "bypass")
+        if model_name:
+            call.set(model=model_name)
+
+        _record(kind, "calls")
+        parts = []
+        for attempt in range(1, max_attempts + 1):
+            _record(kind, "attempts")
+            call.set(attempts=attempt)
+            # Usage is reported cumulatively while streaming; only the last report counts
+            usage = []
+            try:
+                for chunk in llm_client.generate_stream(model_name, prompt, GENERATION_CONFIG, on_usage=usage.append):
+                    parts.append(chunk)
+                    yield chunk
+                break
+            except RETRYABLE_ERRORS as e:
+                if parts or attempt == max_attempts:
+                    _record(kind, "failures")
+                    raise
+                _record(kind, "retries")
+                delay = LLM_RETRY_BASE_DELAY * 2 ** (attempt - 1) * (1 + random.random() / 4)
+                logger.warning("%s stream failed (attempt %d/%d): %s; retrying in %.1fs", kind, attempt, max_attempts, e, delay)
+                time.sleep(delay)
+            finally:
+                tracing.record_llm_usage(kind, usage[-1] if usage else None)
+        llm_cache.put(key, kind, "".join(parts))
+
+def init_llm():
+    """Prepares the configured LLM provider; only the Vertex provider needs credentials."""
+    llm_client.init()
+
+# Older app modules still import the original name
+init_vertexai = init_llm
+
+def get_summary_with_context(text, context=None, use_cache=True):
+    chunks = split_into_chunks(text, SUMMARY_CHUNK_TOKENS)
+    if len(chunks) > 1:
+        return _map_reduce_summary(chunks, context, use_cache)
     if context:
         prompt = f"""
                     You are an AI assistant for analyzing financial regulation documents.
@@ -39,11 +275,100 @@ def get_summary_with_context(text, context=None):
                     Input:
                     {text}
                 """
-    response = model.generate_content(prompt, generation_config={"temperature": 0.01, "top_p": 0.1, "top_k": 40}))
-    return response.text
+    return _cached_generate("summary", prompt, text, context, use_cache)
+
+def _map_reduce_summary(chunks, context, use_cache):
+    """Summarizes chunks concurrently, then merges the partial summaries into one.
+
+    Chunk summaries are cached on the chunk text alone, so re-running after an
+    edit only calls the model for chunks whose text changed. The previous
+    year's context is only applied in the final reduce step.
+    """
+    with ThreadPoolExecutor(max_workers=SUMMARY_MAX_PARALLEL) as executor:
+        futures = [
+            tracing.submit(executor, _summarize_chunk, chunk, index, len(chunks), use_cache)
+            for index, chunk in enumerate(chunks, 1)
+        ]
+        partials = [future.result() for future in futures]
+
+    # Merge in groups while the partial summaries themselves exceed the budget
+    while len(partials) > 1 and estimate_tokens("\n\n".join(partials)) > SUMMARY_CHUNK_TOKENS:
+        groups, group = [], []
+        for partial in partials:
+            if group and estimate_tokens("\n\n".join(group + [partial])) > SUMMARY_CHUNK_TOKENS:
+                groups.append(group)
+                group = []
+            group.append(partial)
+        groups.append(group)
+        if len(groups) == len(partials):
+            break
+        with ThreadPoolExecutor(max_workers=SUMMARY_MAX_PARALLEL) as executor:
+            futures = [tracing.submit(executor, _reduce_summaries, group, None, use_cache) for group in groups]
+            partials = [future.result() for future in futures]
+
+    return _reduce_summaries(partials, context, use_cache)
+
+def _summarize_chunk(chunk, index, total, use_cache):
+    prompt = f"""
+                You are an AI assistant for analyzing financial regulation documents.
+                
+                The input below is part {index} of {total} of a longer regulation. Explain this part in detail, keeping article and section numbers, every obligation, condition, threshold and frequency. Keep cross references to other parts as written so they can be resolved later.
+                
+                Input:
+                {chunk}
+            """
+    return _cached_generate("summary_chunk", prompt, chunk, None, use_cache)
+
+def _reduce_summaries(partials, context, use_cache):
+    text = "\n\n".join(f"Part {i}:\n{partial}" for i, partial in enumerate(partials, 1))
+    if context:
+        prompt = f"""
+                    You are an AI assistant for analyzing financial regulation documents.
+                    
+                    Below are detailed explanations of consecutive parts of one regulation. Combine them into a single detailed explanation of the whole regulation. You as an assistant should resolve all of the cross references between the parts.
+                    
+                    Input:
+                    {text}
+                    
+                    Reference of the past year regulation entity relationship is given for your reference below. Use it only for semantic difference matching. Make sure you figure out the differences very clear in the above text and previous year's summarized text and provide the summary for this year based on above text.
+                    
+                    {context}
+                """
+    else:
+        prompt = f"""
+                    You are an AI assistant for analyzing financial regulation documents.
+                    
+                    Below are detailed explanations of consecutive parts of one regulation. Combine them into a single detailed explanation of the whole regulation. You as an assistant should resolve all of the cross references between the parts.
+                    
+                    Input:
+                    {text}
+                """
+    return _cached_generate("summary_reduce", prompt, text, context, use_cache)
 
-def get_entity_relationship_with_context(text, context=None):
-    model = GenerativeModel(os.getenv("GEMINI_MODEL"))
+def get_incremental_summary(changes, previous_summary, use_cache=True):
+    """Updates last year's summary from a compact description of the sections that changed."""
+    prompt = f"""
+                You are an AI assistant for analyzing financial regulation documents.
+                
+                Below is the detailed explanation of the past year's version of a regulation, followed by the sections of this year's version that were amended, added or removed. Sections listed as unchanged have exactly the same wording as last year.
+                
+                Explain this year's regulation in detail. Carry over the explanation of unchanged sections from the past year's explanation, update it for amended sections, add new sections and drop removed ones. Make the differences to the past year very clear. You as an assistant should resolve all of the cross references within the document.
+                
+                Past year's explanation:
+                {previous_summary}
+                
+                Changes:
+                {changes}
+            """
+    return _cached_generate("summary_incremental", prompt, changes, previous_summary, use_cache)
+
+def get_entity_relationship_with_context(text, context=None, use_cache=True, changed_sections=None):
+    inherit = ""
+    if context and changed_sections:
+        inherit = (
+            "Only these sections changed since the past year: " + "; ".join(changed_sections) + ". "
+            "Keep every relationship that stems from other sections exactly as in the reference, with the same entity IDs."
+        )
     if context:
         prompt = f"""
                     You are an AI assistant for analyzing financial regulation documents.
@@ -54,12 +379,12 @@ def get_entity_relationship_with_context(text, context=None):
 
                     Respond in valid JSON ONLY. Make sure you follow below JSON structure.
                     
-                    {
+                    {{
                         "entities": [
-                            {"id": "E1", "name": "Deutsche Bank (LCB)", "type": "organization"}
+                            {{"id": "E1", "name": "Deutsche Bank (LCB)", "type": "organization"}}
                         ],
                         "relationships": [
-                            {"subject_id": "E1", 
+                            {{"subject_id": "E1", 
                              "subject_name": "Deutsche Bank (LCB)", 
                              "verb": "Reports", 
                              "object_id": "E2", 
@@ -67,15 +392,15 @@ def get_entity_relationship_with_context(text, context=None):
                              "Optionality": "Conditional (Only if eligible loans exist)", 
                              "Condition for Relationship to be Active": "Loan disbursed to a Prime Customer during the reporting week, meets eligibility criteria (short-term, overdraft, etc.), and exceeds LKR 10 million (or LKR 1 million if no loans exceed LKR 10 million)",
                              "Property of Object (part of condition)": "Disbursed amount, Borrower classification (Prime Customer), Loan type (short-term, overdraft), Currency (LKR), Customer type (Private Sector)", "Thresholds": "LKR 10 million (general reporting) or LKR 1 million (for individual bank publication only if no loans exceed LKR 10 million)", 
-                             "frequency": "to be validated quarterly"}
+                             "frequency": "to be validated quarterly"}}
                         ]
-                    }
+                    }}
                     
                     Make a strict note of responding in valid JSON only. Don’t explain.
                     Input:
                     {text}
 
-                    Reference of the past year regulation entity relationship is given for your reference below. Use it only for semantic difference matching.
+                    Reference of the past year regulation entity relationship is given for your reference below. Use it only for semantic difference matching. {inherit}
 
                     {context}
                 """
@@ -89,12 +414,12 @@ def get_entity_relationship_with_context(text, context=None):
 
                     Respond in valid JSON ONLY. Make sure you follow below JSON structure.
                     
-                    {
+                    {{
                         "entities": [
-                            {"id": "E1", "name": "Deutsche Bank (LCB)", "type": "organization"}
+                            {{"id": "E1", "name": "Deutsche Bank (LCB)", "type": "organization"}}
                         ],
                         "relationships": [
-                            {"subject_id": "E1", 
+                            {{"subject_id": "E1", 
                              "subject_name": "Deutsche Bank (LCB)", 
                              "verb": "Reports", 
                              "object_id": "E2", 
@@ -102,26 +427,38 @@ def get_entity_relationship_with_context(text, context=None):
                              "Optionality": "Conditional (Only if eligible loans exist)", 
                              "Condition for Relationship to be Active": "Loan disbursed to a Prime Customer during the reporting week, meets eligibility criteria (short-term, overdraft, etc.), and exceeds LKR 10 million (or LKR 1 million if no loans exceed LKR 10 million)",
                              "Property of Object (part of condition)": "Disbursed amount, Borrower classification (Prime Customer), Loan type (short-term, overdraft), Currency (LKR), Customer type (Private Sector)", "Thresholds": "LKR 10 million (general reporting) or LKR 1 million (for individual bank publication only if no loans exceed LKR 10 million)", 
-                             "frequency": "to be validated quarterly"}
+                             "frequency": "to be validated quarterly"}}
                         ]
-                    }
+                    }}
                     
                     Make a strict note of responding in valid JSON only. Don’t explain.
                     Input:
                     {text}
                 """
-    response = model.generate_content(prompt, generation_config={"temperature": 0.01, "top_p": 0.1, "top_k": 40}))
-    match = re.search(r'(\{.*\})', response.text, re.DOTALL)
-    if match:
-        json_text = match.group(1)
-        json.loads(json_text)
-        return json_text
-    else:
-        raise ValueError("Invalid JSON returned by Gemini")
+    cache_context = (context or "") + inherit
+    model_name = os.getenv("GEMINI_MODEL")
+    with _structured_lock:
+        structured = STRUCTURED_OUTPUT and model_name not in _structured_unsupported
+    if structured:
+        try:
+            return _cached_generate("entity_relationship", prompt, text, cache_context, use_cache, postprocess=_extract_json,
+                                    generation_config=STRUCTURED_GENERATION_CONFIG, max_attempts=ENTITY_MAX_ATTEMPTS)
+        except api_exceptions.InvalidArgument as e:
+            logger.warning("JSON response mode rejected by %s, falling back to prompt-only JSON: %s", model_name, e)
+            with _structured_lock:
+                _structured_unsupported.add(model_name)
+    return _cached_generate("entity_relationship", prompt, text, cache_context, use_cache, postprocess=_extract_json,
+                            max_attempts=ENTITY_MAX_ATTEMPTS)
 
-def get_kop_doc(new_summary, new_json_str):
-    model = GenerativeModel(os.getenv("GEMINI_MODEL"))
-    prompt = f"""
+def _extract_json(response_text):
+    data, repaired = parse_json_response(response_text)
+    data, normalized = validate_entity_relationships(data)
+    if repaired or normalized:
+        _record("entity_relationship", "repairs")
+    return json.dumps(data, ensure_ascii=False)
+
+def _kop_prompt(new_summary, new_json_str):
+    return f"""
                 You are an AI assistant for analyzing financial regulation documents and generating a clear Key Operating Procedures (KOP) out of it.
                 
                 Given the original document, pickup the modality of reporting.
@@ -134,5 +471,10 @@ def get_kop_doc(new_summary, new_json_str):
                 
                 Generate a KOP document with step wise instruction for operational personnel.
             """
-    response = model.generate_content(prompt, generation_config={"temperature": 0.01, "top_p": 0.1, "top_k": 40}))
-    return response.text
+
+def get_kop_doc(new_summary, new_json_str, use_cache=True):
+    return _cached_generate("kop", _kop_prompt(new_summary, new_json_str), new_summary, new_json_str, use_cache)
+
+def stream_kop_doc(new_summary, new_json_str, use_cache=True):
+    """Yields the KOP markdown as the model produces it; see _cached_stream."""
+    return _cached_stream("kop", _kop_prompt(new_summary, new_json_str), new_summary, new_json_str, use_cache)